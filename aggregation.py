@@ -0,0 +1,137 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/ThorlabsWaveFrontSensor/aggregation.py         #
+#                                                                   #
+# This file is part of labscript_devices                            #
+#                                                                   #
+#####################################################################
+"""Aggregate storage mode: running reductions instead of every frame.
+
+With storageMode='aggregate' (connection table) or set_storage_mode() (one
+shot) the worker does not keep or save the frames of a shot. Each frame is
+folded into running reductions of everything that would have been stored,
+its per-element mean, standard deviation, minimum and maximum, and its
+buffer slot is reused for a later trigger, so memory does not grow with the
+number of triggers. The reductions are saved to the AGGREGATE_KEY group of
+the image group at the end of the shot, as <key>/Mean, Std, Min and Max in
+the stored shape of each dataset (one compound row for Measurements).
+
+With binFrames = N > 0, the mean of every N consecutive frames is also
+saved, as one row of the usual datasets, so the shot file holds one
+N-frame average where it would have held N frames. The last bin may hold
+fewer frames; see the 'Last Bin Frames' attribute.
+"""
+import numpy as np
+
+from labscript_devices.ThorlabsWaveFrontSensor.reference import Welford
+from labscript_devices.ThorlabsWaveFrontSensor.shot_buffers import RECORD_DTYPE, RECORD_KEY
+
+STORAGE_MODES = ('frames', 'aggregate')
+# Attributes of the device group, written by generate_code
+STORAGE_MODE_ATTR = 'Storage Mode'
+BIN_FRAMES_ATTR = 'Bin Frames'
+# Group in the image group holding the reductions
+AGGREGATE_KEY = 'Aggregate'
+REDUCTIONS = ('Mean', 'Std', 'Min', 'Max')
+
+
+class Aggregator(object):
+    """Running reductions of the datasets in layout, fed one ShotBuffers slot at a time.
+
+    add(buffers) returns the mean of a completed bin, a mapping of dataset
+    name to value that can be appended to a StreamingShotWriter, or None;
+    flush() returns the incomplete last bin, if any. Measurements fields
+    are reduced as one float64 vector.
+    """
+    def __init__(self, layout, binFrames=0):
+        self.layout = layout
+        self.binFrames = binFrames
+        self.frames = 0
+        self.binned = 0
+        self.lastBinFrames = 0
+        self.shapes = {}
+        self.fields = None
+        for key, (shape, dtype) in layout.items():
+            if np.dtype(dtype).names:
+                self.fields = np.array([RECORD_DTYPE.names.index(name) for name in np.dtype(dtype).names])
+                shape = (len(self.fields),)
+            self.shapes[key] = tuple(shape)
+        self.statistics = {key: Welford(shape) for key, shape in self.shapes.items()}
+        self.minimum = {key: np.full(shape, np.nan) for key, shape in self.shapes.items()}
+        self.maximum = {key: np.full(shape, np.nan) for key, shape in self.shapes.items()}
+        self.binSum = {key: np.zeros(shape) for key, shape in self.shapes.items()}
+        self.binCount = {key: np.zeros(shape, dtype=np.int64) for key, shape in self.shapes.items()}
+        self.binFrameCount = 0
+
+    def _values(self, buffers, key):
+        if key == RECORD_KEY:
+            return np.frombuffer(buffers.row, dtype=np.float64)[self.fields]
+        return np.asarray(buffers[key], dtype=np.float64)
+
+    def add(self, buffers):
+        for key in self.shapes:
+            values = self._values(buffers, key)
+            self.statistics[key].update(values)
+            np.fmin(self.minimum[key], values, out=self.minimum[key])
+            np.fmax(self.maximum[key], values, out=self.maximum[key])
+            if self.binFrames:
+                valid = np.isfinite(values)
+                self.binSum[key] += np.where(valid, values, 0.)
+                self.binCount[key] += valid
+        self.frames += 1
+        if self.binFrames:
+            self.binFrameCount += 1
+            if self.binFrameCount == self.binFrames:
+                return self._bin()
+        return None
+
+    def flush(self):
+        if self.binFrameCount:
+            return self._bin()
+        return None
+
+    def _bin(self):
+        """Mean of the current bin in the stored layout, and start the next bin."""
+        storedData = {}
+        for key, (shape, dtype) in self.layout.items():
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = self.binSum[key] / self.binCount[key]
+            if key == RECORD_KEY:
+                # The stored record fields are consecutive float64s
+                storedData[key] = np.ascontiguousarray(mean).view(dtype)[0]
+            else:
+                storedData[key] = mean.astype(dtype)
+            self.binSum[key][...] = 0.
+            self.binCount[key][...] = 0
+        self.lastBinFrames = self.binFrameCount
+        self.binFrameCount = 0
+        self.binned += 1
+        return storedData
+
+    def reductions(self, key):
+        """{reduction name: value} of one dataset, in its stored shape and dtype."""
+        shape, dtype = self.layout[key]
+        values = {
+            'Mean': self.statistics[key].mean_or_nan(),
+            'Std': self.statistics[key].std(),
+            'Min': self.minimum[key],
+            'Max': self.maximum[key],
+        }
+        if key == RECORD_KEY:
+            return {name: np.ascontiguousarray(value).view(dtype) for name, value in values.items()}
+        return {name: value.astype(dtype) for name, value in values.items()}
+
+    def save(self, group):
+        """Write the reductions to AGGREGATE_KEY in group."""
+        if AGGREGATE_KEY in group:
+            del group[AGGREGATE_KEY]
+        out = group.create_group(AGGREGATE_KEY)
+        out.attrs['Frames'] = self.frames
+        out.attrs['Bin Frames'] = self.binFrames
+        out.attrs['Bins'] = self.binned
+        out.attrs['Last Bin Frames'] = self.lastBinFrames
+        for key in self.layout:
+            reductions = out.create_group(key)
+            for name, value in self.reductions(key).items():
+                reductions.create_dataset(name, data=value)
+        return out
@@ -18,8 +18,32 @@ from blacs.device_base_class import (
     MODE_TRANSITION_TO_BUFFERED,
     MODE_TRANSITION_TO_MANUAL,
 )
+import json
+import numpy as np
 import labscript_utils.properties
+from labscript_utils.ls_zprocess import ZMQServer
+from qtutils import inmain, inmain_later
 from qtutils.qt import QtWidgets
+import pyqtgraph as pg
+
+
+class MonitorReceiver(ZMQServer):
+    """Receives the live view frames sent by the worker's monitor.DisplaySocket.
+
+    The frame is drawn in the GUI thread before the reply is sent, so while
+    the GUI is busy the worker keeps acquiring and drops frames from the
+    display instead of queueing them."""
+    def __init__(self, draw):
+        ZMQServer.__init__(self, port=None, dtype='multipart')
+        self.draw = draw
+
+    def handler(self, data):
+        info = json.loads(data[0])
+        wavefront = np.frombuffer(memoryview(data[1]), dtype=np.float32).reshape(info['Wavefront Shape'])
+        zernikes = np.frombuffer(memoryview(data[2]), dtype=np.float32)
+        inmain(self.draw, info, wavefront, zernikes)
+        return [b'ok']
+
 
 class ThorlabsWaveFrontSensorTab(DeviceTab):
     def initialise_GUI(self):        
@@ -91,21 +115,123 @@ class ThorlabsWaveFrontSensorTab(DeviceTab):
         _, AO_widgets, _ = self.auto_create_widgets()  
         widget_list = [("Analog outputs", AO_widgets)]
         self.auto_place_widgets(*widget_list)
+        self.create_monitor_widgets()
         # Connect signals for buttons
         # Add icons
         
         self.serialNum = connection_table_properties.get('serialNum', None)
         self.orientation = connection_table_properties.get('orientation', None)
+        self.triggerWaitMode = connection_table_properties.get('triggerWaitMode', 'backoff')
+        self.triggerWaitTimeout = connection_table_properties.get('triggerWaitTimeout', None)
+        self.runStorePath = connection_table_properties.get('runStorePath', None)
+        self.cropToPupil = connection_table_properties.get('cropToPupil', False)
+        self.sdkBackend = connection_table_properties.get('sdkBackend', 'dll')
+        self.stageTiming = connection_table_properties.get('stageTiming', False)
+        self.computeProfile = connection_table_properties.get('computeProfile', 'full')
+        self.feedbackAddress = connection_table_properties.get('feedbackAddress', None)
+        self.compression = connection_table_properties.get('compression', 'gzip')
+        self.compressionLevel = connection_table_properties.get('compressionLevel', None)
+        self.shuffle = connection_table_properties.get('shuffle', False)
+        self.compressionThreads = connection_table_properties.get('compressionThreads', 0)
+        self.storageMode = connection_table_properties.get('storageMode', 'frames')
+        self.binFrames = connection_table_properties.get('binFrames', 0)
+        self.spotfieldImages = connection_table_properties.get('spotfieldImages', False)
+        self.spotfieldCrop = connection_table_properties.get('spotfieldCrop', None)
+        self.spotfieldDelta = connection_table_properties.get('spotfieldDelta', False)
+        self.wavefrontSolver = connection_table_properties.get('wavefrontSolver', 'sdk')
+        self.processingWorkers = connection_table_properties.get('processingWorkers', 1)
 
         # Create and set the primary worker
         self.create_worker("main_worker",
                             'labscript_devices.ThorlabsWaveFrontSensor.blacs_workers.ThorlabsWaveFrontSensorWorker',
                             {'serialNum':self.serialNum,
-                             'orientation': self.orientation})
+                             'orientation': self.orientation,
+                             'triggerWaitMode': self.triggerWaitMode,
+                             'triggerWaitTimeout': self.triggerWaitTimeout,
+                             'runStorePath': self.runStorePath,
+                             'cropToPupil': self.cropToPupil,
+                             'sdkBackend': self.sdkBackend,
+                             'stageTiming': self.stageTiming,
+                             'computeProfile': self.computeProfile,
+                             'feedbackAddress': self.feedbackAddress,
+                             'compression': self.compression,
+                             'compressionLevel': self.compressionLevel,
+                             'shuffle': self.shuffle,
+                             'compressionThreads': self.compressionThreads,
+                             'storageMode': self.storageMode,
+                             'binFrames': self.binFrames,
+                             'spotfieldImages': self.spotfieldImages,
+                             'spotfieldCrop': self.spotfieldCrop,
+                             'spotfieldDelta': self.spotfieldDelta,
+                             'wavefrontSolver': self.wavefrontSolver,
+                             'processingWorkers': self.processingWorkers})
         
         self.primary_worker = "main_worker"
 
         # Set the capabilities of this device
         self.supports_remote_value_check(False)
-        self.supports_smart_programming(False) 
+        self.supports_smart_programming(True) 
+
+    def create_monitor_widgets(self):
+        # Live view for alignment in manual mode: wavefront map, Zernike coefficients and frame rates
+        self.monitorReceiver = MonitorReceiver(self.draw_monitor_frame)
+        self.monitorButton = QtWidgets.QPushButton('Monitor')
+        self.monitorButton.setCheckable(True)
+        self.monitorButton.toggled.connect(self.on_monitor_toggled)
+        self.monitorRate = QtWidgets.QSpinBox()
+        self.monitorRate.setRange(1, 60)
+        self.monitorRate.setValue(20)
+        self.monitorRate.setSuffix(' Hz display')
+        self.monitorStatus = QtWidgets.QLabel()
+        self.wavefrontView = pg.ImageView()
+        self.wavefrontView.ui.roiBtn.hide()
+        self.wavefrontView.ui.menuBtn.hide()
+        self.zernikePlot = pg.PlotWidget(labels={'bottom': 'Zernike mode', 'left': 'um'})
+        self.zernikeBars = pg.BarGraphItem(x=[], height=[], width=0.8)
+        self.zernikePlot.addItem(self.zernikeBars)
+
+        controls = QtWidgets.QHBoxLayout()
+        controls.addWidget(self.monitorButton)
+        controls.addWidget(self.monitorRate)
+        controls.addWidget(self.monitorStatus, 1)
+        plots = QtWidgets.QHBoxLayout()
+        plots.addWidget(self.wavefrontView)
+        plots.addWidget(self.zernikePlot)
+        monitor = QtWidgets.QWidget()
+        layout = QtWidgets.QVBoxLayout(monitor)
+        layout.addLayout(controls)
+        layout.addLayout(plots)
+        monitor.setMinimumHeight(300)
+        self.get_tab_layout().addWidget(monitor)
+
+    def on_monitor_toggled(self, checked):
+        if checked:
+            self.start_monitor(self.monitorRate.value())
+        else:
+            self.stop_monitor()
+
+    @define_state(MODE_MANUAL, True)
+    def start_monitor(self, maxRate):
+        started = yield(self.queue_work(self.primary_worker, 'start_monitor', self.monitorReceiver.port, maxRate))
+        if not started:
+            self.monitorButton.setChecked(False)
+
+    @define_state(MODE_MANUAL | MODE_BUFFERED | MODE_TRANSITION_TO_BUFFERED | MODE_TRANSITION_TO_MANUAL, True)
+    def stop_monitor(self):
+        yield(self.queue_work(self.primary_worker, 'stop_monitor'))
+
+    def draw_monitor_frame(self, info, wavefront, zernikes):
+        self.wavefrontView.setImage(wavefront.T, autoLevels=True, autoRange=False)
+        self.zernikeBars.setOpts(x=np.arange(1, len(zernikes)+1), height=zernikes)
+        self.monitorStatus.setText('%.0f frames/s, %d shown, %d dropped  RMS %.3f um  PV %.3f um' % (
+            info['Rate'], info['Shown'], info['Dropped'], info['Wavefront RMS'], info['Wavefront Peak-Valley']))
+
+    def transition_to_buffered(self, h5_file, notify_queue):
+        # The worker stops the live view for the shot
+        inmain_later(self.monitorButton.setChecked, False)
+        return DeviceTab.transition_to_buffered(self, h5_file, notify_queue)
+
+    def close_tab(self, *args, **kwargs):
+        self.monitorReceiver.shutdown()
+        return DeviceTab.close_tab(self, *args, **kwargs)
 
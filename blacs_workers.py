@@ -5,27 +5,71 @@
 # This file is part of labscript_devices                            #
 #                                                                   #
 #####################################################################
-from asyncio.log import logger
-import logging
 from blacs.tab_base_classes import Worker
 import ctypes as ct
 import numpy as np
-from time import sleep
-from threading import Thread
-import pickle
-from labscript_utils import dedent
-import labscript_utils.h5_lock
-import h5py
-import labscript_utils.properties
-from labscript_utils.shared_drive import path_to_local
-from labscript_utils.properties import set_attributes
+from time import time, perf_counter
+import os
+from threading import Thread, Event
+# h5py (with labscript_utils.h5_lock) and the run store are imported where they are first used,
+# so that starting the worker does not wait for them
+from labscript_devices.ThorlabsWaveFrontSensor.shot_buffers import (
+    ShotBufferPool,
+    MAX_ZERNIKE_MODES,
+    SCALAR_KEYS,
+    ZernikeOrderCount,
+    FULL_CROP,
+    crop_attrs,
+)
+from labscript_devices.ThorlabsWaveFrontSensor.h5_writer import StorageCodec, StreamingShotWriter
+from labscript_devices.ThorlabsWaveFrontSensor.trigger_wait import make_trigger_wait
+from labscript_devices.ThorlabsWaveFrontSensor.pipeline import ProcessingStage
+from labscript_devices.ThorlabsWaveFrontSensor.wfs_sdk import load_sdk
+from labscript_devices.ThorlabsWaveFrontSensor.device_manager import DeviceProfile, InstrumentList
+from labscript_devices.ThorlabsWaveFrontSensor.settings_cache import SettingsCache
+from labscript_devices.ThorlabsWaveFrontSensor.exposure_table import (
+    COMPUTE_PROFILE_ATTR,
+    EXPOSURES_KEY,
+    OUTPUTS,
+    OUTPUT_KEYS,
+    ExposurePlan,
+    make_exposure,
+    output_names,
+    outputs_mask,
+)
+from labscript_devices.ThorlabsWaveFrontSensor.feedback import NullPublisher, make_publisher
+from labscript_devices.ThorlabsWaveFrontSensor.aggregation import BIN_FRAMES_ATTR, STORAGE_MODE_ATTR, Aggregator
+from labscript_devices.ThorlabsWaveFrontSensor.reference import (
+    REFERENCE_FILE_ATTR,
+    REFERENCE_FRAMES_ATTR,
+    STATISTICS_ONLY_SKIPPED,
+    STORE_WAVEFRONTS_ATTR,
+    SUBTRACT_REFERENCE_ATTR,
+    ReferenceTracker,
+    load_reference,
+)
+from labscript_devices.ThorlabsWaveFrontSensor.spotfield import DEFAULT_LEVEL, NullSpotfieldRecorder, SpotfieldRecorder
+from labscript_devices.ThorlabsWaveFrontSensor.monitor import CONTINUOUS_TRIGGER_MODE, DisplaySocket, Monitor
+from labscript_devices.ThorlabsWaveFrontSensor.stage_timing import NullTimer, StageTimer, TIMING_KEY
+from labscript_devices.ThorlabsWaveFrontSensor.zernike import (
+    SpotGeometry,
+    pupil_crop,
+    spot_grid_crop,
+)
+from labscript_devices.ThorlabsWaveFrontSensor.zonal import ZonalReconstructor
+from labscript_devices.ThorlabsWaveFrontSensor.frame_timing import FRAME_EXPOSURES_KEY, FrameLog, reconcile
+
+# Seconds transition_to_manual waits for the capture thread to return after stopEvent is set
+STOP_TIMEOUT = 5.
+# Setting calls made by program_manual, skipped when their inputs are unchanged
+PROGRAM_MANUAL_CALLS = ('WFS_ConfigureCam', 'WFS_SetReferencePlane', 'WFS_SetPupil')
 
 class ThorlabsWaveFrontSensorWorker(Worker):
     def init(self):
-        # logging.basicConfig(level=logging.DEBUG) # Use this line to debugging  
+        # import logging; logging.basicConfig(level=logging.DEBUG) # Use this line to debugging  
 
-        self.wfs = ct.cdll.LoadLibrary(r'C:\Program Files\IVI Foundation\VISA\Win64\Bin\WFS_64.dll')
-        # self.wfs = ct.WinDLL(r'C:\Program Files (x86)\IVI Foundation\VISA\WinNT\Bin\WFS_32.dll')
+        # The Thorlabs DLL, or the simulator with sdkBackend='simulated'; see wfs_sdk.py
+        self.wfs = load_sdk(self.sdkBackend, self.serialNum)
 
         # Functions and IDs declaration
         self.byref = ct.byref
@@ -74,12 +118,34 @@ class ThorlabsWaveFrontSensorWorker(Worker):
         self.triggerMode.value = 2 # 0 for continuous mode, 1 for active low trigger, 2 for active high trigger, 3 for software control mode
         self.zernikeOrder.value = 4 # The highest order Zernike coefficient will be fitted; 
                                     #   should be between 2 and 10
-        self.ZernikeOrderCount = [0,0,6,10,15,21,28,36,45,55,66]
-        self.arrayZernikes = np.zeros(self.ZernikeOrderCount[self.zernikeOrder.value],dtype = np.float32)
-        self.arrayZernikeRMS = np.zeros(self.zernikeOrder.value,dtype = np.float32)
         self.fourierOrder.value = 2 # Used for optometric calulations; should be chosen from 2, 4, 6 and no larger than zernikeOrder
-        self.arrayReconstructSelect = np.ones(self.ZernikeOrderCount[self.zernikeOrder.value],dtype=np.int32)
+        self.arrayReconstructSelect = np.ones(MAX_ZERNIKE_MODES+1,dtype=np.int32)
                                     # The T/F table determining whether each Zernike mode is used to reconstruct the wavefront
+        self.bufferPool = None # Per-shot measurement buffers, allocated in transition_to_buffered
+        self.stopEvent = Event() # Set in transition_to_manual to end the acquisition thread
+        self.processors = [] # Run on every measurement off the acquisition thread, see pipeline.py
+        self.processingStage = None # The shot's processing thread, see pipeline.py
+        self.thread = None # The shot's capture thread
+        self.h5_filepath = None # Shot file while a shot is running
+        self.settingsCache = SettingsCache() # Device settings last applied by program_manual
+        self.stageTimer = StageTimer() if self.stageTiming else NullTimer() # Per-frame latency of every step
+        self.feedbackPublisher = make_publisher(self.feedbackAddress) # Live results for feedback loops, see feedback.py
+        self.monitor = None # Free-running live view in manual mode, see monitor.py
+        self.reference = None # Reference wavefront kept between shots, see reference.py
+        self.referenceTracker = None
+        self.aggregator = None # Running reductions of the shot in aggregate storage mode, see aggregation.py
+        self.frameCount = 0 # Measurements saved or aggregated this shot
+        self.spotfieldRecorder = NullSpotfieldRecorder() # Raw images of the shot with spotfieldImages, see spotfield.py
+        self.zonalReconstructor = ZonalReconstructor() # Wavefront solver with wavefrontSolver='zonal', see zonal.py
+        self.frameLog = FrameLog() # Ready and arrival time of every frame of the shot, see frame_timing.py
+        self.exposureTimes = np.zeros(0) # expose() times of the shot
+        try:
+            # Filters of the shot datasets, see h5_writer.py
+            self.storageCodec = StorageCodec(self.compression, self.compressionLevel, self.shuffle,
+                                             self.compressionThreads)
+        except ImportError as e:
+            print(str(e) + ', storing with gzip instead')
+            self.storageCodec = StorageCodec('gzip', None, self.shuffle, self.compressionThreads)
         self.doSphericalReference.value = 0 # Not sure what it indicates so I put 0 here assuming it means plane reference
         self.camResolIndex.value = 0
         '''
@@ -133,25 +199,40 @@ class ThorlabsWaveFrontSensorWorker(Worker):
         # 0   Calculate Wavefront for all spots 
         # 1   Limit Wavefront to pupil interior (recommended for the device to measure beam params)
 
-        self.wfs.WFS_GetInstrumentListLen(None,self.byref(self.count))
-        for i in range(self.count.value+1):
-            if i == self.count.value:
-                raise ConnectionError('Failed to find the device: Check the serial number.')
-            self.instrumentListIndex.value = i
-            devStatus = self.wfs.WFS_GetInstrumentListInfo(None,self.instrumentListIndex, self.byref(self.deviceID), self.byref(self.inUse),
-                                        self.instrumentName, self.instrumentSN, self.resourceName) # Should return 0 if succeeds
-            if (self.instrumentSN.value).decode() == self.serialNum:
-                break
-        if not self.inUse.value:
+        # The resource and MLA data found by the last init are tried first; the instrument list is only
+        # scanned if there are none or the resource cannot be opened, see device_manager.py
+        self.deviceProfile = DeviceProfile(self.sdkBackend, self.serialNum)
+        profile = self.deviceProfile.load() or {}
+        self.instrumentList = InstrumentList(self.wfs, self.sdkBackend)
+        devStatus = None
+        if 'resourceName' in profile:
+            self.resourceName.value = profile['resourceName'].encode()
+            self.instrumentName.value = profile['name'].encode()
+            self.instrumentSN.value = self.serialNum.encode()
             devStatus = self.wfs.WFS_init(self.resourceName, self.IDQuery, self.resetDevice, self.byref(self.instrumentHandle))
             if(devStatus != 0):
-                self.errorCode.value = devStatus
-                self.wfs.WFS_error_message(self.instrumentHandle,self.errorCode,self.errorMessage)
-                raise ConnectionError('Error in WFS_init():' + str(self.errorMessage.value))
+                print('Could not open the cached resource ' + profile['resourceName'] + ', scanning for the device')
+                profile = {}
+        if devStatus != 0:
+            # The instrument list is scanned once and shared by the workers of all sensors
+            instrument = self.instrumentList.find(self.serialNum)
+            if instrument is None:
+                raise ConnectionError('Failed to find the device: Check the serial number.')
+            self.deviceID.value = instrument['deviceID']
+            self.inUse.value = instrument['inUse']
+            self.instrumentName.value = instrument['name'].encode()
+            self.instrumentSN.value = instrument['serial'].encode()
+            self.resourceName.value = instrument['resourceName'].encode()
+            if not self.inUse.value:
+                devStatus = self.wfs.WFS_init(self.resourceName, self.IDQuery, self.resetDevice, self.byref(self.instrumentHandle))
+                if(devStatus != 0):
+                    self.errorCode.value = devStatus
+                    self.wfs.WFS_error_message(self.instrumentHandle,self.errorCode,self.errorMessage)
+                    raise ConnectionError('Error in WFS_init():' + str(self.errorMessage.value))
             else:
-                print('WFS has been initialized. Instrument handle: ' +str(self.instrumentHandle.value))
-        else:
-            print('WFS already in use')
+                print('WFS already in use')
+        if devStatus == 0:
+            print('WFS has been initialized. Instrument handle: ' +str(self.instrumentHandle.value))
 
         devStatus = self.wfs.WFS_SetTriggerMode(self.instrumentHandle, self.triggerMode)
         if(devStatus != 0):
@@ -169,9 +250,46 @@ class ThorlabsWaveFrontSensorWorker(Worker):
         else:
             print('WFS MLA selected')
 
+        # Lenslet geometry, needed to turn stored spot deviations back into wavefront slopes
+        self.mlaName = ct.create_string_buffer(256)
+        self.camPitchUm = ct.c_double()
+        self.lensletPitchUm = ct.c_double()
+        self.spotOffsetX = ct.c_double()
+        self.spotOffsetY = ct.c_double()
+        self.lensletFUm = ct.c_double()
+        self.grdCorr0 = ct.c_double()
+        self.grdCorr45 = ct.c_double()
+        mlaFields = ('camPitchUm', 'lensletPitchUm', 'spotOffsetX', 'spotOffsetY', 'lensletFUm', 'grdCorr0', 'grdCorr45')
+        mla = profile.get('mla')
+        if mla is not None and mla['mlaIndex'] == self.mlaIndex.value:
+            # The MLA calibration of a sensor does not change, so the data saved last time is used
+            self.mlaName.value = mla['mlaName'].encode()
+            for field in mlaFields:
+                getattr(self, field).value = mla[field]
+            print('WFS MLA: ' + self.mlaName.value.decode() + ' (from the device profile)')
+        else:
+            devStatus = self.wfs.WFS_GetMlaData(self.instrumentHandle, self.mlaIndex, self.mlaName,
+                                                self.byref(self.camPitchUm), self.byref(self.lensletPitchUm),
+                                                self.byref(self.spotOffsetX), self.byref(self.spotOffsetY),
+                                                self.byref(self.lensletFUm), self.byref(self.grdCorr0), self.byref(self.grdCorr45))
+            if(devStatus != 0):
+                self.errorCode.value = devStatus
+                self.wfs.WFS_error_message(self.instrumentHandle,self.errorCode,self.errorMessage)
+                print('error in WFS_GetMlaData():' + str(self.errorMessage.value))
+            else:
+                print('WFS MLA: ' + self.mlaName.value.decode())
+                mla = dict({field: getattr(self, field).value for field in mlaFields},
+                           mlaIndex=self.mlaIndex.value, mlaName=self.mlaName.value.decode())
+        newProfile = {'resourceName': self.resourceName.value.decode(),
+                      'name': self.instrumentName.value.decode(), 'mla': mla}
+        if not self.inUse.value and newProfile != profile:
+            self.deviceProfile.save(newProfile)
+
 
 
     def program_manual(self,front_panel_values):
+        # The live view is paused while the settings change, and restarted with them
+        monitorSettings = self.stop_monitor()
         self.camResolIndex.value = int(front_panel_values['Resolution Index'])
         self.pupilCenterXMm.value = front_panel_values['Pupil Center X']
         self.pupilCenterYMm.value = front_panel_values['Pupil Center Y']
@@ -181,34 +299,50 @@ class ThorlabsWaveFrontSensorWorker(Worker):
         print('fp'+str(front_panel_values['Fourier Order']))
         self.fourierOrder.value = int(front_panel_values['Fourier Order'])
         self.limitToPupil.value = int(front_panel_values['Limited to Pupil?'])
+        skippedBefore = dict(self.settingsCache.skipped)
 
-        devStatus = self.wfs.WFS_ConfigureCam(self.instrumentHandle, 
-                                        self.pixelFormat, self.camResolIndex, self.byref(self.spotsX), self.byref(self.spotsY))
-        if(devStatus != 0):
+        # Only settings that changed since they were last applied are sent to the device
+        devStatus = self.settingsCache.call('WFS_ConfigureCam', (self.pixelFormat.value, self.camResolIndex.value),
+                                            self.wfs.WFS_ConfigureCam, self.instrumentHandle,
+                                            self.pixelFormat, self.camResolIndex, self.byref(self.spotsX), self.byref(self.spotsY))
+        if devStatus is None:
+            print('WFS camera unchanged')
+        elif(devStatus != 0):
             self.errorCode.value = devStatus
             self.wfs.WFS_error_message(self.instrumentHandle,self.errorCode,self.errorMessage)
             raise KeyError('error in WFS_ConfigureCam():' + str(self.errorMessage.value))
         else:
+            # Reconfiguring the camera resets the spot grid, so reference and pupil have to be set again
+            self.settingsCache.invalidate('WFS_SetReferencePlane', 'WFS_SetPupil')
             print('WFS camera configured')
             print('SpotsX:' + str(self.spotsX.value))
             print('SpotsY:' + str(self.spotsY.value))
 
-        devStatus = self.wfs.WFS_SetReferencePlane(self.instrumentHandle, self.refInternal)
-        if(devStatus != 0):
+        devStatus = self.settingsCache.call('WFS_SetReferencePlane', (self.refInternal.value,),
+                                            self.wfs.WFS_SetReferencePlane, self.instrumentHandle, self.refInternal)
+        if devStatus is None:
+            print('WFS reference plane unchanged')
+        elif(devStatus != 0):
             self.errorCode.value = devStatus
             self.wfs.WFS_error_message(self.instrumentHandle,self.errorCode,self.errorMessage)
             print('error in WFS_SetReferencePlane():' + str(self.errorMessage.value))
         else:
             print('WFS internal reference plane set')
 
-        devStatus = self.wfs.WFS_SetPupil(self.instrumentHandle,
-                                    self.pupilCenterXMm, self.pupilCenterYMm, self.pupilDiameterXMm, self.pupilDiameterYMm)
-        if(devStatus != 0):
+        pupil = (self.pupilCenterXMm, self.pupilCenterYMm, self.pupilDiameterXMm, self.pupilDiameterYMm)
+        devStatus = self.settingsCache.call('WFS_SetPupil', tuple(value.value for value in pupil),
+                                            self.wfs.WFS_SetPupil, self.instrumentHandle, *pupil)
+        if devStatus is None:
+            print('WFS pupil unchanged')
+        elif(devStatus != 0):
             self.errorCode.value = devStatus
             self.wfs.WFS_error_message(self.instrumentHandle,self.errorCode,self.errorMessage)
             print('error in WFS_SetPupil():' + str(self.errorMessage.value))
         else:
             print('WFS pupil set')
+        skipped = [name for name in PROGRAM_MANUAL_CALLS if self.settingsCache.skipped[name] > skippedBefore.get(name, 0)]
+        if skipped:
+            print('Skipped %s, saving about %.1f ms' % (', '.join(skipped), 1e3*self.settingsCache.saved_seconds(skipped)))
         print('camResolIndex: '+str(self.camResolIndex.value))
         print('pupilCenterXMm: '+str(self.pupilCenterXMm.value))
         print('pupilCenterYMm: '+str(self.pupilCenterYMm.value))
@@ -217,206 +351,283 @@ class ThorlabsWaveFrontSensorWorker(Worker):
         print('zernikeOrder: '+str(self.zernikeOrder.value))
         print('fourierOrder: '+str(self.fourierOrder.value))
         print('limitToPupil: '+str(self.limitToPupil.value))
+        if monitorSettings is not None:
+            self.start_monitor(*monitorSettings)
         return {}
+
+    def start_monitor(self, port, maxRate=20.):
+        '''Free-running acquisition shown in the tab, which listens on port, at most maxRate times a second.'''
+        self.stop_monitor()
+        devStatus = self.wfs.WFS_SetTriggerMode(self.instrumentHandle, ct.c_int32(CONTINUOUS_TRIGGER_MODE))
+        if(devStatus != 0):
+            self.errorCode.value = devStatus
+            self.wfs.WFS_error_message(self.instrumentHandle,self.errorCode,self.errorMessage)
+            print('error in SetTriggerMode():' + str(self.errorMessage.value))
+            return False
+        buffers = ShotBufferPool(self.zernikeOrder.value, blockSize=1, crop=self.storage_crop()).acquire()
+        self.monitor = Monitor(self.monitor_frame, buffers, DisplaySocket(port), maxRate)
+        self.monitorSettings = (port, maxRate)
+        self.monitor.start()
+        print('WFS monitor started')
+        return True
+
+    def stop_monitor(self):
+        '''Stop the live view and return to the trigger mode of the shots; returns the
+        settings to start it again with, or None if it was not running.'''
+        if self.monitor is None:
+            return None
+        self.monitor.stop()
+        self.monitor.display.close()
+        print('WFS monitor stopped after %d frames, %d shown' % (self.monitor.frames, self.monitor.shown))
+        self.monitor = None
+        devStatus = self.wfs.WFS_SetTriggerMode(self.instrumentHandle, self.triggerMode)
+        if(devStatus != 0):
+            self.errorCode.value = devStatus
+            self.wfs.WFS_error_message(self.instrumentHandle,self.errorCode,self.errorMessage)
+            print('error in SetTriggerMode():' + str(self.errorMessage.value))
+        return self.monitorSettings
+
+    def monitor_frame(self, buffers):
+        # One frame of the live view: beam, wavefront and Zernike fit, without saving
+        ref = buffers.ref
+        devStatus = self.wfs.WFS_TakeSpotfieldImageAutoExpos(self.instrumentHandle, ref('Exposure Time'), ref('Master Gain'))
+        if(devStatus != 0):
+            self.errorCode.value = devStatus
+            self.wfs.WFS_error_message(self.instrumentHandle,self.errorCode,self.errorMessage)
+            print('error in WFS_TakeSpotfieldImageAutoExpos():' + str(self.errorMessage.value))
+            return False
+        calls = [
+            ('WFS_CalcSpotsCentrDiaIntens', (self.dynamicNoiseCut, self.calculateDiameters)),
+            ('WFS_CalcBeamCentroidDia', (ref('Beam Center X'), ref('Beam Center Y'), ref('Beam Diameter X'), ref('Beam Diameter Y'))),
+            ('WFS_CalcSpotToReferenceDeviations', (self.cancelWavefrontTilt,)),
+            ('WFS_ZernikeLsf', (self.byref(ct.c_int32(self.zernikeOrder.value)), buffers.zernikesPtr,
+                                buffers.zernikeRMSPtr, ref('Radius of Curvature'))),
+            ('WFS_CalcWavefront', (ct.c_int32(0), self.limitToPupil, buffers.wavefrontPtr)),
+            ('WFS_CalcWavefrontStatistics', (ref('Wavefront Min'), ref('Wavefront Max'), ref('Wavefront Peak-Valley'),
+                                             ref('Wavefront Mean'), ref('Wavefront RMS'), ref('Wavefront Weighted RMS'))),
+        ]
+        for name, args in calls:
+            devStatus = getattr(self.wfs, name)(self.instrumentHandle, *args)
+            if(devStatus != 0):
+                self.errorCode.value = devStatus
+                self.wfs.WFS_error_message(self.instrumentHandle,self.errorCode,self.errorMessage)
+                print('error in ' + name + '():' + str(self.errorMessage.value))
+                return False
+        return True
         
     def threaded_worker(self,wfs,instrumentHandle,errorCode,errorMessage,byref,dynamicNoiseCut,
-                        calculateDiameters,cancelWavefrontTilt,wavefrontType,limitToPupil,
-                        zernikeOrder,fourierOrder,arrayZernikes,arrayZernikeRMS,
-                        arrayReconstructSelect,doSphericalReference,dataList):
-
-        exposureTimeAct = ct.c_double()
-        masterGainAct = ct.c_double() 
-        beam_centroid_x = ct.c_double() 
-        beam_centroid_y = ct.c_double() 
-        beam_diameter_x = ct.c_double() 
-        beam_diameter_y = ct.c_double()
-        arrayWavefront = np.zeros((80,80),dtype = np.float32)
-        arrayDeviation_x = np.zeros((80,80),dtype=np.float32) 
-        arrayDeviation_y = np.zeros((80,80),dtype=np.float32)
-        arrayDeviation = np.zeros((80,80,2),dtype=np.float32) 
-        arrayIntensity = np.zeros((80,80),dtype=np.float32) 
-        wavefront_min = ct.c_double() 
-        wavefront_max = ct.c_double() 
-        wavefront_diff = ct.c_double() 
-        wavefront_mean = ct.c_double() 
-        wavefront_rms = ct.c_double() 
-        wavefront_weighted_rms = ct.c_double() 
-        fourierM = ct.c_double()
-        fourierJ0 = ct.c_double()
-        fourierJ45 = ct.c_double()
-        optoSphere = ct.c_double()
-        optoCylinder = ct.c_double()
-        optoAxisDeg = ct.c_double()
-        radiusOfCurvature = ct.c_double()
-        fitErrMean = ct.c_double()
-        fitErrStdev = ct.c_double()
+                        calculateDiameters,cancelWavefrontTilt,limitToPupil,
+                        fourierOrder,bufferPool,
+                        arrayReconstructSelect,doSphericalReference,processingStage,triggerWait,timer,exposurePlan,publisher,
+                        spotfield,zonalWavefront,frameLog):
+
+        # Settings of the current exposure, see exposure_table.py
+        wavefrontType = ct.c_int32()
+        zernikeOrder = ct.c_int32()
+        exposureTimeSet = ct.c_double(np.nan)
+        masterGainSet = ct.c_double(np.nan)
+        exposureTimeAct = ct.c_double(np.nan)
+        masterGainAct = ct.c_double(np.nan)
         status = ct.c_longlong()
-        global kill_loop
-        
+        def takeImage():
+            if autoExposure:
+                # The exposure found by the search goes straight into the record
+                return wfs.WFS_TakeSpotfieldImageAutoExpos(instrumentHandle, ref('Exposure Time'), ref('Master Gain'))
+            return wfs.WFS_TakeSpotfieldImage(instrumentHandle)
+        # Stage timing, see stage_timing.py; lap() does nothing unless timing is switched on
+        lap = timer.lap
+        if timer.enabled:
+            untimedTakeImage = takeImage
+            def takeImage():
+                # Everything up to the last attempt is waiting; the attempt that returns the frame is Take Image
+                lap('Trigger Wait', accumulate=True)
+                return untimedTakeImage()
+
         while True:
-            wfs.WFS_GetStatus(instrumentHandle,byref(status))
+            # Free-running frames never wait on the trigger, so check for the end of the shot here too
+            if triggerWait.stopEvent.is_set():
+                return 0
+            # Each measurement gets its own preallocated slot that the SDK fills in place
+            # The scalar results go straight into the slot's row of the pool's record table
+            buffers = bufferPool.acquire()
+            ref = buffers.ref
+            timer.start(buffers.index)
 
-            # For some reason the trigger detect loop does not behave as I expected; the following implementation is reserved for future optimization
-            # wfs.WFS_TakeSpotfieldImageAutoExpos(instrumentHandle,byref(exposureTimeAct), byref(masterGainAct))
-
-            # print_counter = 0
-            # while True:
-            #     if kill_loop:
-            #         return 0
-            #     devStatus = wfs.WFS_GetStatus(instrumentHandle,byref(status))
-            #     if(devStatus == 0):
-            #         if(status.value & 0x00000080):
-            #             if print_counter >= 10:
-            #                 print('Waiting for trigger')
-            #                 print_counter = -1
-            #             print_counter += 1
-            #             # sleep(1e-6)
-            #         else:
-            #             print("Triggered!")
-            #             break         
-            #     else:
-            #         errorCode.value = devStatus
-            #         wfs.WFS_error_message(instrumentHandle,errorCode,errorMessage)
-            #         print('error in WFS_GetStatus():' + str(errorMessage.value)+'\nPlease refresh Devices Tab.\n')
-            #         wfs.WFS_close(instrumentHandle)
-            #         raise
-
-            print_counter = 0
-            while True:
-                if kill_loop:
-                    return 0
-                devStatus = wfs.WFS_TakeSpotfieldImageAutoExpos(instrumentHandle,byref(exposureTimeAct), byref(masterGainAct))
-                if(devStatus == -1074001642):
-                    if print_counter >= 1000:
-                        print('Waiting for trigger')
-                        print_counter = -1
-                    print_counter += 1
-                    sleep(1e-9)
-                elif(devStatus == 0):
-                    print('Triggered!')
-                    break       
-                else:
-                    errorCode.value = devStatus
-                    wfs.WFS_error_message(instrumentHandle,errorCode,errorMessage)
-                    print('error in WFS_GetStatus():' + str(errorMessage.value)+'\nPlease refresh Devices Tab.\n')
-                    wfs.WFS_close(instrumentHandle)
-                    raise
+            exposure = exposurePlan[buffers.index]
+            outputs = exposure.outputs
+            wavefrontType.value = exposure.wavefrontType
+            zernikeOrder.value = exposure.zernikeOrder
+            autoExposure = np.isnan(exposure.exposureTime)
+            if autoExposure:
+                # The search changes exposure time and gain, so a later fixed exposure has to set them again
+                exposureTimeSet.value = masterGainSet.value = np.nan
+            else:
+                # A fixed exposure is set before waiting for the trigger, and only if it changed
+                if exposure.exposureTime != exposureTimeSet.value:
+                    exposureTimeSet.value = exposure.exposureTime
+                    devStatus = wfs.WFS_SetExposureTime(instrumentHandle, exposureTimeSet, byref(exposureTimeAct))
+                    if(devStatus != 0):
+                        exposureTimeSet.value = np.nan
+                        errorCode.value = devStatus
+                        wfs.WFS_error_message(instrumentHandle,errorCode,errorMessage)
+                        print('error in WFS_SetExposureTime():' + str(errorMessage.value))
+                if not np.isnan(exposure.masterGain) and exposure.masterGain != masterGainSet.value:
+                    masterGainSet.value = exposure.masterGain
+                    devStatus = wfs.WFS_SetMasterGain(instrumentHandle, masterGainSet, byref(masterGainAct))
+                    if(devStatus != 0):
+                        masterGainSet.value = np.nan
+                        errorCode.value = devStatus
+                        wfs.WFS_error_message(instrumentHandle,errorCode,errorMessage)
+                        print('error in WFS_SetMasterGain():' + str(errorMessage.value))
+                buffers.record['Exposure Time'] = exposureTimeAct.value
+                buffers.record['Master Gain'] = masterGainAct.value
+            # Results this exposure does not ask for stay NaN rather than holding an earlier frame's values
+            buffers.clear(exposure.skipped)
+            lap('Set Exposure')
 
+            # Wait for the trigger without spinning; see trigger_wait.py for the available strategies
+            readyTime = perf_counter()
+            devStatus = triggerWait.wait(takeImage)
+            hostTime = perf_counter()
+            lap('Take Image')
+            if devStatus is None:
+                return 0
+            elif devStatus != 0:
+                errorCode.value = devStatus
+                wfs.WFS_error_message(instrumentHandle,errorCode,errorMessage)
+                print('error in WFS_TakeSpotfieldImage():' + str(errorMessage.value)+'\nPlease refresh Devices Tab.\n')
+                wfs.WFS_close(instrumentHandle)
+                raise RuntimeError('error in WFS_TakeSpotfieldImage():' + str(errorMessage.value))
+            if autoExposure:
+                exposureTimeAct.value = buffers.record['Exposure Time']
+                masterGainAct.value = buffers.record['Master Gain']
+            buffers.record['Timestamp'] = time()
+            buffers.record['Trigger Index'] = buffers.index
+            buffers.record['Host Time'] = hostTime
+            # A frame there on the first call was triggered before the worker was ready for it
+            frameLog.append(readyTime, hostTime, triggerWait.retries == 0)
+            # Power and ambient light warnings of this image
+            wfs.WFS_GetStatus(instrumentHandle,byref(status))
+            buffers.record['Device Status'] = status.value
 
             devStatus = wfs.WFS_CalcSpotsCentrDiaIntens(instrumentHandle, 
                                                         dynamicNoiseCut, calculateDiameters)
+            lap('Calc Spots')
             if(devStatus != 0):
                 errorCode.value = devStatus
                 wfs.WFS_error_message(instrumentHandle,errorCode,errorMessage)
                 print('error in WFS_CalcSpotsCentrDiaIntens():' + str(errorMessage.value))
 
-            devStatus = wfs.WFS_CalcBeamCentroidDia(instrumentHandle, byref(beam_centroid_x), 
-                                                        byref(beam_centroid_y), byref(beam_diameter_x), byref(beam_diameter_y))
-            if(devStatus != 0):
-                errorCode.value = devStatus
-                wfs.WFS_error_message(instrumentHandle,errorCode,errorMessage)
-                print('error in WFS_CalcBeamCentroidDia():' + str(errorMessage.value))
+            if outputs & OUTPUTS['centroid']:
+                devStatus = wfs.WFS_CalcBeamCentroidDia(instrumentHandle, ref('Beam Center X'), 
+                                                            ref('Beam Center Y'), ref('Beam Diameter X'), ref('Beam Diameter Y'))
+                lap('Beam Centroid')
+                if(devStatus != 0):
+                    errorCode.value = devStatus
+                    wfs.WFS_error_message(instrumentHandle,errorCode,errorMessage)
+                    print('error in WFS_CalcBeamCentroidDia():' + str(errorMessage.value))
+
+            if spotfield.enabled:
+                # The raw image, cropped around the beam centroid if this exposure calculated it
+                devStatus = wfs.WFS_GetSpotfieldImageCopy(instrumentHandle, spotfield.imagePtr,
+                                                          byref(spotfield.rows), byref(spotfield.columns))
+                if(devStatus != 0):
+                    errorCode.value = devStatus
+                    wfs.WFS_error_message(instrumentHandle,errorCode,errorMessage)
+                    print('error in WFS_GetSpotfieldImageCopy():' + str(errorMessage.value))
+                else:
+                    spotfield.put(buffers.index, buffers.record['Beam Center X'], buffers.record['Beam Center Y'])
+                lap('Spotfield Copy')
 
             devStatus = wfs.WFS_CalcSpotToReferenceDeviations(instrumentHandle, cancelWavefrontTilt)
+            lap('Reference Deviations')
             if(devStatus != 0):
                 errorCode.value = devStatus
                 wfs.WFS_error_message(instrumentHandle,errorCode,errorMessage)
                 print('error in WFS_CalcSpotToReferenceDeviations():' + str(errorMessage.value))
 
-            devStatus = wfs.WFS_GetSpotDeviations(instrumentHandle, arrayDeviation_x.ctypes.data_as(ct.POINTER(ct.c_double)),arrayDeviation_y.ctypes.data_as(ct.POINTER(ct.c_double)))
+            # The x and y planes are written side by side; buffers.deviationStored interleaves them without copying
+            devStatus = wfs.WFS_GetSpotDeviations(instrumentHandle, buffers.deviationXPtr, buffers.deviationYPtr)
+            lap('Get Deviations')
             if(devStatus != 0):
                 errorCode.value = devStatus
                 wfs.WFS_error_message(instrumentHandle,errorCode,errorMessage)
                 print('error in WFS_GetSpotDeviations():' + str(errorMessage.value))
 
-            for i in range(80):
-                for j in range(80):
-                    arrayDeviation[i][j][0] = arrayDeviation_x[i][j]
-                    arrayDeviation[i][j][1] = arrayDeviation_y[i][j]
-
-            devStatus = wfs.WFS_GetSpotIntensities(instrumentHandle, arrayIntensity.ctypes.data_as(ct.POINTER(ct.c_double)))
+            devStatus = wfs.WFS_GetSpotIntensities(instrumentHandle, buffers.intensityPtr)
+            lap('Get Intensities')
             if(devStatus != 0):
                 errorCode.value = devStatus
                 wfs.WFS_error_message(instrumentHandle,errorCode,errorMessage)
                 print('error in WFS_GetSpotIntensities():' + str(errorMessage.value))
 
-            
-            arrayaddr=arrayWavefront.ctypes.data_as(ct.POINTER(ct.c_float))
-            devStatus = wfs.WFS_CalcWavefront(instrumentHandle, 
-                                            wavefrontType, limitToPupil,arrayaddr)
-            if(devStatus != 0):
-                errorCode.value = devStatus
-                wfs.WFS_error_message(instrumentHandle,errorCode,errorMessage)
-                print('error in WFS_CalcWavefront():' + str(errorMessage.value))
-                print('WFS wavefront calculated')
-            
+            # The optometric values and the reconstructed deviations are calculated from the Zernike fit,
+            # and the reconstructed wavefront types need the reconstructed deviations, so fit first
+            if outputs & OUTPUTS['zernikes']:
+                devStatus = wfs.WFS_ZernikeLsf(instrumentHandle, byref(zernikeOrder), buffers.zernikesPtr, 
+                                    buffers.zernikeRMSPtr, ref('Radius of Curvature'))
+                lap('Zernike Fit')
+                if(devStatus != 0):
+                    errorCode.value = devStatus
+                    wfs.WFS_error_message(instrumentHandle,errorCode,errorMessage)
+                    print('error in WFS_ZernikeLsf():' + str(errorMessage.value))
+                if exposure.zernikeOrder < bufferPool.zernikeOrder:
+                    # Modes above this exposure's order were not fitted
+                    buffers.zernikes[ZernikeOrderCount[exposure.zernikeOrder]+1:] = np.nan
+                    buffers.zernikeRMS[exposure.zernikeOrder+1:] = np.nan
 
-            devStatus = wfs.WFS_CalcWavefrontStatistics(instrumentHandle, byref(wavefront_min), byref(wavefront_max), 
-                                byref(wavefront_diff), byref(wavefront_mean), byref(wavefront_rms), byref(wavefront_weighted_rms))
-            if(devStatus != 0):
-                errorCode.value = devStatus
-                wfs.WFS_error_message(instrumentHandle,errorCode,errorMessage)
-                print('error in WFS_CalcWavefrontStatistics():' + str(errorMessage.value))
+            # Feedback loops get the frame now; the remaining results only go to the shot file
+            publisher.publish(buffers, exposure.zernikeOrder if outputs & OUTPUTS['zernikes'] else 0)
+            lap('Publish')
 
-            
+            if outputs & OUTPUTS['fit_error']:
+                devStatus = wfs.WFS_CalcReconstrDeviations(instrumentHandle, zernikeOrder,arrayReconstructSelect.ctypes.data_as(ct.POINTER(ct.c_int32)) ,
+                                                            doSphericalReference, ref('Fit Error Mean'), ref('Fit Error Std'))
+                lap('Reconstruct Deviations')
+                if(devStatus != 0):
+                    errorCode.value = devStatus
+                    wfs.WFS_error_message(instrumentHandle,errorCode,errorMessage)
+                    print('error in WFS_CalcReconstrDeviations():' + str(errorMessage.value))
 
-            devStatus = wfs.WFS_CalcFourierOptometric(instrumentHandle, zernikeOrder, fourierOrder, byref(fourierM), byref(fourierJ0),
-                                                        byref(fourierJ45), byref(optoSphere), byref(optoCylinder), byref(optoAxisDeg))
-            if(devStatus != 0):
-                errorCode.value = devStatus
-                wfs.WFS_error_message(instrumentHandle,errorCode,errorMessage)
-                print('error in CalcFourierOptometric():' + str(errorMessage.value))
-            
+            if outputs & OUTPUTS['optometric']:
+                devStatus = wfs.WFS_CalcFourierOptometric(instrumentHandle, zernikeOrder, fourierOrder, ref('Fourier M'), ref('Fourier J0'),
+                                                            ref('Fourier J45'), ref('Optometric Sphere'), ref('Optometric Cylinder'), ref('Optometric Axis Angle'))
+                lap('Fourier Optometric')
+                if(devStatus != 0):
+                    errorCode.value = devStatus
+                    wfs.WFS_error_message(instrumentHandle,errorCode,errorMessage)
+                    print('error in CalcFourierOptometric():' + str(errorMessage.value))
 
-            devStatus = wfs.WFS_ZernikeLsf(instrumentHandle, byref(zernikeOrder), arrayZernikes.ctypes.data_as(ct.POINTER(ct.c_double)), 
-                                arrayZernikeRMS.ctypes.data_as(ct.POINTER(ct.c_double)), byref(radiusOfCurvature))
-            if(devStatus != 0):
-                errorCode.value = devStatus
-                wfs.WFS_error_message(instrumentHandle,errorCode,errorMessage)
-                print('error in WFS_ZernikeLsf():' + str(errorMessage.value))
-            
+            # The zonal solver does the measured wavefront and its statistics on the processing thread
+            if zonalWavefront and wavefrontType.value == 0:
+                outputs &= ~(OUTPUTS['wavefront'] | OUTPUTS['statistics'])
 
-            devStatus = wfs.WFS_CalcReconstrDeviations(instrumentHandle, zernikeOrder,arrayReconstructSelect.ctypes.data_as(ct.POINTER(ct.c_double)) ,
-                                                        doSphericalReference, byref(fitErrMean), byref(fitErrStdev))
-            if(devStatus != 0):
-                errorCode.value = devStatus
-                wfs.WFS_error_message(instrumentHandle,errorCode,errorMessage)
-                print('error in WFS_CalcReconstrDeviations():' + str(errorMessage.value))
+            if outputs & OUTPUTS['wavefront']:
+                devStatus = wfs.WFS_CalcWavefront(instrumentHandle, 
+                                                wavefrontType, limitToPupil,buffers.wavefrontPtr)
+                lap('Calc Wavefront')
+                if(devStatus != 0):
+                    errorCode.value = devStatus
+                    wfs.WFS_error_message(instrumentHandle,errorCode,errorMessage)
+                    print('error in WFS_CalcWavefront():' + str(errorMessage.value))
+
+            if outputs & OUTPUTS['statistics']:
+                devStatus = wfs.WFS_CalcWavefrontStatistics(instrumentHandle, ref('Wavefront Min'), ref('Wavefront Max'), 
+                                    ref('Wavefront Peak-Valley'), ref('Wavefront Mean'), ref('Wavefront RMS'), ref('Wavefront Weighted RMS'))
+                lap('Wavefront Statistics')
+                if(devStatus != 0):
+                    errorCode.value = devStatus
+                    wfs.WFS_error_message(instrumentHandle,errorCode,errorMessage)
+                    print('error in WFS_CalcWavefrontStatistics():' + str(errorMessage.value))
 
-            
             # print('saving to file:'+path)
             # f = open(path, "ab+")
             # f = open(path, "a") # Used for debugging
             # f = open(path, "w") # Used for debugging
-            storedData = {
-                'Beam Center X':beam_centroid_x.value,
-                'Beam Center Y':beam_centroid_y.value,
-                'Beam Diameter X':beam_diameter_x.value,
-                'Beam Diameter Y':beam_diameter_y.value, 
-                'Wavefront Min':wavefront_min.value, 
-                'Wavefront Max':wavefront_max.value, 
-                'Wavefront Peak-Valley':wavefront_diff.value,
-                'Wavefront Mean':wavefront_mean.value, 
-                'Wavefront RMS':wavefront_rms.value, 
-                'Wavefront Weighted RMS':wavefront_weighted_rms.value,
-                'Fourier M':fourierM.value,
-                'Fourier J0':fourierJ0.value,
-                'Fourier J45':fourierJ45.value,
-                'Optometric Sphere':optoSphere.value,
-                'Optometric Cylinder':optoCylinder.value,
-                'Optometric Axis Angle':optoAxisDeg.value,
-                'Radius of Curvature':radiusOfCurvature.value,
-                'Fit Error Mean':fitErrMean.value,
-                'Fit Error Std':fitErrStdev.value,
-                'Wavefront': arrayWavefront,
-                'Zernikes Coefficients':arrayZernikes,
-                'Zernikes RMS':arrayZernikeRMS,
-                'Spot Deviations':arrayDeviation,
-                'Spot Intensities':arrayIntensity
-            }
-            dataList.append(storedData)
-            print('appended')
-            print(len(dataList))
+            # Saving happens on the processing thread so the next trigger is not held up
+            buffers.record['Capture Duration'] = perf_counter() - hostTime
+            processingStage.put(buffers)
+            lap('Queue')
             # print(storedData)
             # f.write(str(storedData)+'\r') Used for debugging
             # pickle.dump(storedData,f)
@@ -425,7 +636,148 @@ class ThorlabsWaveFrontSensorWorker(Worker):
 
 
     def transition_to_buffered(self,device_name,h5file,initial_values,fresh):
+        # Shots need the hardware trigger; the tab restarts the live view if it wants it back
+        self.stop_monitor()
+        if fresh:
+            # BLACS asks for a full reprogram, so send every setting again after the shot
+            self.settingsCache.invalidate()
         self.dataList = []
+        # Per-exposure settings compiled from expose(). The front panel settings apply to the rest,
+        # with the compute profile of the shot, or of the connection table if the shot does not set one
+        computeOutputs = outputs_mask(self.computeProfile)
+        exposures = None
+        deviceAttrs = {}
+        import labscript_utils.h5_lock
+        import h5py
+        with h5py.File(h5file, 'r') as f:
+            group = f.get('devices/' + device_name)
+            if group is not None:
+                deviceAttrs = dict(group.attrs)
+                computeOutputs = int(deviceAttrs.get(COMPUTE_PROFILE_ATTR, computeOutputs))
+                if EXPOSURES_KEY in group:
+                    exposures = group[EXPOSURES_KEY][:]
+        self.exposureTimes = np.sort(exposures['t']) if exposures is not None else np.zeros(0)
+        self.frameLog.reset()
+        self.exposurePlan = ExposurePlan(make_exposure(wavefrontType=self.wavefrontType.value,
+                                                       zernikeOrder=self.zernikeOrder.value,
+                                                       outputs=computeOutputs), exposures)
+        zernikeOrder = self.exposurePlan.max_zernike_order()
+        crop = self.storage_crop()
+        # Aggregated frames are not kept, so their slots are reused and memory stays constant in the triggers
+        aggregate = str(deviceAttrs.get(STORAGE_MODE_ATTR, self.storageMode)) == 'aggregate'
+        binFrames = int(deviceAttrs.get(BIN_FRAMES_ATTR, self.binFrames))
+        if (self.bufferPool is None or self.bufferPool.zernikeOrder != zernikeOrder
+                or self.bufferPool.crop != crop or self.bufferPool.recycle != aggregate):
+            self.bufferPool = ShotBufferPool(zernikeOrder, crop=crop, recycle=aggregate)
+        else:
+            self.bufferPool.reset()
+        self.frameCount = 0
+
+        # Measurements are appended to the shot file as they arrive
+        # Use orientation for image path, device_name if orientation unspecified
+        if self.orientation is not None:
+            image_path = 'images/' + self.orientation
+        else:
+            image_path = 'images/' + self.device_name
+
+        # Reference subtraction asked for by capture_reference()/subtract_reference(), see reference.py
+        skipped = self.exposurePlan.never_calculated()
+        self.referenceTracker = None
+        captureFrames = int(deviceAttrs.get(REFERENCE_FRAMES_ATTR, 0))
+        if REFERENCE_FILE_ATTR in deviceAttrs:
+            from labscript_utils.shared_drive import path_to_local
+            referenceFile = path_to_local(str(deviceAttrs[REFERENCE_FILE_ATTR]))
+            try:
+                self.reference = load_reference(referenceFile, image_path)
+            except (OSError, KeyError, ValueError) as e:
+                print('error loading the reference from ' + referenceFile + ': ' + str(e))
+                self.reference = None
+        if captureFrames or deviceAttrs.get(SUBTRACT_REFERENCE_ATTR, False):
+            if captureFrames or self.reference is not None:
+                statisticsOnly = not deviceAttrs.get(STORE_WAVEFRONTS_ATTR, True)
+                self.referenceTracker = ReferenceTracker(self.reference, captureFrames, statisticsOnly)
+                if statisticsOnly:
+                    # Only statistics of the spot arrays are kept, see reference.py
+                    skipped = skipped + STATISTICS_ONLY_SKIPPED
+            else:
+                print('No reference to subtract; capture one with capture_reference() first')
+        attrs = {
+            'Wavefront Sensor': self.device_name,
+            'Resolution Index': self.camResolIndex.value,
+            'Pupil Center X': self.pupilCenterXMm.value,
+            'Pupil Center Y': self.pupilCenterYMm.value,
+            'Pupil Diameter X': self.pupilDiameterXMm.value,
+            'Pupil Diameter Y': self.pupilDiameterYMm.value,
+            'Limited to Pupil?': self.limitToPupil.value,
+            'Highest Zernike Order': zernikeOrder,
+            'Exposures': len(self.exposurePlan),
+            'Outputs': ', '.join(output_names(self.exposurePlan.outputs())),
+            'Fourier Order': self.fourierOrder.value,
+            'Spots X': self.spotsX.value,
+            'Spots Y': self.spotsY.value,
+            'MLA Name': self.mlaName.value.decode(),
+            'Camera Pitch': self.camPitchUm.value,
+            'Lenslet Pitch': self.lensletPitchUm.value,
+            'Lenslet Focal Length': self.lensletFUm.value,
+            'Spot Offset X': self.spotOffsetX.value,
+            'Spot Offset Y': self.spotOffsetY.value,
+            'Dynamic Noise Cut': self.dynamicNoiseCut.value,
+            'Wavefront Solver': self.wavefrontSolver,
+        }
+        attrs.update(crop_attrs(crop))
+        attrs['Storage Mode'] = 'aggregate' if aggregate else 'frames'
+        if aggregate:
+            attrs['Bin Frames'] = binFrames
+        if self.referenceTracker is not None:
+            attrs['Reference Subtracted'] = True
+            attrs['Reference Frames Captured'] = captureFrames
+        layout = self.bufferPool.layout(skipped)
+        self.aggregator = Aggregator(layout, binFrames) if aggregate else None
+        if aggregate and not binFrames:
+            # Only the reductions are saved, at the end of the shot
+            layout = {}
+        self.stageTimer.reset()
+        # Anything that can fail on the settings alone fails here, before any thread is started
+        triggerWait = make_trigger_wait(self.triggerWaitMode, self.wfs, self.instrumentHandle,
+                                        self.stopEvent, self.triggerWaitTimeout)
+        # The scalar results are saved as one compound 'Measurements' table, plus one dataset per field;
+        # results no exposure of the shot calculates are not stored at all
+        self.shotWriter = StreamingShotWriter(h5file, image_path,
+                                              layout, attrs,
+                                              compression=self.storageCodec,
+                                              timer=self.stageTimer if self.stageTimer.enabled else None)
+        try:
+            self.start_shot_threads(h5file, image_path, aggregate, triggerWait)
+        except Exception:
+            # h5_filepath is not set yet, so transition_to_manual would not stop what did start
+            self.stop_shot_threads()
+            raise
+        self.h5_filepath = h5file
+        return {}
+
+    def start_shot_threads(self, h5file, image_path, aggregate, triggerWait):
+        # The writer, spotfield, processing and capture threads of the shot, in that order
+        self.shotWriter.start()
+        if self.spotfieldImages:
+            # Raw spotfield images, written by their own thread; see spotfield.py
+            self.spotfieldRecorder = SpotfieldRecorder(h5file, image_path, self.spotfieldCrop, self.spotfieldDelta,
+                                                       self.spot_geometry(),
+                                                       codec=StorageCodec('gzip', DEFAULT_LEVEL,
+                                                                          threads=self.compressionThreads),
+                                                       fileLock=self.shotWriter.fileLock,
+                                                       timer=self.stageTimer if self.stageTimer.enabled else None)
+            self.spotfieldRecorder.start()
+        # The reference tracker is a sink rather than a processor so it sees the frames in order, before saving
+        sinks = [self.aggregate_measurement if aggregate else self.store_measurement]
+        if self.referenceTracker is not None:
+            sinks.insert(0, self.referenceTracker)
+        processors = list(self.processors)
+        zonalWavefront = self.wavefrontSolver == 'zonal'
+        if zonalWavefront:
+            self.zonalGeometry = self.spot_geometry()
+            processors.append(self.reconstruct_wavefront)
+        self.processingStage = ProcessingStage(sinks, processors, self.processingWorkers)
+        self.processingStage.start()
         passed_args = (self.wfs,
                         self.instrumentHandle,
                         self.errorCode,
@@ -434,23 +786,106 @@ class ThorlabsWaveFrontSensorWorker(Worker):
                         self.dynamicNoiseCut,
                         self.calculateDiameters,
                         self.cancelWavefrontTilt,
-                        self.wavefrontType,
                         self.limitToPupil,
-                        self.zernikeOrder,
                         self.fourierOrder,
-                        self.arrayZernikes,
-                        self.arrayZernikeRMS,
+                        self.bufferPool,
                         self.arrayReconstructSelect,
                         self.doSphericalReference,
                         # self.path,
-                        self.dataList
+                        self.processingStage,
+                        triggerWait,
+                        self.stageTimer,
+                        self.exposurePlan,
+                        self.feedbackPublisher,
+                        self.spotfieldRecorder,
+                        zonalWavefront,
+                        self.frameLog
                         )
-        self.h5_filepath = h5file
-        global kill_loop
-        kill_loop = False
+        self.stopEvent.clear()
         self.thread = Thread(target = self.threaded_worker, args = passed_args)
         self.thread.start()
-        return {}
+
+    def stop_shot_threads(self):
+        # Stop whatever start_shot_threads got to before it failed; closing what never started does nothing
+        self.stopEvent.set()
+        if self.thread is not None and self.thread.is_alive():
+            self.thread.join(timeout=STOP_TIMEOUT)
+        for stage in (self.processingStage, self.shotWriter, self.spotfieldRecorder):
+            try:
+                if stage is not None:
+                    stage.close()
+            except Exception as e:
+                print('error stopping the shot: ' + str(e))
+        self.spotfieldRecorder = NullSpotfieldRecorder()
+
+    def spot_geometry(self):
+        return SpotGeometry(self.spotsX.value, self.spotsY.value,
+                            self.lensletPitchUm.value, self.camPitchUm.value, self.lensletFUm.value,
+                            self.pupilCenterXMm.value, self.pupilCenterYMm.value,
+                            self.pupilDiameterXMm.value, self.pupilDiameterYMm.value)
+
+    def storage_crop(self):
+        # Only the spot grid of the current camera resolution holds data, the rest of the 80x80 arrays is padding
+        if not (self.spotsX.value and self.spotsY.value):
+            return FULL_CROP
+        geometry = self.spot_geometry()
+        if self.cropToPupil:
+            return pupil_crop(geometry)
+        return spot_grid_crop(geometry)
+
+    def reconstruct_wavefront(self,buffers):
+        # Zonal wavefront of a measured-wavefront exposure, and its statistics, from the spot deviations
+        exposure = self.exposurePlan[buffers.index]
+        if exposure.wavefrontType != 0 or not exposure.outputs & (OUTPUTS['wavefront'] | OUTPUTS['statistics']):
+            return buffers
+        start = perf_counter()
+        wavefront = self.zonalReconstructor.reconstruct(np.moveaxis(buffers.deviations, 0, -1), self.zonalGeometry)
+        buffers.wavefront[...] = wavefront
+        if exposure.outputs & OUTPUTS['statistics']:
+            inPupil = np.isfinite(wavefront)
+            values = wavefront[inPupil].astype(np.float64)
+            weights = np.nan_to_num(buffers.intensity[inPupil].astype(np.float64))
+            record = buffers.record
+            if len(values):
+                record['Wavefront Min'] = values.min()
+                record['Wavefront Max'] = values.max()
+                record['Wavefront Peak-Valley'] = values.max() - values.min()
+                record['Wavefront Mean'] = values.mean()
+                record['Wavefront RMS'] = values.std()
+                # Weighted by the spot intensities, like the SDK
+                if weights.sum() > 0:
+                    weightedMean = np.average(values, weights=weights)
+                    record['Wavefront Weighted RMS'] = np.sqrt(np.average((values - weightedMean)**2, weights=weights))
+                else:
+                    record['Wavefront Weighted RMS'] = np.nan
+            else:
+                buffers.clear(OUTPUT_KEYS['statistics'])
+        self.stageTimer.record(buffers.index, 'Zonal Wavefront', perf_counter() - start)
+        return buffers
+
+    def processing_done(self,buffers,now):
+        # Time from the end of capture until saving: waiting in the queue plus the processors
+        record = buffers.record
+        record['Processing Duration'] = now - record['Host Time'] - record['Capture Duration']
+
+    def store_measurement(self,buffers):
+        start = perf_counter()
+        self.processing_done(buffers, start)
+        self.dataList.append(buffers)
+        self.shotWriter.append(buffers)
+        self.frameCount += 1
+        self.stageTimer.record(buffers.index, 'Save', perf_counter() - start)
+
+    def aggregate_measurement(self,buffers):
+        # Fold the measurement into the reductions and free its slot; completed bins are saved as rows
+        start = perf_counter()
+        self.processing_done(buffers, start)
+        binned = self.aggregator.add(buffers)
+        if binned is not None:
+            self.shotWriter.append(binned)
+        self.bufferPool.release(buffers)
+        self.frameCount += 1
+        self.stageTimer.record(buffers.index, 'Save', perf_counter() - start)
     
     def abort_transition_to_buffered(self):
         return self.transition_to_manual(True)
@@ -496,47 +931,148 @@ class ThorlabsWaveFrontSensorWorker(Worker):
 
         if not (self.h5_filepath is None):
             try:
-                self.thread.join(timeout=1)
-                if self.thread.is_alive():
-                    global kill_loop
-                    kill_loop = True
-                    if len(self.dataList) == 0:
-                        msg = "WFS did not acquire data. Check triggering is connected/configured correctly"
-                        self.shutdown()
-                        print(msg)
-                        return 0
-                    else:
-                        print('Total '+str(len(self.dataList)) + ' data shots saved.')
-            except:
-                pass
+                return self.finish_shot()
+            finally:
+                self.h5_filepath = None
 
+        return True
+
+    def finish_shot(self):
+        # The end of shot part of transition_to_manual; the caller resets h5_filepath even if this raises
+        timer = self.stageTimer
+        start = perf_counter()
+        # The capture loop returns as soon as its trigger wait sees stopEvent
+        self.stopEvent.set()
+        self.thread.join(timeout=STOP_TIMEOUT)
+        if self.thread.is_alive():
+            print('Capture thread still running ' + str(STOP_TIMEOUT) + ' s after the end of the shot')
+        timer.end_of_shot('Stop Capture', perf_counter() - start)
+
+        # Only what is still queued is written here; everything else was appended during the shot.
+        # A failed processor or sink is reported, and raised once the frames that made it are saved
+        start = perf_counter()
+        error = None
+        try:
+            self.processingStage.close()
+        except Exception as e:
+            print('error processing measurements: ' + str(e))
+            error = e
+        try:
+            if self.aggregator is not None and self.aggregator.binFrames:
+                binned = self.aggregator.flush()
+                if binned is not None:
+                    self.shotWriter.append(binned)
+            timer.end_of_shot('Drain Pipeline', perf_counter() - start)
+            start = perf_counter()
+            self.shotWriter.close()
+            timer.end_of_shot('Close Writer', perf_counter() - start)
+        finally:
+            # Also stops the spotfield writer thread if the shot writer failed
+            start = perf_counter()
+            enabled = self.spotfieldRecorder.enabled
+            self.close_spotfield()
+            if enabled:
+                timer.end_of_shot('Close Spotfield', perf_counter() - start)
+
+        if self.frameCount == 0:
+            if error is not None:
+                raise error
+            print("WFS did not acquire data. Check triggering is connected/configured correctly")
+            self.shutdown()
+            return 0
+        print('Total '+str(self.frameCount) + ' data shots saved.')
+
+        if self.aggregator is not None:
+            start = perf_counter()
+            import h5py
             with h5py.File(self.h5_filepath, 'r+') as f:
-                # Use orientation for image path, device_name if orientation unspecified
-                if self.orientation is not None:
-                    image_path = 'images/' + self.orientation
-                else:
-                    image_path = 'images/' + self.device_name
-                image_group = f.require_group(image_path)
-                image_group.attrs['Wavefront Sensor'] = self.device_name
-                image_group.attrs['Resolution Index'] = self.camResolIndex.value
-                image_group.attrs['Pupil Center X'] = self.pupilCenterXMm.value
-                image_group.attrs['Pupil Center Y'] = self.pupilCenterYMm.value
-                image_group.attrs['Pupil Diameter X'] = self.pupilDiameterXMm.value
-                image_group.attrs['Pupil Diameter Y'] = self.pupilDiameterYMm.value
-                image_group.attrs['Limited to Pupil?'] = self.limitToPupil.value
-                image_group.attrs['Highest Zernike Order'] = self.zernikeOrder.value
-                image_group.attrs['Fourier Order'] = self.fourierOrder.value
-
-                for i in range(len(self.dataList[0])):
-                    group = image_group.require_group(list(self.dataList[0].items())[i][0])
-                    datalistset = []
-                    for j in range(len(self.dataList)):
-                        datalistset.append(list(self.dataList[j].items())[i][1])
-                    group.create_dataset(list(self.dataList[0].items())[i][0], data=datalistset, compression='gzip')
-
-            self.h5_filepath = None
+                self.aggregator.save(f[self.shotWriter.groupPath])
+            timer.end_of_shot('Save Aggregate', perf_counter() - start)
+            print('Aggregated ' + str(self.aggregator.frames) + ' frames')
+
+        if self.referenceTracker is not None:
+            self.save_reference()
 
+        # Aggregated shots keep no per-frame rows for the run store
+        if self.runStorePath is not None and self.aggregator is None:
+            start = perf_counter()
+            self.append_to_run_store()
+            timer.end_of_shot('Run Store', perf_counter() - start)
+
+        start = perf_counter()
+        self.save_frame_exposures()
+        timer.end_of_shot('Frame Exposures', perf_counter() - start)
+
+        if timer.enabled:
+            self.save_stage_timings()
+        if error is not None:
+            raise error
         return True
 
+    def close_spotfield(self):
+        # Write out the queued images; the next shot starts a new recorder if it wants one
+        recorder, self.spotfieldRecorder = self.spotfieldRecorder, NullSpotfieldRecorder()
+        count = recorder.close()
+        if recorder.enabled:
+            print('Saved ' + str(count) + ' spotfield images')
+
+    def save_frame_exposures(self):
+        # Which exposure every frame belongs to, with the dropped and late ones; see frame_timing.py
+        table, summary = reconcile(self.exposureTimes, *self.frameLog.times())
+        import h5py
+        with h5py.File(self.h5_filepath, 'r+') as f:
+            group = f[self.shotWriter.groupPath].require_group(FRAME_EXPOSURES_KEY)
+            if FRAME_EXPOSURES_KEY in group:
+                del group[FRAME_EXPOSURES_KEY]
+            dataset = group.create_dataset(FRAME_EXPOSURES_KEY, data=table)
+            dataset.attrs.update(summary)
+        if summary['Exposures']:
+            print('%d frames for %d exposures: %d dropped, %d late, %d unmatched; max safe trigger rate %.1f Hz' % (
+                summary['Frames'], summary['Exposures'], summary['Dropped'], summary['Late'],
+                summary['Unmatched Frames'], summary['Max Safe Trigger Rate']))
+
+    def save_stage_timings(self):
+        # Table of per-frame stage durations next to the measurements, and a p50/p99 summary
+        timer = self.stageTimer
+        timer.truncate(self.frameCount)
+        import h5py
+        with h5py.File(self.h5_filepath, 'r+') as f:
+            group = f[self.shotWriter.groupPath].require_group(TIMING_KEY)
+            if TIMING_KEY in group:
+                del group[TIMING_KEY]
+            dataset = group.create_dataset(TIMING_KEY, data=timer.table())
+            dataset.attrs['Units'] = 's'
+            for step, seconds in timer.endOfShot.items():
+                dataset.attrs['End of Shot ' + step] = seconds
+        for line in timer.summary():
+            print(line)
+
+    def save_reference(self):
+        # The reference, kept for later shots, and the running statistics of this shot's differences
+        tracker = self.referenceTracker
+        if tracker.reference is not None:
+            self.reference = tracker.reference
+        import h5py
+        with h5py.File(self.h5_filepath, 'r+') as f:
+            tracker.save(f[self.shotWriter.groupPath])
+        print('Reference subtracted from ' + str(tracker.subtracted) + ' frames')
+        self.referenceTracker = None
+
+    def append_to_run_store(self):
+        # One row per measurement in the run-level store, see run_store.py
+        from labscript_devices.ThorlabsWaveFrontSensor.run_store import RunStoreWriter
+        records = self.bufferPool.records()[[buffers.index for buffers in self.dataList]]
+        scalars = np.stack([records[key] for key in SCALAR_KEYS], axis=-1)
+        zernikes = [buffers.zernikesStored for buffers in self.dataList]
+        try:
+            RunStoreWriter(self.runStorePath, SCALAR_KEYS, self.device_name).append_shot(
+                os.path.basename(self.h5_filepath), records['Timestamp'], scalars, zernikes)
+        except Exception as e:
+            print('error appending to run store ' + self.runStorePath + ': ' + str(e))
+
     def shutdown(self):
+        self.stop_monitor()
         self.wfs.WFS_close(self.instrumentHandle)
+        self.feedbackPublisher.close()
+        self.feedbackPublisher = NullPublisher()
+        self.settingsCache.invalidate()
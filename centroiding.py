@@ -0,0 +1,177 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/ThorlabsWaveFrontSensor/centroiding.py         #
+#                                                                   #
+# This file is part of labscript_devices                            #
+#                                                                   #
+#####################################################################
+"""NumPy spot centroiding of raw spotfield images.
+
+Does what WFS_CalcSpotsCentrDiaIntens and WFS_GetSpotDeviations do inside
+the SDK, on images saved with spotfieldImages (see spotfield.py), for any
+number of frames at once. The image is cut into one square cell per
+lenslet, the whole pixels of the lenslet pitch around the lenslet centre.
+Lenslet centres are on a regular grid of lensletPitchUm centred on the
+image, like zernike.lenslet_coordinates, shifted by the MLA spot offsets
+(sensor pixels) from WFS_GetMlaData.
+
+In every cell a noise level is subtracted and pixels below it are
+ignored. With dynamicNoiseCut the level is estimated from the cell itself,
+as its mean plus NOISE_SIGMAS standard deviations, which keeps the spot and
+little of the noise around it; otherwise it is the fixed noiseCut in
+counts. A cell holds a spot if its peak is at least minPeak counts above
+the level. The spot deviation is the centroid of what is left, in pixels
+from the lenslet centre; the intensity is its sum and the diameter 4
+standard deviations (D4 sigma) in pixels, along x and y. Cells without a
+spot are NaN.
+
+The gather indices and the pixel offsets of the cells depend only on the
+camera resolution and the stored window, so they are computed once per
+camResolIndex and window and cached.
+"""
+from collections import OrderedDict, namedtuple
+import numpy as np
+
+from labscript_devices.ThorlabsWaveFrontSensor.spotfield import pixel_pitch
+
+MIN_PEAK = 16 # counts above the noise level
+NOISE_SIGMAS = 2.
+# Pixels centroided at a time: the whole stack of a chunk is worked on in a few passes, which are
+# fastest while it stays in the CPU caches, so large frames go one by one and small ones in batches
+CHUNK_PIXELS = 1 << 20
+
+# Results for frames x spotsY x spotsX lenslets, float32
+Centroids = namedtuple('Centroids', ['deviationX', 'deviationY', 'intensity', 'diameterX', 'diameterY'])
+
+
+class CellGrid(object):
+    """Gather indices and pixel offsets of the lenslet cells of one resolution and window.
+
+    shape is the (rows, columns) of the full image and window the
+    (row, column, rows, columns) of the stored part of it. Only lenslets
+    whose cell lies entirely inside the window are centroided (rows and
+    columns of the spot grid, as slices)."""
+    def __init__(self, shape, spotsX, spotsY, pixelPitchUm, lensletPitchUm, offsetX=0., offsetY=0.,
+                 window=None):
+        rows, columns = shape
+        windowRow, windowColumn, windowRows, windowColumns = window or (0, 0, rows, columns)
+        pitch = lensletPitchUm / pixelPitchUm
+        self.size = int(pitch) # Cells of whole pixels that do not overlap
+        # Lenslet centres in image pixels, where pixel k spans k to k+1
+        centerX = columns/2. + (np.arange(spotsX) - (spotsX-1)/2.) * pitch + offsetX
+        centerY = rows/2. + (np.arange(spotsY) - (spotsY-1)/2.) * pitch + offsetY
+        startX = np.round(centerX - self.size/2.).astype(int) - windowColumn
+        startY = np.round(centerY - self.size/2.).astype(int) - windowRow
+        insideX = np.flatnonzero((startX >= 0) & (startX + self.size <= windowColumns))
+        insideY = np.flatnonzero((startY >= 0) & (startY + self.size <= windowRows))
+        self.spotsX, self.spotsY = spotsX, spotsY
+        self.columns = slice(insideX[0], insideX[-1] + 1) if len(insideX) else slice(0, 0)
+        self.rows = slice(insideY[0], insideY[-1] + 1) if len(insideY) else slice(0, 0)
+        pixels = np.arange(self.size)
+        startX, startY = startX[self.columns], startY[self.rows]
+        centerX, centerY = centerX[self.columns] - windowColumn, centerY[self.rows] - windowRow
+        self.columnIndex = (startX[:, None] + pixels).ravel()
+        self.rowIndex = (startY[:, None] + pixels).ravel()
+        # Offsets of the pixel centres from the lenslet centre, (lenslets, size)
+        self.dx = (startX[:, None] + pixels + 0.5 - centerX[:, None]).astype(np.float32)
+        self.dy = (startY[:, None] + pixels + 0.5 - centerY[:, None]).astype(np.float32)
+
+    def cells(self, frames):
+        """(frames, spot rows, size, spot columns, size) uint8 stack of the cells of a uint8 stack."""
+        cells = np.take(np.take(frames, self.rowIndex, axis=1), self.columnIndex, axis=2)
+        return cells.reshape(len(frames), len(self.dy), self.size, len(self.dx), self.size)
+
+
+class CentroidEngine(object):
+    """Centroids of every lenslet of whole stacks of spotfield frames.
+
+    camPitchUm, lensletPitchUm and the spot offsets are the MLA data from
+    WFS_GetMlaData; dynamicNoiseCut, noiseCut and minPeak set the noise
+    level and spot detection described in the module docstring. CellGrids
+    are kept for up to maxCached resolutions and windows, least recently
+    used first out.
+    """
+    def __init__(self, camPitchUm, lensletPitchUm, spotOffsetX=0., spotOffsetY=0., dynamicNoiseCut=True,
+                 noiseCut=0., minPeak=MIN_PEAK, maxCached=8):
+        self.camPitchUm = camPitchUm
+        self.lensletPitchUm = lensletPitchUm
+        self.spotOffsetX = spotOffsetX
+        self.spotOffsetY = spotOffsetY
+        self.dynamicNoiseCut = bool(dynamicNoiseCut)
+        self.noiseCut = noiseCut
+        self.minPeak = minPeak
+        self.maxCached = maxCached
+        self.cache = OrderedDict()
+
+    def grid(self, camResolIndex, shape, spotsX, spotsY, window=None):
+        """CellGrid of the image shape (rows, columns) of camResolIndex and the stored window."""
+        key = (camResolIndex, tuple(shape), spotsX, spotsY, None if window is None else tuple(window))
+        if key in self.cache:
+            self.cache.move_to_end(key)
+        else:
+            pixelPitchUm = pixel_pitch(self.camPitchUm, self.lensletPitchUm, spotsX, shape[1])
+            binning = pixelPitchUm / self.camPitchUm
+            self.cache[key] = CellGrid(shape, spotsX, spotsY, pixelPitchUm, self.lensletPitchUm,
+                                       self.spotOffsetX / binning, self.spotOffsetY / binning, window)
+            while len(self.cache) > self.maxCached:
+                self.cache.popitem(last=False)
+        return self.cache[key]
+
+    def centroid(self, frames, camResolIndex, spotsX, spotsY, shape=None, corner=(0, 0)):
+        """Centroids of a (rows, columns) frame or a (frames, rows, columns) stack of uint8 images.
+
+        shape is the size of the full image if the frames are a window of it
+        with its top left corner at corner; results are (spotsY, spotsX),
+        with a frames axis first for a stack."""
+        frames = np.asarray(frames)
+        single = frames.ndim == 2
+        if single:
+            frames = frames[None]
+        shape = frames.shape[1:] if shape is None else tuple(shape)
+        window = None if frames.shape[1:] == shape else tuple(corner) + frames.shape[1:]
+        grid = self.grid(camResolIndex, shape, spotsX, spotsY, window)
+        results = Centroids(*[np.full((len(frames), spotsY, spotsX), np.nan, dtype=np.float32)
+                              for _ in Centroids._fields])
+        chunkFrames = max(1, CHUNK_PIXELS // (len(grid.rowIndex) * len(grid.columnIndex) or 1))
+        for start in range(0, len(frames), chunkFrames):
+            chunk = self._centroid_cells(grid, grid.cells(frames[start:start+chunkFrames]))
+            for out, values in zip(results, chunk):
+                out[start:start+len(values), grid.rows, grid.columns] = values
+        if single:
+            return Centroids(*[values[0] for values in results])
+        return results
+
+    def _centroid_cells(self, grid, cells):
+        # Reductions over the cell rows (axis 2) run along whole image rows and are much faster in NumPy
+        # than those over the short cell columns (axis 4), so those are matrix products or on smaller arrays
+        peak = cells.max(axis=2).max(axis=-1).astype(np.float32)
+        if self.dynamicNoiseCut:
+            values = cells.astype(np.float32)
+            pixels = grid.size**2
+            mean = values.sum(axis=2).sum(axis=-1) / pixels
+            meanSquare = np.einsum('fyaxb,fyaxb->fyx', values, values) / pixels
+            level = mean + NOISE_SIGMAS*np.sqrt(np.maximum(meanSquare - mean**2, 0))
+            values -= level[:, :, None, :, None]
+        else:
+            level = np.full(peak.shape, self.noiseCut, dtype=np.float32)
+            values = np.subtract(cells, np.float32(self.noiseCut), dtype=np.float32)
+        np.maximum(values, 0, out=values)
+        # Moments along x only need the column sums of each cell, along y the row sums
+        columnSums = values.sum(axis=2) # (frames, spot rows, spot columns, size)
+        rowSums = values @ np.ones(grid.size, dtype=np.float32) # (frames, spot rows, size, spot columns)
+        intensity = columnSums.sum(axis=-1)
+        found = (peak - level >= self.minPeak) & (intensity > 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            x = (columnSums * grid.dx).sum(axis=-1) / intensity
+            y = np.einsum('fyax,ya->fyx', rowSums, grid.dy) / intensity
+            xx = (columnSums * grid.dx**2).sum(axis=-1) / intensity
+            yy = np.einsum('fyax,ya->fyx', rowSums, grid.dy**2) / intensity
+            diameterX = 4*np.sqrt(np.maximum(xx - x**2, 0))
+            diameterY = 4*np.sqrt(np.maximum(yy - y**2, 0))
+        values = Centroids(x, y, intensity, diameterX, diameterY)
+        return Centroids(*[np.where(found, value, np.nan) for value in values])
+
+
+def deviations(centroids):
+    """(..., spotsY, spotsX, 2) spot deviations, x then y, as WFS_GetSpotDeviations and the stored datasets."""
+    return np.stack([centroids.deviationX, centroids.deviationY], axis=-1)
@@ -0,0 +1,190 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/ThorlabsWaveFrontSensor/device_manager.py      #
+#                                                                   #
+# This file is part of labscript_devices                            #
+#                                                                   #
+#####################################################################
+"""Instrument list shared by all wavefront sensors of a setup.
+
+Every sensor is its own device in the connection table, with its own worker
+process, so the acquisition loops of several heads run concurrently without
+sharing a GIL, and each one writes to the image group of its orientation.
+What they do share is the scan of the connected instruments: the first
+worker to start enumerates them with WFS_GetInstrumentListLen/Info and
+caches the list, in the process and in a file read by the other workers,
+for maxAge seconds. A serial number that is not in the cached list causes
+one rescan, so newly plugged in sensors are still found. Workers starting
+together wait for the first one's scan rather than each scanning.
+
+DeviceProfile keeps what init() learned about one sensor, its resource name
+and MLA data, in a file under PROFILE_DIR that outlives the process and the
+machine's temporary files. The next init() opens the cached resource
+straight away and only scans the instrument list if that fails.
+"""
+import json
+import os
+import tempfile
+import threading
+from time import time, sleep
+import ctypes as ct
+
+CACHE_MAX_AGE = 60. # seconds
+LOCK_TIMEOUT = 10. # seconds after which the scan lock of a worker is assumed abandoned
+PROFILE_DIR = os.path.join(os.path.expanduser('~'), '.ThorlabsWaveFrontSensor')
+
+# Instrument lists of this process by backend: (scan time, list)
+_instruments = {}
+# Workers that are threads of one process scan one at a time; the lock file does it between processes
+_scanLock = threading.Lock()
+
+
+def cache_path(backend):
+    return os.path.join(tempfile.gettempdir(), 'ThorlabsWaveFrontSensor_instruments_%s.json' % backend)
+
+
+class InstrumentList(object):
+    """Enumerates the sensors connected to the wfs function table once for all workers.
+
+    Entries are dicts with 'deviceID', 'inUse', 'name', 'serial' and
+    'resourceName'. scans counts the enumerations done by this object.
+    """
+    def __init__(self, wfs, backend, maxAge=CACHE_MAX_AGE):
+        self.wfs = wfs
+        self.backend = backend
+        self.maxAge = maxAge
+        self.path = cache_path(backend)
+        self.scans = 0
+
+    def scan(self):
+        count = ct.c_int32()
+        deviceID = ct.c_int32()
+        inUse = ct.c_int32()
+        instrumentName = ct.create_string_buffer(20)
+        instrumentSN = ct.create_string_buffer(20)
+        resourceName = ct.create_string_buffer(30)
+        self.wfs.WFS_GetInstrumentListLen(None, ct.byref(count))
+        instruments = []
+        for i in range(count.value):
+            devStatus = self.wfs.WFS_GetInstrumentListInfo(None, ct.c_int32(i), ct.byref(deviceID), ct.byref(inUse),
+                                                           instrumentName, instrumentSN, resourceName)
+            if devStatus != 0:
+                continue
+            instruments.append({
+                'deviceID': deviceID.value,
+                'inUse': inUse.value,
+                'name': instrumentName.value.decode(),
+                'serial': instrumentSN.value.decode(),
+                'resourceName': resourceName.value.decode(),
+            })
+        self.scans += 1
+        _instruments[self.backend] = (time(), instruments)
+        try:
+            temporary = '%s.%d' % (self.path, os.getpid())
+            with open(temporary, 'w') as f:
+                json.dump(instruments, f)
+            os.replace(temporary, self.path)
+        except OSError as e:
+            print('Could not cache the instrument list: ' + str(e))
+        return instruments
+
+    def cached(self):
+        """Instrument list scanned less than maxAge seconds ago, by this process or another; None if there is none."""
+        if self.backend in _instruments:
+            scanned, instruments = _instruments[self.backend]
+            if time() - scanned < self.maxAge:
+                return instruments
+        try:
+            scanned = os.path.getmtime(self.path)
+            if time() - scanned < self.maxAge:
+                with open(self.path) as f:
+                    instruments = json.load(f)
+                _instruments[self.backend] = (scanned, instruments)
+                return instruments
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def _scan_once(self):
+        """Scan, unless another worker is already scanning, in which case use its list."""
+        start = time()
+        with _scanLock:
+            lockPath = self.path + '.lock'
+            while True:
+                try:
+                    os.close(os.open(lockPath, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                    break
+                except FileExistsError:
+                    try:
+                        stale = time() - os.path.getmtime(lockPath) > LOCK_TIMEOUT
+                    except OSError:
+                        continue
+                    if stale:
+                        # Left by a worker that died while scanning
+                        try:
+                            os.remove(lockPath)
+                        except OSError:
+                            pass
+                    sleep(0.01)
+            try:
+                instruments = self.cached()
+                if instruments is not None and _instruments[self.backend][0] >= start:
+                    # Scanned by another worker while we waited
+                    return instruments
+                return self.scan()
+            finally:
+                os.remove(lockPath)
+
+    def find(self, serialNum):
+        """Entry of the sensor with the given serial number, or None if it is not connected."""
+        instruments = self.cached()
+        for attempt in range(2):
+            if instruments is None:
+                instruments = self._scan_once()
+            for instrument in instruments:
+                if instrument['serial'] == serialNum:
+                    return instrument
+            if self.scans:
+                break
+            instruments = None # Not in a list scanned elsewhere; it may have been plugged in since
+        return None
+
+    def invalidate(self):
+        _instruments.pop(self.backend, None)
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class DeviceProfile(object):
+    """Resource name and MLA data of the sensor serialNum, saved by init() for the next start.
+
+    load() returns the saved dict, or None if there is none or it cannot be
+    read; save(profile) replaces it. The file is JSON, one per backend and
+    serial number, in directory (PROFILE_DIR by default)."""
+    def __init__(self, backend, serialNum, directory=None):
+        self.path = os.path.join(directory or PROFILE_DIR, '%s_%s.json' % (backend, serialNum))
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, profile):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temporary = '%s.%d' % (self.path, os.getpid())
+            with open(temporary, 'w') as f:
+                json.dump(profile, f, indent=1)
+            os.replace(temporary, self.path)
+        except OSError as e:
+            print('Could not save the device profile: ' + str(e))
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
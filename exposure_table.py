@@ -0,0 +1,154 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/ThorlabsWaveFrontSensor/exposure_table.py      #
+#                                                                   #
+# This file is part of labscript_devices                            #
+#                                                                   #
+#####################################################################
+"""Per-exposure acquisition parameters, compiled by generate_code and applied by the worker.
+
+Each call of ThorlabsWaveFrontSensor.expose() becomes one row of the
+EXPOSURES table in the device group of the shot file, in time order, so row
+i applies to the i-th trigger of the shot. A NaN exposure time means auto
+exposure, a NaN gain keeps the current gain, and -1 for wavefront type or
+Zernike order means the front panel value. Outputs is a bitmask of OUTPUTS
+saying which results to calculate; the rest of the calculation chain is
+skipped for that exposure. -1 means the compute profile of the shot.
+
+A compute profile is the set of outputs calculated by default: one of the
+named PROFILES or a list of OUTPUTS names. It is chosen with computeProfile
+in the connection table, and can be overridden for a shot with
+ThorlabsWaveFrontSensor.set_compute_profile(), which is saved as the
+COMPUTE_PROFILE_ATTR attribute (a bitmask) of the device group.
+"""
+from collections import namedtuple
+import numpy as np
+
+# Name of the table and of the compute profile attribute in the device group
+EXPOSURES_KEY = 'EXPOSURES'
+COMPUTE_PROFILE_ATTR = 'Compute Profile'
+
+# Results that can be calculated per exposure. Spot deviations and intensities are always read out.
+OUTPUTS = {
+    'centroid': 0x01,   # WFS_CalcBeamCentroidDia
+    'wavefront': 0x02,  # WFS_CalcWavefront
+    'statistics': 0x04, # WFS_CalcWavefrontStatistics
+    'zernikes': 0x08,   # WFS_ZernikeLsf
+    'optometric': 0x10, # WFS_CalcFourierOptometric
+    'fit_error': 0x20,  # WFS_CalcReconstrDeviations
+}
+ALL_OUTPUTS = sum(OUTPUTS.values())
+# Named compute profiles
+PROFILES = {
+    'centroid_only': ('centroid',),
+    'zernike': ('centroid', 'zernikes'), # Tilt and low order terms for feedback, without the wavefront
+    'full': tuple(OUTPUTS),
+}
+# Record fields and datasets holding each output, set to NaN when it is not calculated
+OUTPUT_KEYS = {
+    'centroid': ('Beam Center X', 'Beam Center Y', 'Beam Diameter X', 'Beam Diameter Y'),
+    'wavefront': ('Wavefront',),
+    'statistics': ('Wavefront Min', 'Wavefront Max', 'Wavefront Peak-Valley', 'Wavefront Mean',
+                   'Wavefront RMS', 'Wavefront Weighted RMS'),
+    'zernikes': ('Zernikes Coefficients', 'Zernikes RMS', 'Radius of Curvature'),
+    'optometric': ('Fourier M', 'Fourier J0', 'Fourier J45',
+                   'Optometric Sphere', 'Optometric Cylinder', 'Optometric Axis Angle'),
+    'fit_error': ('Fit Error Mean', 'Fit Error Std'),
+}
+
+EXPOSURE_DTYPE = np.dtype([
+    ('t', np.float64),
+    ('Exposure Time', np.float64), # ms
+    ('Master Gain', np.float64),
+    ('Wavefront Type', np.int32),
+    ('Zernike Order', np.int32),
+    ('Outputs', np.int32),
+])
+
+# Settings of one trigger; outputs includes the calculations the requested ones depend on,
+# skipped lists the record fields and datasets left NaN
+Exposure = namedtuple('Exposure', ['exposureTime', 'masterGain', 'wavefrontType', 'zernikeOrder', 'outputs', 'skipped'])
+
+
+def outputs_mask(outputs):
+    """Bitmask of a PROFILES name, an iterable of OUTPUTS names or an int bitmask; None means all outputs."""
+    if outputs is None:
+        return ALL_OUTPUTS
+    if isinstance(outputs, str):
+        if outputs not in PROFILES:
+            raise ValueError('Unknown compute profile %r, expected one of %s' % (outputs, ', '.join(PROFILES)))
+        outputs = PROFILES[outputs]
+    if isinstance(outputs, (int, np.integer)):
+        if outputs & ~ALL_OUTPUTS:
+            raise ValueError('Unknown output bits in %#x' % outputs)
+        return int(outputs)
+    mask = 0
+    for name in outputs:
+        if name not in OUTPUTS:
+            raise ValueError('Unknown output %r, expected some of %s' % (name, ', '.join(OUTPUTS)))
+        mask |= OUTPUTS[name]
+    return mask
+
+def output_names(outputs):
+    """OUTPUTS names in the bitmask outputs."""
+    return [name for name, bit in OUTPUTS.items() if outputs & bit]
+
+def skipped_keys(outputs):
+    """Record fields and datasets of the outputs not in the bitmask outputs."""
+    return tuple(key for name, bit in OUTPUTS.items() if not outputs & bit for key in OUTPUT_KEYS[name])
+
+def required_outputs(outputs, wavefrontType=0):
+    """outputs plus the calculations they depend on.
+
+    Wavefront statistics need the wavefront, optometric values and the fit error
+    need the Zernike fit, and the reconstructed wavefront types (1 and 2) need
+    the reconstructed deviations."""
+    if outputs & OUTPUTS['statistics']:
+        outputs |= OUTPUTS['wavefront']
+    if outputs & OUTPUTS['wavefront'] and wavefrontType != 0:
+        outputs |= OUTPUTS['fit_error']
+    if outputs & (OUTPUTS['optometric'] | OUTPUTS['fit_error']):
+        outputs |= OUTPUTS['zernikes']
+    return outputs
+
+
+def make_exposure(exposureTime=np.nan, masterGain=np.nan, wavefrontType=0, zernikeOrder=4, outputs=ALL_OUTPUTS):
+    outputs = required_outputs(int(outputs), int(wavefrontType))
+    return Exposure(float(exposureTime), float(masterGain), int(wavefrontType), int(zernikeOrder),
+                    outputs, skipped_keys(outputs))
+
+
+class ExposurePlan(object):
+    """Settings of every trigger of a shot: the rows of an EXPOSURES table, with
+    -1 entries and triggers beyond the end of the table taking the front panel
+    default, an Exposure."""
+    def __init__(self, default, table=None):
+        self.default = default
+        self.exposures = []
+        for row in (table if table is not None else []):
+            self.exposures.append(make_exposure(
+                row['Exposure Time'], row['Master Gain'],
+                row['Wavefront Type'] if row['Wavefront Type'] >= 0 else default.wavefrontType,
+                row['Zernike Order'] if row['Zernike Order'] >= 0 else default.zernikeOrder,
+                row['Outputs'] if row['Outputs'] >= 0 else default.outputs))
+
+    def __len__(self):
+        return len(self.exposures)
+
+    def __getitem__(self, trigger):
+        return self.exposures[trigger] if trigger < len(self.exposures) else self.default
+
+    def max_zernike_order(self):
+        """Highest Zernike order fitted in the shot, which sets the stored coefficient count."""
+        return max([self.default.zernikeOrder] + [exposure.zernikeOrder for exposure in self.exposures])
+
+    def outputs(self):
+        """Bitmask of every output calculated for some trigger of the shot."""
+        outputs = self.default.outputs
+        for exposure in self.exposures:
+            outputs |= exposure.outputs
+        return outputs
+
+    def never_calculated(self):
+        """Record fields and datasets skipped for every trigger, which the shot file can leave out."""
+        return skipped_keys(self.outputs())
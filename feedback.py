@@ -0,0 +1,277 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/ThorlabsWaveFrontSensor/feedback.py            #
+#                                                                   #
+# This file is part of labscript_devices                            #
+#                                                                   #
+#####################################################################
+"""Live publication of every frame's results for closed-loop control.
+
+The capture thread publishes one FEEDBACK_DTYPE message per frame as soon
+as the Zernike fit has returned (or, for exposures without a fit, as soon as
+the spot deviations are read out), long before the frame reaches the shot
+file. Every message carries a Sequence number counting up from 1 across
+shots, the Frame number within the shot, the unix Timestamp of the trigger
+and the perf_counter() Publish Time, which is comparable between processes
+on the same machine. Results not calculated for the frame are NaN.
+
+Two transports are available, chosen by the feedbackAddress connection
+table property:
+
+    'tcp://*:5560' (any ZeroMQ endpoint)  ZeroMQ PUB socket, one message per frame
+    'wfs_feedback' (any other string)     ring of FEEDBACK_SLOTS messages in shared memory of that name
+
+The shared memory ring is zero-copy for the reader and has no dependency
+beyond the standard library; ZeroMQ (pyzmq) reaches other machines. Read
+either with FeedbackSubscriber(address).
+"""
+import sys
+from multiprocessing import parent_process
+from time import perf_counter, sleep
+import numpy as np
+
+from labscript_devices.ThorlabsWaveFrontSensor.shot_buffers import MAX_ZERNIKE_MODES, RECORD_DTYPE
+
+ZMQ_SCHEMES = ('tcp://', 'ipc://', 'inproc://', 'pgm://', 'epgm://')
+FEEDBACK_SLOTS = 256
+# Record fields available when the message is published
+FEEDBACK_SCALARS = (
+    'Timestamp',
+    'Exposure Time',
+    'Master Gain',
+    'Beam Center X',
+    'Beam Center Y',
+    'Beam Diameter X',
+    'Beam Diameter Y',
+    'Radius of Curvature',
+)
+FEEDBACK_DTYPE = np.dtype(
+    [('Sequence', np.uint64), ('Frame', np.int64), ('Publish Time', np.float64)]
+    + [(key, np.float64) for key in FEEDBACK_SCALARS]
+    + [('Zernike Order', np.int32), ('Zernikes', np.float32, (MAX_ZERNIKE_MODES,))] # Z1..Z66
+)
+RECORD_INDICES = np.array([RECORD_DTYPE.names.index(key) for key in FEEDBACK_SCALARS])
+# Shared memory published from this process
+_published = set()
+# The shared memory starts with the sequence number of the last complete message
+HEADER_BYTES = 64
+
+
+def is_zmq_address(address):
+    return address.startswith(ZMQ_SCHEMES)
+
+
+class FeedbackPublisher(object):
+    """Fills one message per frame from a ShotBuffers slot and sends it with _send().
+
+    Messages are written in place into the array messages, through views of
+    its fields made once, so publishing a frame costs a few array copies. By
+    itself it sends nothing and keeps only the latest message, in messages[0];
+    the subclasses override _index() and _send() to pass messages on."""
+    enabled = True
+
+    def __init__(self, messages):
+        self.sequence = 0
+        self.messages = messages
+        self.sequences = messages['Sequence']
+        self.frames = messages['Frame']
+        self.publishTimes = messages['Publish Time']
+        # The scalars are consecutive float64 fields, so they can be copied from the record in one go
+        first = FEEDBACK_DTYPE.fields[FEEDBACK_SCALARS[0]][1]
+        raw = messages.view(np.uint8).reshape(len(messages), FEEDBACK_DTYPE.itemsize)
+        self.scalars = raw[:, first:first + 8*len(FEEDBACK_SCALARS)].view(np.float64)
+        self.orders = messages['Zernike Order']
+        self.zernikes = messages['Zernikes']
+
+    def publish(self, buffers, zernikeOrder):
+        """Publish the frame in buffers; zernikeOrder is 0 if no Zernike fit was made."""
+        self.sequence += 1
+        i = self._index()
+        self.sequences[i] = 0 # Incomplete until the real sequence number is written last
+        self.frames[i] = buffers.index
+        self.scalars[i] = np.frombuffer(buffers.row, dtype=np.float64)[RECORD_INDICES]
+        self.orders[i] = zernikeOrder
+        self.zernikes[i] = buffers.zernikes[1:] if zernikeOrder else np.nan
+        self.publishTimes[i] = perf_counter()
+        self.sequences[i] = self.sequence
+        self._send(i)
+
+    def _index(self):
+        return 0
+
+    def _send(self, i):
+        pass
+
+    def close(self):
+        pass
+
+
+class SharedMemoryPublisher(FeedbackPublisher):
+    """Writes the messages into a ring in shared memory, then the sequence number into the header.
+
+    A message is written in place in its slot, with its Sequence field zero
+    until it is complete, so a reader can tell a finished message from one
+    being overwritten."""
+    def __init__(self, name, slots=FEEDBACK_SLOTS):
+        from multiprocessing import shared_memory
+        size = HEADER_BYTES + slots * FEEDBACK_DTYPE.itemsize
+        try:
+            self.memory = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            # Left behind by a worker that did not shut down cleanly
+            self.memory = shared_memory.SharedMemory(name)
+            if self.memory.size < size:
+                raise
+        _published.add(name)
+        self.header = np.ndarray(1, dtype=np.uint64, buffer=self.memory.buf)
+        self.header[0] = 0
+        ring = np.ndarray(slots, dtype=FEEDBACK_DTYPE, buffer=self.memory.buf, offset=HEADER_BYTES)
+        ring['Sequence'] = 0
+        FeedbackPublisher.__init__(self, ring)
+
+    def _index(self):
+        return self.sequence % len(self.messages)
+
+    def _send(self, i):
+        self.header[0] = self.sequence
+
+    def close(self):
+        del self.header, self.messages, self.sequences, self.frames, self.publishTimes
+        del self.scalars, self.orders, self.zernikes
+        self.memory.close()
+        self.memory.unlink()
+        _published.discard(self.memory.name)
+
+
+class ZMQPublisher(FeedbackPublisher):
+    """Sends every message as one frame on a ZeroMQ PUB socket bound to address."""
+    def __init__(self, address, highWaterMark=1000):
+        FeedbackPublisher.__init__(self, np.zeros(1, dtype=FEEDBACK_DTYPE))
+        import zmq
+        self.zmq = zmq
+        self.context = zmq.Context.instance()
+        self.socket = self.context.socket(zmq.PUB)
+        self.socket.setsockopt(zmq.SNDHWM, highWaterMark)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.bind(address)
+
+    def _send(self, i):
+        try:
+            self.socket.send(self.messages, self.zmq.NOBLOCK)
+        except self.zmq.Again:
+            pass # Slow subscribers lose messages rather than holding up acquisition
+
+    def close(self):
+        self.socket.close()
+
+
+class NullPublisher(object):
+    """FeedbackPublisher that publishes nothing."""
+    enabled = False
+
+    def publish(self, buffers, zernikeOrder):
+        pass
+
+    def close(self):
+        pass
+
+
+def make_publisher(address):
+    """Publisher for the feedbackAddress connection table property; NullPublisher if it is None."""
+    if address is None:
+        return NullPublisher()
+    if is_zmq_address(address):
+        return ZMQPublisher(address)
+    return SharedMemoryPublisher(address)
+
+
+class FeedbackSubscriber(object):
+    """Client for the messages of a worker publishing to address.
+
+    receive(timeout) returns the next message, a FEEDBACK_DTYPE record, or
+    None if none arrived within timeout seconds. latest() returns the most
+    recent message without waiting, or None, for control loops that only
+    care about the current state. dropped counts the messages receive()
+    missed: overwritten in shared memory, or lost by ZeroMQ, before they were
+    read. Subscribers start with the next message published.
+    """
+    def __init__(self, address, pollInterval=20e-6):
+        self.address = address
+        self.pollInterval = pollInterval
+        self.dropped = 0
+        self.last = 0
+        if is_zmq_address(address):
+            import zmq
+            self.zmq = zmq
+            self.socket = zmq.Context.instance().socket(zmq.SUB)
+            self.socket.setsockopt(zmq.SUBSCRIBE, b'')
+            self.socket.connect(address)
+            self.memory = None
+        else:
+            from multiprocessing import shared_memory
+            self.memory = shared_memory.SharedMemory(address)
+            if sys.platform != 'win32' and parent_process() is None and address not in _published:
+                # Only the publisher owns the memory; keep the resource tracker of this program from
+                # unlinking it when we exit. Processes started by multiprocessing share their parent's tracker.
+                from multiprocessing import resource_tracker
+                resource_tracker.unregister(self.memory._name, 'shared_memory')
+            self.header = np.ndarray(1, dtype=np.uint64, buffer=self.memory.buf)
+            slots = (self.memory.size - HEADER_BYTES) // FEEDBACK_DTYPE.itemsize
+            self.ring = np.ndarray(slots, dtype=FEEDBACK_DTYPE, buffer=self.memory.buf, offset=HEADER_BYTES)
+            self.last = int(self.header[0])
+
+    def _count(self, message):
+        if message is not None:
+            sequence = int(message['Sequence'])
+            if self.last and sequence > self.last + 1:
+                self.dropped += sequence - self.last - 1
+            self.last = sequence
+        return message
+
+    def _read(self, sequence):
+        """Copy of the ring message with the given sequence number, None if it was overwritten."""
+        slot = self.ring[sequence % len(self.ring)]
+        message = slot.copy()
+        if message['Sequence'] != sequence or slot['Sequence'] != sequence:
+            return None
+        return message
+
+    def receive(self, timeout=None):
+        if self.memory is None:
+            if not self.socket.poll(None if timeout is None else 1e3*timeout):
+                return None
+            return self._count(np.frombuffer(self.socket.recv(), dtype=FEEDBACK_DTYPE)[0])
+        start = perf_counter()
+        while True:
+            published = int(self.header[0])
+            if published > self.last:
+                # Skip what the publisher has lapped already
+                sequence = max(self.last + 1, published - len(self.ring) + 1)
+                message = self._read(sequence)
+                if message is not None:
+                    return self._count(message)
+                self.dropped += 1
+                self.last = sequence
+                continue
+            if timeout is not None and perf_counter() - start > timeout:
+                return None
+            sleep(self.pollInterval)
+
+    def latest(self):
+        message = None
+        if self.memory is None:
+            while self.socket.poll(0):
+                message = np.frombuffer(self.socket.recv(), dtype=FEEDBACK_DTYPE)[0]
+        elif self.header[0]:
+            message = self._read(int(self.header[0]))
+        if message is not None:
+            # Skipping to the latest message is deliberate, so nothing counts as dropped
+            self.last = int(message['Sequence'])
+        return message
+
+    def close(self):
+        if self.memory is None:
+            self.socket.close()
+        else:
+            del self.header, self.ring
+            self.memory.close()
@@ -0,0 +1,173 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/ThorlabsWaveFrontSensor/frame_timing.py        #
+#                                                                   #
+# This file is part of labscript_devices                            #
+#                                                                   #
+#####################################################################
+"""Which exposure every frame belongs to, and which exposures were dropped.
+
+The capture thread notes, for every frame, when it was ready for the
+trigger (the first WFS_TakeSpotfieldImage call), when the image arrived,
+both on the monotonic perf_counter() clock, and whether the image was held
+by the camera already, i.e. came with that first call. At the end of the
+shot these are matched with the expose() times of the EXPOSURES table.
+
+The first frame belongs to the first exposure, since the worker is armed
+before the sequence starts, but it may have arrived some time after it, so
+that only bounds the offset between the clocks. Going back from that bound
+by up to the smallest spacing of the exposures (at most MAX_ALIGNMENT), the
+offset is the one at which most frames the camera did not hold had an
+exposure while the worker was waiting for them. Once the frames are
+matched, the clocks are aligned on the frame with the smallest delay. The
+latency of that frame (exposure and readout) is not known, so a trigger up
+to that long before the worker was ready still counts as caught.
+
+A frame belongs to the first exposure after the previous frame's that was
+triggered between the worker being ready and the image arriving (within
+tolerance). Exposures skipped over were triggered while the camera was not
+armed, and are dropped. A held frame, or one with no exposure in that
+window, comes from a trigger the camera kept while the worker was busy, and
+belongs to the next exposure after the previous frame's instead. A frame
+with no exposure left that could have triggered it is unmatched.
+
+The delay of a frame is the time from its exposure to its arrival, minus
+the smallest delay of the shot; frames delayed by more than lateDelay are
+late. The busy time of an exposure is the time from its trigger until the
+worker was ready for the next one. No exposure is dropped as long as the
+exposures are further apart than that, so the largest busy time of a shot
+gives the highest safe trigger rate of its sequence.
+
+The result is one row per exposure and per unmatched frame, saved as the
+FRAME_EXPOSURES_KEY table of the image group, with the counts as its
+attributes.
+"""
+import numpy as np
+
+# Table of the image group mapping frames to exposures
+FRAME_EXPOSURES_KEY = 'Frame Exposures'
+FRAME_EXPOSURE_DTYPE = np.dtype([
+    ('Exposure', np.int32),  # row of the EXPOSURES table, -1 for an unmatched frame
+    ('t', np.float64),       # expose() time, s
+    ('Frame', np.int32),     # -1 if the exposure was dropped
+    ('Arrival', np.float64), # arrival of the frame on the time base of t, s
+    ('Delay', np.float64),   # arrival - t - the smallest delay of the shot, s
+    ('Busy', np.float64),    # from t until the worker was ready for the next frame, s
+    ('Dropped', np.bool_),
+    ('Late', np.bool_),
+])
+LATE_DELAY = 1e-3 # s
+TOLERANCE = 200e-6 # s, clock and trigger jitter allowed when matching
+MAX_ALIGNMENT = 0.1 # s, longest first frame latency searched for the clock offset
+
+
+class FrameLog(object):
+    """Ready and arrival times (perf_counter) of the frames of a shot, in the order they were taken, and
+    whether the camera held each frame already."""
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.ready = []
+        self.arrival = []
+        self.held = []
+
+    def append(self, ready, arrival, held=False):
+        self.ready.append(ready)
+        self.arrival.append(arrival)
+        self.held.append(held)
+
+    def __len__(self):
+        return len(self.arrival)
+
+    def times(self):
+        """ready, arrival and held arrays, the arguments of reconcile."""
+        return (np.array(self.ready, dtype=np.float64), np.array(self.arrival, dtype=np.float64),
+                np.array(self.held, dtype=bool))
+
+
+def _match(exposureTimes, ready, arrival, held, tolerance):
+    # Exposure of every frame, -1 if unmatched
+    exposures = len(exposureTimes)
+    exposureOf = np.full(len(arrival), -1)
+    last = -1
+    for frame in range(len(arrival)):
+        first = last + 1
+        # The first exposure the worker was ready for, if it came before the image, or the next one
+        start = first if held[frame] else first + np.searchsorted(exposureTimes[first:], ready[frame] - tolerance)
+        if start < exposures and exposureTimes[start] <= arrival[frame] + tolerance:
+            last = start
+        elif first < exposures and exposureTimes[first] <= arrival[frame] + tolerance:
+            last = first
+        else:
+            continue
+        exposureOf[frame] = last
+    return exposureOf
+
+
+def _align(exposureTimes, ready, arrival, held, tolerance):
+    # Offset of the perf_counter clock from the exposure times, see the module docstring
+    latest = arrival[0] - exposureTimes[0]
+    span = min(np.diff(exposureTimes).min() if len(exposureTimes) > 1 else 0., MAX_ALIGNMENT)
+    waited = ~held
+    best, bestCount = latest, -1
+    for offset in latest - np.arange(0., span, max(tolerance, span / 100.)):
+        first = np.searchsorted(exposureTimes, ready[waited] - offset - tolerance)
+        last = np.searchsorted(exposureTimes, arrival[waited] - offset + tolerance, side='right')
+        count = (last > first).sum()
+        if count > bestCount:
+            best, bestCount = offset, count
+    return best
+
+
+def reconcile(exposureTimes, ready, arrival, held=None, lateDelay=LATE_DELAY, tolerance=TOLERANCE):
+    """FRAME_EXPOSURE_DTYPE table and summary counts matching frames (ready and arrival times,
+    perf_counter, and whether the camera held them) with the sorted exposure times of a shot."""
+    exposureTimes = np.asarray(exposureTimes, dtype=np.float64)
+    ready, arrival = np.asarray(ready, dtype=np.float64), np.asarray(arrival, dtype=np.float64)
+    exposures, frames = len(exposureTimes), len(arrival)
+    held = np.zeros(frames, dtype=bool) if held is None else np.asarray(held, dtype=bool)
+    exposureOf, offset = np.full(frames, -1), 0.
+    if exposures and frames:
+        offset = _align(exposureTimes, ready, arrival, held, tolerance)
+        exposureOf = _match(exposureTimes, ready - offset, arrival - offset, held, tolerance)
+        # Then aligned on the frame with the smallest delay
+        matched = exposureOf >= 0
+        offset += (arrival[matched] - offset - exposureTimes[exposureOf[matched]]).min()
+        exposureOf = _match(exposureTimes, ready - offset, arrival - offset, held, tolerance)
+    ready, arrival = ready - offset, arrival - offset
+    frameOf = np.full(exposures, -1)
+    frameOf[exposureOf[exposureOf >= 0]] = np.flatnonzero(exposureOf >= 0)
+    unmatched = np.flatnonzero(exposureOf < 0)
+
+    table = np.zeros(exposures + len(unmatched), dtype=FRAME_EXPOSURE_DTYPE)
+    table['Exposure'][:exposures] = np.arange(exposures)
+    table['Exposure'][exposures:] = -1
+    table['t'][:exposures] = exposureTimes
+    table['t'][exposures:] = np.nan
+    table['Frame'][:exposures] = frameOf
+    table['Frame'][exposures:] = unmatched
+    matched = table['Frame'] >= 0
+    table['Arrival'] = np.nan
+    table['Arrival'][matched] = arrival[table['Frame'][matched]]
+    delay = table['Arrival'] - table['t']
+    table['Delay'] = delay - (np.nanmin(delay) if np.isfinite(delay).any() else 0.)
+    # Ready for the frame after the one of this exposure
+    table['Busy'] = np.nan
+    following = matched & (table['Frame'] + 1 < frames) & (table['Exposure'] >= 0)
+    table['Busy'][following] = ready[table['Frame'][following] + 1] - table['t'][following]
+    table['Dropped'][:exposures] = frameOf < 0
+    table['Late'] = matched & (table['Exposure'] >= 0) & (table['Delay'] > lateDelay)
+
+    busy = table['Busy'][np.isfinite(table['Busy'])]
+    summary = {
+        'Frames': frames,
+        'Exposures': exposures,
+        'Dropped': int(table['Dropped'].sum()),
+        'Late': int(table['Late'].sum()),
+        'Unmatched Frames': len(unmatched),
+        'Max Busy': busy.max() if len(busy) else np.nan,
+        # Trigger rate at which the worker would still have been ready for every exposure
+        'Max Safe Trigger Rate': 1. / busy.max() if len(busy) and busy.max() > 0 else np.nan,
+    }
+    return table, summary
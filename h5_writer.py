@@ -0,0 +1,229 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/ThorlabsWaveFrontSensor/h5_writer.py           #
+#                                                                   #
+# This file is part of labscript_devices                            #
+#                                                                   #
+#####################################################################
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from time import perf_counter
+from threading import Lock, Thread
+import numpy as np
+
+# Codecs for the compression connection table property; None stores the data uncompressed.
+# blosc and zstd are HDF5 plugin filters and need the hdf5plugin package, also to read the file.
+CODECS = ('gzip', 'lzf', 'blosc', 'zstd', None)
+DEFAULT_LEVELS = {'gzip': 4, 'blosc': 5, 'zstd': 3}
+# Codecs whose chunks can be encoded in Python (zlib releases the GIL) and written with write_direct_chunk
+DIRECT_CODECS = ('gzip', None)
+
+
+class StorageCodec(object):
+    """Filter pipeline of the shot datasets.
+
+    codec is one of CODECS, compressed at level (codec default if None),
+    after the byte shuffle filter if shuffle is set. With threads > 0 the
+    writer encodes the per-frame chunks of the array datasets itself, in a
+    pool of that many threads, and writes them with write_direct_chunk, so
+    compression runs in parallel instead of in the HDF5 library one chunk
+    at a time; this is only possible for DIRECT_CODECS and is ignored for
+    the others. The file is the same either way.
+    """
+    def __init__(self, codec='gzip', level=None, shuffle=False, threads=0):
+        if codec not in CODECS:
+            raise ValueError('compression must be one of %s, not %r' % (', '.join(map(str, CODECS)), codec))
+        self.codec = codec
+        self.level = DEFAULT_LEVELS.get(codec) if level is None else int(level)
+        self.shuffle = bool(shuffle)
+        self.threads = int(threads) if codec in DIRECT_CODECS else 0
+        self.options = self._options()
+
+    def _options(self):
+        """Keyword arguments of create_dataset for the filters."""
+        if self.codec in ('blosc', 'zstd'):
+            try:
+                import hdf5plugin
+            except ImportError:
+                raise ImportError('compression %r needs the hdf5plugin package' % self.codec)
+            if self.codec == 'blosc':
+                # Blosc shuffles internally
+                shuffle = hdf5plugin.Blosc.SHUFFLE if self.shuffle else hdf5plugin.Blosc.NOSHUFFLE
+                return dict(hdf5plugin.Blosc(cname='lz4', clevel=self.level, shuffle=shuffle))
+            return dict(hdf5plugin.Zstd(clevel=self.level), shuffle=self.shuffle)
+        options = {'compression': self.codec, 'shuffle': self.shuffle}
+        if self.codec == 'gzip':
+            options['compression_opts'] = self.level
+        return options
+
+    @property
+    def direct(self):
+        return self.threads > 0
+
+    def encode(self, frame):
+        """(chunk bytes, filter mask) of one frame as HDF5 would store it with these filters."""
+        frame = np.ascontiguousarray(frame)
+        if self.shuffle:
+            # Byte shuffle: all first bytes of the elements, then all second bytes, ...
+            data = frame.view(np.uint8).reshape(-1, frame.dtype.itemsize).T.tobytes()
+        else:
+            data = frame.tobytes()
+        if self.codec is None:
+            return data, 0
+        compressed = zlib.compress(data, self.level)
+        if len(compressed) >= len(data):
+            # Like the deflate filter, store chunks that do not compress as they are, with deflate masked out
+            return data, 1 << int(self.shuffle)
+        return compressed, 0
+
+
+class StreamingShotWriter(object):
+    """Appends measurements to the shot file while the shot is running.
+
+    The datasets are created, empty and resizable, when the writer is started.
+    append() queues one measurement (a dict of key: value) and a background
+    thread writes the queue out in batches of up to flushSize measurements.
+    The file is opened only for the duration of each batch so that other
+    devices can access the shot file in between. The queue holds at most
+    maxQueue measurements; once it is full append() blocks until the writer
+    catches up.
+
+    Every key is stored as the dataset <groupPath>/<key>/<key> with one row
+    per measurement, the same layout transition_to_manual used to write in
+    one go at the end of the shot. A key with a structured dtype is stored as
+    one compound dataset, and each of its fields is additionally stored on
+    its own as <groupPath>/<field>/<field>, so code reading single scalar
+    datasets keeps working. Only the fields in the layout dtype are stored.
+
+    Arrays are chunked one measurement per chunk and scalars in blocks of
+    1024 measurements. compression is a StorageCodec, or a codec name for
+    its default settings.
+
+    If a stage_timing.StageTimer is given, the time of each batch write is
+    recorded, shared equally, as the 'HDF5 Write' stage of its measurements.
+
+    The file is only opened while holding fileLock, which other writers of
+    the same shot file in this process (spotfield.SpotfieldRecorder) share.
+    """
+    def __init__(self, h5_filepath, groupPath, layout, attrs=None,
+                 compression='gzip', maxQueue=256, flushSize=64, timer=None):
+        self.h5_filepath = h5_filepath
+        self.groupPath = groupPath
+        self.layout = layout # {key: (shape, dtype)} of a single measurement
+        self.attrs = attrs or {}
+        if not isinstance(compression, StorageCodec):
+            compression = StorageCodec(compression)
+        self.codec = compression
+        self.encoders = None
+        self.flushSize = flushSize
+        self.queue = Queue(maxsize=maxQueue)
+        self.count = 0
+        self.error = None
+        self.thread = None
+        self.timer = timer
+        self.fileLock = Lock()
+
+    def start(self):
+        import h5py
+        with self.fileLock, h5py.File(self.h5_filepath, 'r+') as f:
+            group = f.require_group(self.groupPath)
+            for name, value in self.attrs.items():
+                group.attrs[name] = value
+            for key, (shape, dtype) in self._datasets():
+                # One chunk per measurement for arrays, a block of measurements for scalars
+                chunks = (1,) + tuple(shape) if shape else (1024,)
+                group.require_group(key).create_dataset(key, shape=(0,) + tuple(shape), dtype=dtype,
+                                                        maxshape=(None,) + tuple(shape), chunks=chunks,
+                                                        **self.codec.options)
+        if self.codec.direct:
+            self.encoders = ThreadPoolExecutor(self.codec.threads)
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _datasets(self):
+        """(key, (shape, dtype)) of every dataset in the group, including the split out record fields."""
+        for key, (shape, dtype) in self.layout.items():
+            yield key, (shape, dtype)
+            if np.dtype(dtype).names:
+                for field in np.dtype(dtype).names:
+                    yield field, (shape, np.dtype(dtype).fields[field][0])
+
+    def append(self, storedData):
+        self.queue.put(storedData)
+
+    def close(self):
+        """Write out everything still queued and stop the writer thread.
+
+        Returns the number of measurements written to the file."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.encoders is not None:
+            self.encoders.shutdown()
+            self.encoders = None
+        if self.error is not None:
+            raise self.error
+        return self.count
+
+    def _run(self):
+        finished = False
+        while not finished:
+            batch = [self.queue.get()]
+            while len(batch) < self.flushSize:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            if batch[-1] is None:
+                finished = True
+                batch.pop()
+            if batch and self.error is None:
+                try:
+                    self._write(batch)
+                except Exception as e:
+                    # Keep draining the queue so append() never blocks forever; report in close()
+                    self.error = e
+
+    def _write(self, batch):
+        import h5py
+        begin = perf_counter()
+        start = self.count
+        stop = start + len(batch)
+        # Frame chunks of the arrays are compressed in the pool before the file is opened
+        encoded = {}
+        if self.encoders is not None:
+            for key, (shape, dtype) in self.layout.items():
+                if shape and not np.dtype(dtype).names:
+                    encoded[key] = [self.encoders.submit(self.codec.encode, np.asarray(storedData[key], dtype))
+                                    for storedData in batch]
+        with self.fileLock, h5py.File(self.h5_filepath, 'r+') as f:
+            group = f[self.groupPath]
+            for key, chunks in encoded.items():
+                dataset = group[key][key]
+                dataset.resize(stop, axis=0)
+                origin = (0,) * len(self.layout[key][0])
+                for row, chunk in zip(range(start, stop), chunks):
+                    data, filterMask = chunk.result()
+                    dataset.id.write_direct_chunk((row,) + origin, data, filterMask)
+            for key, (shape, dtype) in self.layout.items():
+                if key in encoded:
+                    continue
+                if np.dtype(dtype).names:
+                    # The records may hold more fields than are stored
+                    records = np.array([storedData[key] for storedData in batch])
+                    rows = np.empty(len(batch), dtype=dtype)
+                    for name in rows.dtype.names:
+                        rows[name] = records[name]
+                else:
+                    rows = np.array([storedData[key] for storedData in batch], dtype=dtype)
+                for name in (key,) + (rows.dtype.names or ()):
+                    dataset = group[name][name]
+                    dataset.resize(stop, axis=0)
+                    dataset[start:stop] = rows if name == key else rows[name]
+        self.count = stop
+        if self.timer is not None:
+            seconds = (perf_counter() - begin) / len(batch)
+            for row in range(start, stop):
+                self.timer.record(row, 'HDF5 Write', seconds)
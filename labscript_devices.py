@@ -18,11 +18,102 @@ from labscript import config, set_passed_properties,TriggerableDevice
 import labscript_utils.properties
 import numpy as np
 
+from labscript_devices.ThorlabsWaveFrontSensor.exposure_table import (
+    COMPUTE_PROFILE_ATTR,
+    EXPOSURES_KEY,
+    EXPOSURE_DTYPE,
+    outputs_mask,
+)
+from labscript_devices.ThorlabsWaveFrontSensor.h5_writer import CODECS
+from labscript_devices.ThorlabsWaveFrontSensor.aggregation import BIN_FRAMES_ATTR, STORAGE_MODE_ATTR, STORAGE_MODES
+from labscript_devices.ThorlabsWaveFrontSensor.reference import (
+    REFERENCE_FILE_ATTR,
+    REFERENCE_FRAMES_ATTR,
+    STORE_WAVEFRONTS_ATTR,
+    SUBTRACT_REFERENCE_ATTR,
+)
+from labscript_devices.ThorlabsWaveFrontSensor.trigger_wait import TRIGGER_WAIT_ALIASES, TRIGGER_WAIT_MODES
+from labscript_devices.ThorlabsWaveFrontSensor.zonal import WAVEFRONT_SOLVERS
+
 __author__ = ['Oliver Tu']
 
 class ThorlabsWaveFrontSensor(TriggerableDevice):
     """
     This class is initilzed with the key word argument
+
+    triggerWaitMode selects how the worker waits for each trigger: 'backoff'
+    (retry with growing intervals), 'status' (poll the trigger bit of
+    WFS_GetStatus) or 'fixed' (retry at a fixed interval; formerly
+    'blocking'). If triggerWaitTimeout is set, acquisition stops after that
+    many seconds without a trigger.
+
+    If runStorePath is set, one row per measurement (scalar results and
+    Zernike coefficients) is also appended to that run-level HDF5 file; read
+    it with run_store.RunStore.
+
+    The spot arrays (Wavefront, Spot Deviations, Spot Intensities) are stored
+    cropped to the spot grid of the configured camera resolution, or, with
+    cropToPupil, to the lenslets around the pupil. The crop is saved in the
+    group attributes; shot_buffers.uncrop rebuilds the full 80x80 arrays.
+
+    sdkBackend='simulated' runs the worker against simulated_wfs.SimulatedWFS
+    instead of the Thorlabs DLL, for testing without hardware.
+
+    With stageTiming, the duration of every step of the acquisition loop is
+    measured for every frame and saved as the 'Stage Timings' table in the
+    image group; a p50/p99 summary is printed at the end of each shot.
+
+    expose() takes optional per-exposure settings: a fixed exposureTime (ms)
+    and masterGain instead of auto exposure, wavefrontType, zernikeOrder and
+    the outputs to calculate (names from exposure_table.OUTPUTS). They are
+    compiled into the EXPOSURES table of the device group and applied to the
+    triggers of the shot in time order.
+
+    computeProfile sets the outputs calculated for every exposure that does
+    not list its own: 'centroid_only', 'zernike', 'full' (the default) or a
+    list of output names. set_compute_profile() changes it for one shot.
+    Datasets of outputs not calculated in a shot are left out of its file.
+
+    If feedbackAddress is set, every frame's beam centroid and Zernike
+    coefficients are published as soon as they are calculated, to a ZeroMQ
+    PUB socket if it is a ZeroMQ endpoint ('tcp://*:5560') or else to a ring
+    in shared memory of that name. Read them with
+    feedback.FeedbackSubscriber(feedbackAddress).
+
+    compression selects the codec of the shot datasets: 'gzip' (the
+    default), 'lzf', 'blosc' or 'zstd' (these two need hdf5plugin, also for
+    reading) or None, at compressionLevel (codec default if None), with the
+    byte shuffle filter if shuffle is set. Arrays are chunked one frame per
+    chunk. With compressionThreads > 0, gzip and uncompressed frames are
+    encoded in that many threads and written with direct chunk writes.
+
+    capture_reference() and subtract_reference() make the worker subtract a
+    reference wavefront and Zernike vector from every frame of the shot, and
+    keep running statistics of the differences; see reference.py.
+
+    storageMode='aggregate' saves running reductions of each shot (mean,
+    standard deviation, minimum and maximum of every dataset) instead of
+    every frame, so worker memory does not grow with the number of
+    triggers; with binFrames = N > 0 the average of every N frames is saved
+    as well. storageMode='frames' (the default) saves every frame.
+    set_storage_mode() changes this for one shot; see aggregation.py.
+
+    With spotfieldImages, the raw 8-bit camera image of every trigger is
+    saved as well, losslessly compressed, in the Spotfield group of the
+    image group: whole, or cropped to spotfieldCrop pixels (an int or
+    (rows, columns)) around the beam centroid. With spotfieldDelta the
+    images are stored as differences to the previous one, which compresses
+    better; read them with spotfield.read_spotfield.
+
+    wavefrontSolver='zonal' reconstructs the measured wavefront (wavefront
+    type 0) from the spot deviations on the processing thread, by the
+    least-squares solver of zonal.py, instead of WFS_CalcWavefront on the
+    capture thread; its statistics are calculated there too, always over
+    the pupil. 'sdk' (the default) leaves both to the SDK.
+
+    processingWorkers > 1 runs the processing of that many frames at once
+    in a thread pool, e.g. the zonal wavefront; frames are still saved in
+    acquisition order. See pipeline.py.
     """
     description = 'ThorlabsWaveFrontSensor'
     allowed_children = []
@@ -31,7 +122,26 @@ class ThorlabsWaveFrontSensor(TriggerableDevice):
         property_names={
             'connection_table_properties': [
                 'serialNum',
-                'orientation'
+                'orientation',
+                'triggerWaitMode',
+                'triggerWaitTimeout',
+                'runStorePath',
+                'cropToPupil',
+                'sdkBackend',
+                'stageTiming',
+                'computeProfile',
+                'feedbackAddress',
+                'compression',
+                'compressionLevel',
+                'shuffle',
+                'compressionThreads',
+                'storageMode',
+                'binFrames',
+                'spotfieldImages',
+                'spotfieldCrop',
+                'spotfieldDelta',
+                'wavefrontSolver',
+                'processingWorkers',
             ]
         }
     )
@@ -41,13 +151,51 @@ class ThorlabsWaveFrontSensor(TriggerableDevice):
         parent_device,
         serialNum,
         orientation = None,
+        triggerWaitMode = 'backoff',
+        triggerWaitTimeout = None,
+        runStorePath = None,
+        cropToPupil = False,
+        sdkBackend = 'dll',
+        stageTiming = False,
+        computeProfile = 'full',
+        feedbackAddress = None,
+        compression = 'gzip',
+        compressionLevel = None,
+        shuffle = False,
+        compressionThreads = 0,
+        storageMode = 'frames',
+        binFrames = 0,
+        spotfieldImages = False,
+        spotfieldCrop = None,
+        spotfieldDelta = False,
+        wavefrontSolver = 'sdk',
+        processingWorkers = 1,
         **kwargs
     ):
         TriggerableDevice.__init__(self, name, parent_device, **kwargs)
         self.BLACS_connection = '%s'%(serialNum)
         self.orientation = orientation
+        if triggerWaitMode not in TRIGGER_WAIT_MODES and triggerWaitMode not in TRIGGER_WAIT_ALIASES:
+            raise ValueError("triggerWaitMode must be one of %s, not %s" % (', '.join(TRIGGER_WAIT_MODES), str(triggerWaitMode)))
+        if triggerWaitTimeout is not None and not triggerWaitTimeout > 0:
+            raise ValueError("triggerWaitTimeout must be None or > 0, not %s" % str(triggerWaitTimeout))
+        outputs_mask(computeProfile)
+        if compression not in CODECS:
+            raise ValueError("compression must be one of %s, not %s" % (', '.join(map(str, CODECS)), str(compression)))
+        self._check_storage_mode(storageMode, binFrames)
+        if spotfieldCrop is not None and not np.all(np.asarray(spotfieldCrop) >= 1):
+            raise ValueError("spotfieldCrop must be None or sizes >= 1, not %s" % str(spotfieldCrop))
+        if wavefrontSolver not in WAVEFRONT_SOLVERS:
+            raise ValueError("wavefrontSolver must be one of %s, not %s" % (', '.join(WAVEFRONT_SOLVERS), str(wavefrontSolver)))
+        if not (isinstance(processingWorkers, int) and processingWorkers >= 1):
+            raise ValueError("processingWorkers must be an integer >= 1, not %s" % str(processingWorkers))
+        self.exposures = []
+        self.computeProfile = None
+        self.referenceAttrs = {}
+        self.storageAttrs = {}
 
-    def expose(self, t, trigger_duration = 150e-6):
+    def expose(self, t, trigger_duration = 150e-6, exposureTime = None, masterGain = None,
+               wavefrontType = None, zernikeOrder = None, outputs = None):
         """Request an exposure at the given time. A trigger will be produced by the
         parent trigger object, with duration trigger_duration, or if not specified, of
         self.trigger_duration. The frame should have a `name, and optionally a
@@ -58,6 +206,14 @@ class ThorlabsWaveFrontSensor(TriggerableDevice):
         frames. For example an absorption image of atoms might have three frames:
         'probe', 'atoms' and 'background'. For this one might call expose three times
         with the same name, but three different frametypes.
+
+        exposureTime (ms) and masterGain fix the exposure of this trigger; if
+        exposureTime is None the sensor searches for an exposure as before, and
+        if masterGain is None the gain is left as it is. wavefrontType (0, 1 or
+        2) and zernikeOrder (2 to 10) override the front panel for this
+        exposure. outputs is a compute profile name or an iterable of names from
+        exposure_table.OUTPUTS (e.g. ['centroid', 'zernikes']); calculations not
+        needed for them are skipped. None means the compute profile of the shot.
         """
         # Backward compatibility with code that calls expose with name as the first
         # argument and t as the second argument:
@@ -71,17 +227,64 @@ class ThorlabsWaveFrontSensor(TriggerableDevice):
         if not trigger_duration > 0:
             msg = "trigger_duration must be > 0, not %s" % str(trigger_duration)
             raise ValueError(msg)
+        if exposureTime is not None and not exposureTime > 0:
+            raise ValueError("exposureTime must be > 0, not %s" % str(exposureTime))
+        if wavefrontType not in (None, 0, 1, 2):
+            raise ValueError("wavefrontType must be 0, 1 or 2, not %s" % str(wavefrontType))
+        if zernikeOrder is not None and not 2 <= zernikeOrder <= 10:
+            raise ValueError("zernikeOrder must be between 2 and 10, not %s" % str(zernikeOrder))
         self.trigger(t, trigger_duration)
+        self.exposures.append((
+            t,
+            np.nan if exposureTime is None else exposureTime,
+            np.nan if masterGain is None else masterGain,
+            -1 if wavefrontType is None else wavefrontType,
+            -1 if zernikeOrder is None else zernikeOrder,
+            -1 if outputs is None else outputs_mask(outputs),
+        ))
         return trigger_duration
 
+    def set_compute_profile(self, profile):
+        """Outputs calculated by default in this shot, instead of computeProfile from the
+        connection table: a name from exposure_table.PROFILES or a list of output names."""
+        self.computeProfile = outputs_mask(profile)
+
+    def capture_reference(self, frames, storeWavefronts=True):
+        """Average the first `frames` exposures of this shot into a new reference, and subtract it
+        from the remaining ones. The worker keeps the reference for subtract_reference() in later
+        shots. If storeWavefronts is False no per-frame spot arrays (Wavefront, Spot Deviations, Spot
+        Intensities) are saved, only their statistics over the shot; see reference.py."""
+        if not frames >= 1:
+            raise ValueError("frames must be >= 1, not %s" % str(frames))
+        self.referenceAttrs = {REFERENCE_FRAMES_ATTR: int(frames), STORE_WAVEFRONTS_ATTR: bool(storeWavefronts)}
+
+    def subtract_reference(self, path=None, storeWavefronts=True):
+        """Subtract the reference from every frame of this shot: the last one the worker captured or,
+        if path is given, the reference of that shot file, or the average of its frames if it used none.
+        storeWavefronts is as for capture_reference()."""
+        self.referenceAttrs = {SUBTRACT_REFERENCE_ATTR: True, STORE_WAVEFRONTS_ATTR: bool(storeWavefronts)}
+        if path is not None:
+            self.referenceAttrs[REFERENCE_FILE_ATTR] = str(path)
+
+    def _check_storage_mode(self, mode, binFrames):
+        if mode not in STORAGE_MODES:
+            raise ValueError("storageMode must be one of %s, not %s" % (', '.join(STORAGE_MODES), str(mode)))
+        if not binFrames >= 0:
+            raise ValueError("binFrames must be >= 0, not %s" % str(binFrames))
+
+    def set_storage_mode(self, mode, binFrames=0):
+        """Storage mode of this shot instead of storageMode from the connection table: 'frames' saves
+        every frame, 'aggregate' only running reductions and, if binFrames > 0, N-frame averages."""
+        self._check_storage_mode(mode, binFrames)
+        self.storageAttrs = {STORAGE_MODE_ATTR: mode, BIN_FRAMES_ATTR: int(binFrames)}
+
     def generate_code(self, hdf5_file):
-        # dtypes = {'names':['motor1','motor2','motor3','motor4'],'formats':[np.uint32,np.uint32,np.uint32,np.uint32]}
-
-        # out_table = np.zeros(1,dtype=dtypes)# create the table data for the hdf5 file.
-        # out_table['motor1'].fill(self.target_position[0])
-        # out_table['motor2'].fill(self.target_position[1])
-        # out_table['motor3'].fill(self.target_position[2])
-        # out_table['motor4'].fill(self.target_position[3])
-        # grp = self.init_device_group(hdf5_file)
-        # grp.create_dataset('DATA',compression=config.compression,data={}) 
-        pass
\ No newline at end of file
+        # One row per trigger, in the order the worker sees them
+        exposures = np.array(sorted(self.exposures, key=lambda exposure: exposure[0]), dtype=EXPOSURE_DTYPE)
+        grp = self.init_device_group(hdf5_file)
+        if self.computeProfile is not None:
+            grp.attrs[COMPUTE_PROFILE_ATTR] = self.computeProfile
+        for name, value in list(self.referenceAttrs.items()) + list(self.storageAttrs.items()):
+            grp.attrs[name] = value
+        if len(exposures):
+            grp.create_dataset(EXPOSURES_KEY, data=exposures)
@@ -0,0 +1,131 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/ThorlabsWaveFrontSensor/monitor.py             #
+#                                                                   #
+# This file is part of labscript_devices                            #
+#                                                                   #
+#####################################################################
+"""Free-running acquisition in manual mode, for aligning the beam.
+
+Monitor runs on its own thread in the worker. It takes frames as fast as
+the camera delivers them in continuous trigger mode, calculating each one
+with measure(buffers), and hands at most maxRate frames per second to the
+display. A frame is only shown if the display has finished with the
+previous one; all other frames are dropped from the display, never from
+the acquisition, so a slow GUI cannot hold up the camera.
+
+The display is DisplaySocket in the worker, which sends frames to the
+MonitorReceiver of the tab over ZeroMQ, or anything with the same ready()
+and show(buffers, info) methods.
+"""
+import json
+from threading import Thread, Event
+from time import perf_counter
+import numpy as np
+
+# WFS_SetTriggerMode: camera runs continuously, every image call returns the latest frame
+CONTINUOUS_TRIGGER_MODE = 0
+
+
+class Monitor(object):
+    """Acquisition thread of the live view.
+
+    measure(buffers) takes and calculates one frame into buffers (a
+    ShotBuffers slot) and returns whether it succeeded. frames counts the
+    frames taken, shown those handed to the display, dropped those the
+    display was too busy or too recently updated for; rate is the
+    acquisition rate over the last second or so.
+    """
+    def __init__(self, measure, buffers, display, maxRate=20., errorPause=0.1):
+        self.measure = measure
+        self.buffers = buffers
+        self.display = display
+        self.maxRate = maxRate
+        self.errorPause = errorPause
+        self.stopEvent = Event()
+        self.thread = None
+        self.frames = self.shown = self.dropped = 0
+        self.rate = 0.
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self):
+        self.stopEvent.clear()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopEvent.set()
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        interval = 1. / self.maxRate
+        nextShow = rateStart = perf_counter()
+        rateFrames = 0
+        while not self.stopEvent.is_set():
+            if not self.measure(self.buffers):
+                self.stopEvent.wait(self.errorPause)
+                continue
+            self.frames += 1
+            rateFrames += 1
+            now = perf_counter()
+            if now - rateStart >= 1.:
+                self.rate = rateFrames / (now - rateStart)
+                rateStart, rateFrames = now, 0
+            if now >= nextShow and self.display.ready():
+                self.shown += 1
+                self.display.show(self.buffers, self.info())
+                nextShow = now + interval
+            else:
+                self.dropped += 1
+
+    def info(self):
+        record = self.buffers.record
+        return {
+            'Frames': self.frames,
+            'Shown': self.shown,
+            'Dropped': self.dropped,
+            'Rate': self.rate,
+            'Beam Center X': float(record['Beam Center X']),
+            'Beam Center Y': float(record['Beam Center Y']),
+            'Wavefront Peak-Valley': float(record['Wavefront Peak-Valley']),
+            'Wavefront RMS': float(record['Wavefront RMS']),
+        }
+
+
+class DisplaySocket(object):
+    """Sends monitor frames to the tab's MonitorReceiver on port.
+
+    A REQ socket: the receiver replies once the frame is drawn, and until
+    then ready() is False. A frame is three parts, the JSON info (with the
+    array shapes added), the wavefront over the stored crop and the Zernike
+    coefficients, both float32.
+    """
+    def __init__(self, port, host='127.0.0.1'):
+        import zmq
+        from labscript_utils.ls_zprocess import Context
+        self.zmq = zmq
+        self.socket = Context().socket(zmq.REQ)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect('tcp://%s:%d' % (host, port))
+        self.waiting = False
+
+    def ready(self):
+        if self.waiting and self.socket.poll(0):
+            self.socket.recv()
+            self.waiting = False
+        return not self.waiting
+
+    def show(self, buffers, info):
+        wavefront = np.ascontiguousarray(buffers.wavefrontStored)
+        zernikes = np.ascontiguousarray(buffers.zernikesStored)
+        info = dict(info, **{'Wavefront Shape': wavefront.shape})
+        self.socket.send_multipart([json.dumps(info).encode(), wavefront, zernikes])
+        self.waiting = True
+
+    def close(self):
+        self.socket.close()
@@ -0,0 +1,103 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/ThorlabsWaveFrontSensor/pipeline.py            #
+#                                                                   #
+# This file is part of labscript_devices                            #
+#                                                                   #
+#####################################################################
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from threading import Thread
+
+
+class ProcessingStage(object):
+    """Second stage of the acquisition pipeline.
+
+    The capture thread only talks to the instrument: it waits for the trigger,
+    runs the SDK calculations into a buffer slot and put()s the measurement
+    here, which returns immediately unless maxQueue measurements are already
+    waiting. A processing thread then runs every processor on the measurement
+    and hands the result to each sink, in acquisition order.
+
+    processors are callables that take the measurement (a ShotBuffers slot, or
+    any mapping of dataset name to value) and return it, updated. With workers > 1 several measurements are processed at once in a
+    thread pool, which pays off for NumPy processors since they release the
+    GIL. Sinks (saving, counting, ...) always run on the processing thread.
+    """
+    def __init__(self, sinks, processors=(), workers=1, maxQueue=256):
+        self.sinks = list(sinks)
+        self.processors = list(processors)
+        self.workers = workers
+        self.queue = Queue(maxsize=maxQueue)
+        self.error = None
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, storedData):
+        self.queue.put(storedData)
+
+    def close(self):
+        """Process everything still queued and stop the processing thread.
+
+        Raises the first error of a processor or sink, once: it is cleared, so
+        closing again does not raise it a second time."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def process(self, storedData):
+        for processor in self.processors:
+            storedData = processor(storedData)
+        return storedData
+
+    def _deliver(self, storedData):
+        if self.error is not None:
+            return
+        try:
+            for sink in self.sinks:
+                sink(storedData)
+        except Exception as e:
+            # Keep draining the queue so put() never blocks forever; report in close()
+            self.error = e
+
+    def _run(self):
+        if self.workers <= 1 or not self.processors:
+            while True:
+                storedData = self.queue.get()
+                if storedData is None:
+                    return
+                try:
+                    storedData = self.process(storedData)
+                except Exception as e:
+                    self.error = self.error or e
+                    continue
+                self._deliver(storedData)
+
+        pending = deque()
+        finished = False
+        with ThreadPoolExecutor(self.workers) as executor:
+            while not finished:
+                try:
+                    # Don't block on the queue while processed measurements are waiting to be delivered
+                    storedData = self.queue.get(timeout=1e-3 if pending else None)
+                except Empty:
+                    pass
+                else:
+                    if storedData is None:
+                        finished = True
+                    else:
+                        pending.append(executor.submit(self.process, storedData))
+                # Deliver in order; wait for the oldest when the pool is saturated or at the end
+                while pending and (pending[0].done() or len(pending) > 2*self.workers or finished):
+                    try:
+                        self._deliver(pending.popleft().result())
+                    except Exception as e:
+                        self.error = self.error or e
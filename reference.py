@@ -0,0 +1,197 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/ThorlabsWaveFrontSensor/reference.py           #
+#                                                                   #
+# This file is part of labscript_devices                            #
+#                                                                   #
+#####################################################################
+"""Reference wavefront subtraction and drift statistics in the worker.
+
+A reference is a wavefront map and a Zernike vector the worker keeps
+between shots. It is either captured, as the average of the first N frames
+of a shot (ThorlabsWaveFrontSensor.capture_reference), or loaded from a
+prior shot file (subtract_reference(path)): the reference that shot used,
+or else the average of its frames. While a shot subtracts the reference,
+every frame's Wavefront and Zernikes Coefficients are replaced by their
+difference to it before they are saved, and Welford accumulators keep the
+running mean and standard deviation of the differences. The reference and
+those statistics are saved in the REFERENCE_KEY group of the image group at
+the end of the shot.
+
+With storeWavefronts=False the per-frame spot arrays are not stored at
+all: not the Wavefront, and not the Spot Deviations and Spot Intensities,
+which take up nine tenths of a full shot file. Their running mean and
+standard deviation over every frame of the shot are saved in the
+REFERENCE_KEY group instead, next to the statistics of the differences.
+Zernike coefficients and the Measurements table are still stored for every
+frame.
+
+Reference arrays are kept and saved in full, MAX_SPOTS_Y x MAX_SPOTS_X and
+MAX_ZERNIKE_MODES (Z1 first), NaN where they are not defined, so that shots
+with a different crop or Zernike order can use them.
+"""
+from collections import namedtuple
+import numpy as np
+
+from labscript_devices.ThorlabsWaveFrontSensor.shot_buffers import (
+    MAX_SPOTS_X,
+    MAX_SPOTS_Y,
+    MAX_ZERNIKE_MODES,
+    crop_from_attrs,
+    uncrop,
+)
+
+# Attributes of the device group, written by generate_code
+REFERENCE_FRAMES_ATTR = 'Reference Frames'
+REFERENCE_FILE_ATTR = 'Reference File'
+SUBTRACT_REFERENCE_ATTR = 'Subtract Reference'
+STORE_WAVEFRONTS_ATTR = 'Store Wavefronts'
+# Group in the image group holding the reference and the statistics of the differences
+REFERENCE_KEY = 'Reference'
+# Datasets left out of the shot when only statistics are stored
+STATISTICS_ONLY_SKIPPED = ('Wavefront', 'Spot Deviations', 'Spot Intensities')
+
+Reference = namedtuple('Reference', ['wavefront', 'zernikes', 'frames', 'source'])
+
+
+class Welford(object):
+    """Running mean and variance of arrays of a fixed shape, element by element.
+
+    Uses Welford's update, so the statistics of any number of frames are
+    kept in three arrays without loss of precision. NaN elements are not
+    counted, so each element has its own count."""
+    def __init__(self, shape):
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.mean = np.zeros(shape, dtype=np.float64)
+        self.m2 = np.zeros(shape, dtype=np.float64)
+
+    def update(self, x):
+        valid = np.isfinite(x)
+        self.count += valid
+        delta = np.where(valid, x - self.mean, 0.)
+        self.mean += delta / np.maximum(self.count, 1)
+        self.m2 += delta * np.where(valid, x - self.mean, 0.)
+
+    def update_many(self, stack):
+        """Add a stack of arrays (frames first) at once, merging its statistics with Chan's formula."""
+        valid = np.isfinite(stack)
+        count = valid.sum(axis=0)
+        values = np.where(valid, stack, 0.)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(count, values.sum(axis=0) / count, 0.)
+        m2 = (np.where(valid, stack - mean, 0.)**2).sum(axis=0)
+        total = self.count + count
+        delta = mean - self.mean
+        safeTotal = np.maximum(total, 1)
+        self.mean += delta * count / safeTotal
+        self.m2 += m2 + delta**2 * self.count * count / safeTotal
+        self.count = total
+
+    def mean_or_nan(self):
+        return np.where(self.count > 0, self.mean, np.nan)
+
+    def std(self):
+        """Sample standard deviation, NaN where fewer than two values were seen."""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self.count > 1, np.sqrt(self.m2 / (self.count - 1)), np.nan)
+
+
+def load_reference(path, groupPath):
+    """Reference from the shot file at path: the one used by its image group groupPath, or
+    else the average of the wavefronts and Zernike coefficients stored there."""
+    import h5py
+    with h5py.File(path, 'r') as f:
+        group = f[groupPath]
+        if REFERENCE_KEY in group:
+            reference = group[REFERENCE_KEY]
+            return Reference(reference['Wavefront'][:], reference['Zernikes Coefficients'][:],
+                             int(reference.attrs['Frames']), str(reference.attrs['Source']))
+        wavefront = Welford((MAX_SPOTS_Y, MAX_SPOTS_X))
+        zernikes = Welford(MAX_ZERNIKE_MODES)
+        frames = 0
+        if 'Wavefront' in group:
+            stored = group['Wavefront']['Wavefront']
+            frames = len(stored)
+            wavefront.update_many(uncrop(stored[:], crop_from_attrs(group.attrs)).astype(np.float64))
+        if 'Zernikes Coefficients' in group:
+            stored = group['Zernikes Coefficients']['Zernikes Coefficients'][:]
+            frames = max(frames, len(stored))
+            padded = np.full((len(stored), MAX_ZERNIKE_MODES), np.nan)
+            padded[:, :stored.shape[1]] = stored
+            zernikes.update_many(padded)
+        if not frames:
+            raise ValueError('%s has no wavefronts or Zernike coefficients in %s' % (path, groupPath))
+        return Reference(wavefront.mean_or_nan(), zernikes.mean_or_nan(), frames, path)
+
+
+class ReferenceTracker(object):
+    """Captures and subtracts the reference for one shot.
+
+    Called with every measurement (a ShotBuffers slot) in acquisition order,
+    as a sink of the processing stage ahead of saving. The first
+    captureFrames measurements are averaged into a new reference and saved
+    as they are; every later one has the reference subtracted in place and
+    is added to the statistics of the differences. reference is the
+    reference to subtract if none is captured, or None. With statisticsOnly
+    the statistics of every frame's Spot Deviations and Spot Intensities are
+    kept too, for shots that do not store them.
+    """
+    def __init__(self, reference=None, captureFrames=0, statisticsOnly=False):
+        self.reference = None if captureFrames else reference
+        self.captureFrames = captureFrames
+        self.captured = 0
+        self.subtracted = 0
+        if captureFrames:
+            self.captureWavefront = Welford((MAX_SPOTS_Y, MAX_SPOTS_X))
+            self.captureZernikes = Welford(MAX_ZERNIKE_MODES)
+        self.wavefrontDelta = Welford((MAX_SPOTS_Y, MAX_SPOTS_X))
+        self.zernikesDelta = Welford(MAX_ZERNIKE_MODES)
+        self.statisticsOnly = statisticsOnly
+        if statisticsOnly:
+            self.deviations = Welford((2, MAX_SPOTS_Y, MAX_SPOTS_X))
+            self.intensity = Welford((MAX_SPOTS_Y, MAX_SPOTS_X))
+
+    def __call__(self, buffers):
+        zernikes = buffers.zernikes[1:]
+        if self.statisticsOnly:
+            self.deviations.update(buffers.deviations)
+            self.intensity.update(buffers.intensity)
+        if self.captured < self.captureFrames:
+            self.captureWavefront.update(buffers.wavefront)
+            self.captureZernikes.update(zernikes)
+            self.captured += 1
+            if self.captured == self.captureFrames:
+                self.reference = Reference(self.captureWavefront.mean_or_nan(), self.captureZernikes.mean_or_nan(),
+                                           self.captured, 'captured')
+            return
+        if self.reference is None:
+            return
+        buffers.wavefront -= self.reference.wavefront
+        zernikes -= self.reference.zernikes
+        self.wavefrontDelta.update(buffers.wavefront)
+        self.zernikesDelta.update(zernikes)
+        self.subtracted += 1
+
+    def save(self, group):
+        """Write the reference and the statistics of the differences to REFERENCE_KEY in group."""
+        if REFERENCE_KEY in group:
+            del group[REFERENCE_KEY]
+        out = group.create_group(REFERENCE_KEY)
+        if self.reference is None:
+            return out
+        out.attrs['Frames'] = self.reference.frames
+        out.attrs['Source'] = self.reference.source
+        out.attrs['Frames Subtracted'] = self.subtracted
+        out.create_dataset('Wavefront', data=self.reference.wavefront)
+        out.create_dataset('Zernikes Coefficients', data=self.reference.zernikes)
+        out.create_dataset('Wavefront Difference Mean', data=self.wavefrontDelta.mean_or_nan())
+        out.create_dataset('Wavefront Difference Std', data=self.wavefrontDelta.std())
+        out.create_dataset('Zernikes Difference Mean', data=self.zernikesDelta.mean_or_nan())
+        out.create_dataset('Zernikes Difference Std', data=self.zernikesDelta.std())
+        if self.statisticsOnly:
+            # Interleaved (y, x, 2) like the stored Spot Deviations
+            out.create_dataset('Spot Deviations Mean', data=np.moveaxis(self.deviations.mean_or_nan(), 0, -1))
+            out.create_dataset('Spot Deviations Std', data=np.moveaxis(self.deviations.std(), 0, -1))
+            out.create_dataset('Spot Intensities Mean', data=self.intensity.mean_or_nan())
+            out.create_dataset('Spot Intensities Std', data=self.intensity.std())
+        return out
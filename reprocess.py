@@ -0,0 +1,271 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/ThorlabsWaveFrontSensor/reprocess.py           #
+#                                                                   #
+# This file is part of labscript_devices                            #
+#                                                                   #
+#####################################################################
+"""Refit the Zernike coefficients of stored WFS shots with new parameters.
+
+Reads the Spot Deviations stored under images/<orientation> of every shot
+file, fits them with a new Zernike order and/or pupil, and writes the result
+either back into each shot as a new group next to the original datasets or
+into one summary file. Files are processed in parallel by a process pool.
+
+With --recentroid the spot deviations are not read but calculated again
+from the raw spotfield images saved with spotfieldImages, by
+centroiding.CentroidEngine with the MLA data and noise cut of the shot.
+Shots taken without the dynamic noise cut used the SDK's fixed level,
+which the SDK does not report, so those need --noise-cut (in counts).
+With --zonal the wavefront is reconstructed from the deviations as well,
+by the zonal solver of zonal.py, and saved with the refit in each shot.
+
+Example:
+    python -m labscript_devices.ThorlabsWaveFrontSensor.reprocess \\
+        --order 8 --pupil-diameter 2.5 2.5 --summary refit.h5 shots/*.h5
+"""
+import argparse
+import glob
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+import numpy as np
+import h5py
+
+from labscript_devices.ThorlabsWaveFrontSensor.shot_buffers import (
+    ZernikeOrderCount,
+    crop_attrs,
+    crop_from_attrs,
+    uncrop,
+)
+from labscript_devices.ThorlabsWaveFrontSensor.centroiding import CentroidEngine, deviations
+from labscript_devices.ThorlabsWaveFrontSensor.spotfield import SPOTFIELD_KEY, pixel_pitch, read_spotfield
+from labscript_devices.ThorlabsWaveFrontSensor.zernike import (
+    ZernikeFitter,
+    geometry_attrs,
+    geometry_from_attrs,
+    spot_grid_crop,
+)
+from labscript_devices.ThorlabsWaveFrontSensor.zonal import ZonalReconstructor
+
+# One fitter and one zonal reconstructor per process, so bases and solvers are reused across the
+# files that process handles
+_fitter = ZernikeFitter()
+_reconstructor = ZonalReconstructor()
+# Centroid engines by MLA data and noise cut, for the same reason
+_engines = {}
+
+
+def _dataset(group, key):
+    # The worker stores every key as <key>/<key>
+    return group[key][key]
+
+def _wfs_groups(f, orientation=None):
+    """Paths of the image groups in a shot file that hold WFS measurements."""
+    if orientation is not None:
+        return ['images/' + orientation]
+    if 'images' not in f:
+        return []
+    return ['images/' + name for name, group in f['images'].items()
+            if isinstance(group, h5py.Group) and 'Spot Deviations' in group]
+
+
+def _engine(attrs, noiseCut=None):
+    """Centroid engine for the MLA data and noise cut of an image group's attributes. A shot taken
+    without the dynamic noise cut needs the fixed noiseCut (counts) it was taken with."""
+    dynamicNoiseCut = bool(attrs.get('Dynamic Noise Cut', True))
+    if dynamicNoiseCut:
+        noiseCut = 0.
+    elif noiseCut is None:
+        raise ValueError('shot taken with a fixed noise cut, which is not stored: give the noise cut to recentroid it')
+    key = (float(attrs['Camera Pitch']), float(attrs['Lenslet Pitch']), float(attrs.get('Spot Offset X', 0.)),
+           float(attrs.get('Spot Offset Y', 0.)), dynamicNoiseCut, float(noiseCut))
+    if key not in _engines:
+        _engines[key] = CentroidEngine(*key)
+    return _engines[key]
+
+def spotfield_deviations(group, start=0, stop=None, noiseCut=None):
+    """Spot deviations (frames, spotsY, spotsX, 2) in sensor pixels, like the stored ones, centroided
+    again from the spotfield images start:stop of an image group; noiseCut as for _engine()."""
+    attrs = group.attrs
+    engine = _engine(attrs, noiseCut)
+    images, window = read_spotfield(group, start, stop)
+    spotfield = group[SPOTFIELD_KEY].attrs
+    shape = (int(spotfield['Image Rows']), int(spotfield['Image Columns']))
+    spotsX, spotsY = int(attrs['Spots X']), int(attrs['Spots Y'])
+    binning = pixel_pitch(engine.camPitchUm, engine.lensletPitchUm, spotsX, shape[1]) / engine.camPitchUm
+    result = np.empty((len(images), spotsY, spotsX, 2), dtype=np.float32)
+    # Frames cropped around the beam may each have their own window
+    corners = np.stack([window['Row'], window['Column']], axis=-1)
+    for corner in np.unique(corners, axis=0):
+        frames = np.flatnonzero((corners == corner).all(axis=-1))
+        centroids = engine.centroid(images[frames], int(attrs['Resolution Index']), spotsX, spotsY,
+                                    shape, tuple(corner))
+        result[frames] = binning * deviations(centroids)
+    return result
+
+
+def refit_file(path, order, orientation=None, pupilCenter=None, pupilDiameter=None,
+               groupName=None, chunkSize=256, recentroid=False, zonal=False, noiseCut=None):
+    """Refit every WFS image group of one shot file.
+
+    Spot deviations are read chunkSize frames at a time and fitted as a batch;
+    with recentroid they are calculated from the spotfield images instead,
+    with the fixed noiseCut (counts) for shots taken without the dynamic one.
+    If groupName is given the results are written to <image group>/<groupName>,
+    with zonal together with the wavefront reconstructed from the deviations.
+    Returns a list of (image group path, coefficients, order RMS, radius of curvature).
+    """
+    results = []
+    with h5py.File(path, 'r+' if groupName else 'r') as f:
+        for groupPath in _wfs_groups(f, orientation):
+            group = f[groupPath]
+            geometry = geometry_from_attrs(group.attrs)
+            if pupilCenter is not None:
+                geometry = geometry._replace(pupilCenterXMm=pupilCenter[0], pupilCenterYMm=pupilCenter[1])
+            if pupilDiameter is not None:
+                geometry = geometry._replace(pupilDiameterXMm=pupilDiameter[0], pupilDiameterYMm=pupilDiameter[1])
+            basis = _fitter.basis(geometry, order)
+            if recentroid:
+                frames = len(group[SPOTFIELD_KEY][SPOTFIELD_KEY])
+                chunks = (spotfield_deviations(group, i, i+chunkSize, noiseCut) for i in range(0, frames, chunkSize))
+            else:
+                crop = crop_from_attrs(group.attrs)
+                stored = _dataset(group, 'Spot Deviations')
+                # Spots outside a stored crop are missing (NaN) for the fit
+                chunks = (uncrop(stored[i:i+chunkSize], crop, interleaved=True)
+                          for i in range(0, len(stored), chunkSize))
+            fitted, wavefronts = [], []
+            for chunk in chunks:
+                fitted.append(basis.fit(chunk))
+                if zonal and groupName:
+                    wavefronts.append(_reconstructor.reconstruct(chunk, geometry)[:, :geometry.spotsY, :geometry.spotsX])
+            coefficients = np.concatenate(fitted or [np.zeros((0, len(basis.modes)))])
+            orderRMS = basis.order_rms(coefficients)
+            radius = basis.radius_of_curvature(coefficients)
+            if groupName:
+                if groupName in group:
+                    del group[groupName]
+                out = group.create_group(groupName)
+                out.attrs['Highest Zernike Order'] = order
+                out.attrs['Recentroided'] = recentroid
+                out.attrs.update(geometry_attrs(geometry))
+                out.create_dataset('Zernikes Coefficients', data=coefficients, compression='gzip')
+                out.create_dataset('Zernikes RMS', data=orderRMS, compression='gzip')
+                out.create_dataset('Radius of Curvature', data=radius)
+                if zonal:
+                    out.attrs.update(crop_attrs(spot_grid_crop(geometry)))
+                    out.create_dataset('Wavefront', data=np.concatenate(
+                        wavefronts or [np.zeros((0, geometry.spotsY, geometry.spotsX), dtype=np.float32)]),
+                        compression='gzip')
+            results.append((groupPath, coefficients, orderRMS, radius))
+    return results
+
+
+def zonal_difference(group, chunkSize=256):
+    """Zonal reconstruction of the stored Spot Deviations of an image group against its stored
+    Wavefront, both without their piston, over the lenslets where both are defined. On a shot taken
+    with the real SDK this checks zonal.py against WFS_CalcWavefront. Returns the rms difference and
+    the rms of the stored wavefront in um, and the number of lenslet values compared."""
+    geometry = geometry_from_attrs(group.attrs)
+    crop = crop_from_attrs(group.attrs)
+    storedDeviations = _dataset(group, 'Spot Deviations')
+    storedWavefront = _dataset(group, 'Wavefront')
+    grid = (slice(None), slice(0, geometry.spotsY), slice(0, geometry.spotsX))
+    squaredDifference = squaredWavefront = count = 0.
+    for i in range(0, len(storedDeviations), chunkSize):
+        chunk = uncrop(storedDeviations[i:i+chunkSize], crop, interleaved=True)
+        zonal = _reconstructor.reconstruct(chunk, geometry)[grid]
+        sdk = uncrop(storedWavefront[i:i+chunkSize], crop)[grid].astype(np.float64)
+        valid = np.isfinite(zonal) & np.isfinite(sdk)
+        frameCount = np.maximum(valid.sum(axis=(1, 2), keepdims=True), 1)
+        zonal = np.where(valid, zonal, 0.)
+        sdk = np.where(valid, sdk, 0.)
+        zonal = zonal - zonal.sum(axis=(1, 2), keepdims=True) / frameCount
+        sdk = sdk - sdk.sum(axis=(1, 2), keepdims=True) / frameCount
+        squaredDifference += ((zonal - sdk)[valid]**2).sum()
+        squaredWavefront += (sdk[valid]**2).sum()
+        count += valid.sum()
+    if not count:
+        raise ValueError('no lenslet has both a stored wavefront and spot deviations in ' + group.name)
+    return np.sqrt(squaredDifference / count), np.sqrt(squaredWavefront / count), int(count)
+
+
+def write_summary(summaryPath, order, collected):
+    """One row per refitted frame: source file, image group, frame index and fit results."""
+    rows = [(path, groupPath, frame) for path, results in collected
+            for groupPath, coefficients, _, _ in results for frame in range(len(coefficients))]
+    stack = lambda index, width: np.concatenate(
+        [r[index] for _, results in collected for r in results] + [np.zeros((0,) + width)])
+    with h5py.File(summaryPath, 'w') as f:
+        f.attrs['Highest Zernike Order'] = order
+        f.create_dataset('file', data=np.array([r[0] for r in rows], dtype=h5py.string_dtype()))
+        f.create_dataset('group', data=np.array([r[1] for r in rows], dtype=h5py.string_dtype()))
+        f.create_dataset('frame', data=np.array([r[2] for r in rows], dtype=np.int32))
+        f.create_dataset('Zernikes Coefficients', data=stack(1, (ZernikeOrderCount[order],)), compression='gzip')
+        f.create_dataset('Zernikes RMS', data=stack(2, (order,)), compression='gzip')
+        f.create_dataset('Radius of Curvature', data=stack(3, ()))
+
+
+def reprocess(files, order, processes=None, summaryPath=None, progress=True, **kwargs):
+    """Refit many shot files in a process pool; see refit_file for the keyword arguments.
+
+    Results are collected only if a summary file is written. Returns the number
+    of files processed and the number that failed."""
+    start = perf_counter()
+    collected = []
+    failed = 0
+    with ProcessPoolExecutor(processes) as executor:
+        futures = [(path, executor.submit(refit_file, path, order, **kwargs)) for path in files]
+        for done, (path, future) in enumerate(futures, 1):
+            try:
+                results = future.result()
+            except Exception as e:
+                failed += 1
+                print('\n%s: %s' % (path, e), file=sys.stderr)
+            else:
+                if summaryPath:
+                    collected.append((path, results))
+            if progress:
+                elapsed = perf_counter() - start
+                print('\r[%d/%d] %.1f files/s' % (done, len(futures), done/elapsed), end='', file=sys.stderr)
+    if progress:
+        print(file=sys.stderr)
+    if summaryPath:
+        write_summary(summaryPath, order, collected)
+    return len(files), failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='+', help='shot files or glob patterns')
+    parser.add_argument('--order', type=int, required=True, help='highest Zernike order to fit, 2-10')
+    parser.add_argument('--orientation', help='image group to refit (default: every WFS group in the file)')
+    parser.add_argument('--pupil-center', type=float, nargs=2, metavar=('X', 'Y'), help='pupil centre in mm')
+    parser.add_argument('--pupil-diameter', type=float, nargs=2, metavar=('X', 'Y'), help='pupil diameter in mm')
+    parser.add_argument('--group', help='write the results into each shot under this group name')
+    parser.add_argument('--summary', help='write the results of all shots to this file')
+    parser.add_argument('--processes', type=int, help='number of worker processes (default: one per CPU)')
+    parser.add_argument('--chunk', type=int, default=256, help='frames read and fitted at a time')
+    parser.add_argument('--recentroid', action='store_true',
+                        help='centroid the saved spotfield images again instead of using the stored deviations')
+    parser.add_argument('--noise-cut', type=float,
+                        help='fixed noise cut (counts) to recentroid shots taken without the dynamic noise cut')
+    parser.add_argument('--zonal', action='store_true',
+                        help='also reconstruct the wavefront from the deviations (saved with --group only)')
+    args = parser.parse_args(argv)
+    if not (args.group or args.summary):
+        parser.error('nothing to write: give --group and/or --summary')
+    if args.zonal and not args.group:
+        parser.error('--zonal wavefronts are only saved in the shots: give --group')
+
+    files = sorted(set(path for pattern in args.files for path in (glob.glob(pattern) or [pattern])))
+    total, failed = reprocess(files, args.order, processes=args.processes, summaryPath=args.summary,
+                              orientation=args.orientation, pupilCenter=args.pupil_center,
+                              pupilDiameter=args.pupil_diameter, groupName=args.group, chunkSize=args.chunk,
+                              recentroid=args.recentroid, zonal=args.zonal, noiseCut=args.noise_cut)
+    print('%d files refitted, %d failed' % (total - failed, failed))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
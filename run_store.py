@@ -0,0 +1,173 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/ThorlabsWaveFrontSensor/run_store.py           #
+#                                                                   #
+# This file is part of labscript_devices                            #
+#                                                                   #
+#####################################################################
+"""Run-level store of the scalar results and Zernike coefficients of every measurement.
+
+Besides the per-shot files, the worker can append one row per measurement to
+a single HDF5 file that spans many shots, so that drift over a day can be
+looked at without opening every shot file. The file holds chunked,
+extendible columns:
+
+    time            (rows,)            float64, unix time of the measurement
+    shot            (rows,)            int32, index into shots/name
+    frame           (rows,)            int32, measurement number within the shot
+    scalars         (rows, keys)       float64, column names in attribute 'keys'
+    zernikes        (rows, 66)         float32, Z1..Z66, NaN above the fitted order
+    shots/name      (shots,)           str, shot file name
+    shots/start     (shots,)           int64, first row of the shot
+    shots/device    (shots,)           str, name of the sensor that measured the shot
+
+The rows of a shot are appended together, but several sensors may share one
+file, and shots of different sensors then overlap in time; a step of the
+clock does the same to the shots of one sensor. The reader therefore keeps
+an index of the rows sorted by time and finds time windows by bisection of
+that, and every query can be restricted to one device. Files written before
+shots/device existed get the column on the next append, with '' for their
+earlier shots.
+"""
+import os
+import numpy as np
+import h5py
+
+from labscript_devices.ThorlabsWaveFrontSensor.shot_buffers import MAX_ZERNIKE_MODES
+
+CHUNK_ROWS = 4096
+
+
+class RunStoreWriter(object):
+    """Appends the measurements of one shot at a time to a run store file, for the named device."""
+    def __init__(self, path, scalarKeys, device=''):
+        self.path = path
+        self.scalarKeys = list(scalarKeys)
+        self.device = device
+
+    def _create(self, f):
+        def column(name, shape, dtype, fillvalue=0):
+            f.create_dataset(name, shape=(0,) + shape, maxshape=(None,) + shape, dtype=dtype,
+                             chunks=(CHUNK_ROWS,) + shape, fillvalue=fillvalue)
+        column('time', (), np.float64)
+        column('shot', (), np.int32)
+        column('frame', (), np.int32)
+        column('scalars', (len(self.scalarKeys),), np.float64, np.nan)
+        column('zernikes', (MAX_ZERNIKE_MODES,), np.float32, np.nan)
+        f['scalars'].attrs['keys'] = self.scalarKeys
+        f.create_dataset('shots/name', shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(), chunks=(1024,))
+        f.create_dataset('shots/start', shape=(0,), maxshape=(None,), dtype=np.int64, chunks=(1024,))
+        self._create_devices(f)
+
+    def _create_devices(self, f):
+        shots = len(f['shots/name'])
+        f.create_dataset('shots/device', shape=(shots,), maxshape=(None,), dtype=h5py.string_dtype(),
+                         chunks=(1024,), data=np.full(shots, '', dtype=object))
+
+    def append_shot(self, shotName, times, scalars, zernikes):
+        """Append one shot: times (n,), scalars (n, len(scalarKeys)), zernikes (n, modes <= 66)."""
+        times = np.asarray(times, dtype=np.float64)
+        n = len(times)
+        if n == 0:
+            return
+        with h5py.File(self.path, 'a') as f:
+            if 'time' not in f:
+                self._create(f)
+            elif list(f['scalars'].attrs['keys']) != self.scalarKeys:
+                raise ValueError('Run store %s has different scalar columns; use a new file' % self.path)
+            if 'shots/device' not in f:
+                self._create_devices(f)
+            start = len(f['time'])
+            shotIndex = len(f['shots/name'])
+            for name, data in [('shots/name', [shotName]), ('shots/start', [start]), ('shots/device', [self.device])]:
+                f[name].resize(shotIndex + 1, axis=0)
+                f[name][shotIndex] = data[0]
+            for name, data in [('time', times),
+                               ('shot', np.full(n, shotIndex, dtype=np.int32)),
+                               ('frame', np.arange(n, dtype=np.int32)),
+                               ('scalars', scalars)]:
+                f[name].resize(start + n, axis=0)
+                f[name][start:] = data
+            zernikes = np.asarray(zernikes, dtype=np.float32)
+            f['zernikes'].resize(start + n, axis=0)
+            f['zernikes'][start:, :zernikes.shape[1]] = zernikes
+
+
+class RunStore(object):
+    """Reader for a run store file.
+
+    Every query returns a dict of NumPy arrays: 'time', 'shot' (shot file
+    names), 'device', 'frame', 'zernikes' and one entry per scalar key.
+    time_window() and shot() return rows in time order and take an optional
+    device name to select the rows of one sensor. The time and shot columns
+    and the shot index are read once and cached; call refresh() to pick up
+    rows appended since.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.refresh()
+
+    def refresh(self):
+        with h5py.File(self.path, 'r') as f:
+            self.times = f['time'][:]
+            self.rowShots = f['shot'][:]
+            self.scalarKeys = [str(key) for key in f['scalars'].attrs['keys']]
+            self.shotNames = np.array(f['shots/name'].asstr()[:], dtype=object)
+            self.shotStarts = f['shots/start'][:]
+            if 'shots/device' in f:
+                self.shotDevices = np.array(f['shots/device'].asstr()[:], dtype=object)
+            else:
+                self.shotDevices = np.full(len(self.shotNames), '', dtype=object)
+        # Rows by time; stable, so rows with equal times stay in the order they were appended
+        self.order = np.argsort(self.times, kind='stable')
+        self.sortedTimes = self.times[self.order]
+
+    def __len__(self):
+        return len(self.times)
+
+    def rows(self, start=None, stop=None):
+        """Rows start..stop (a slice over all measurements in the store, in the order appended)."""
+        start, stop, _ = slice(start, stop).indices(len(self.times))
+        return self._read(np.arange(start, stop))
+
+    def _read(self, indices):
+        # h5py reads a slice much faster than scattered rows, so the span of the rows is read and indexed
+        if not len(indices):
+            start = stop = 0
+        else:
+            start, stop = indices.min(), indices.max() + 1
+        selected = indices - start
+        with h5py.File(self.path, 'r') as f:
+            scalars = f['scalars'][start:stop][selected]
+            result = {
+                'time': self.times[indices],
+                'shot': self.shotNames[self.rowShots[indices]],
+                'device': self.shotDevices[self.rowShots[indices]],
+                'frame': f['frame'][start:stop][selected],
+                'zernikes': f['zernikes'][start:stop][selected],
+            }
+        for i, key in enumerate(self.scalarKeys):
+            result[key] = scalars[:, i]
+        return result
+
+    def _of_device(self, indices, device):
+        if device is None:
+            return indices
+        return indices[self.shotDevices[self.rowShots[indices]] == device]
+
+    def time_window(self, start, stop, device=None):
+        """Measurements with start <= time < stop (unix time), of one device if given."""
+        first, last = np.searchsorted(self.sortedTimes, [start, stop])
+        return self._read(self._of_device(self.order[first:last], device))
+
+    def shot(self, name, device=None):
+        """All measurements of the shot file with the given name, of every device that measured it
+        unless device is given."""
+        shots = np.flatnonzero(self.shotNames == os.path.basename(name))
+        if device is not None:
+            shots = shots[self.shotDevices[shots] == device]
+        if not len(shots):
+            raise KeyError(name)
+        stops = np.append(self.shotStarts[1:], len(self.times))
+        indices = np.concatenate([np.arange(self.shotStarts[i], stops[i]) for i in shots])
+        return self._read(indices[np.argsort(self.times[indices], kind='stable')])
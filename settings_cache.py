@@ -0,0 +1,53 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/ThorlabsWaveFrontSensor/settings_cache.py      #
+#                                                                   #
+# This file is part of labscript_devices                            #
+#                                                                   #
+#####################################################################
+from collections import Counter
+from time import perf_counter
+
+
+class SettingsCache(object):
+    """Remembers the inputs of the SDK setting calls last applied to the device.
+
+    call(name, inputs, function, *args) runs function(*args) only if inputs
+    differ from those of the last successful call of the same name, and
+    returns its status, or None if the call was skipped. A failed call is not
+    cached, so it is retried next time.
+
+    calls and skipped count the calls made and avoided per name; lastSeconds
+    holds how long the last real call of each name took, which is the time a
+    skipped call saves.
+    """
+    def __init__(self):
+        self.applied = {}
+        self.calls = Counter()
+        self.skipped = Counter()
+        self.lastSeconds = {}
+
+    def call(self, name, inputs, function, *args):
+        if self.applied.get(name) == inputs:
+            self.skipped[name] += 1
+            return None
+        start = perf_counter()
+        devStatus = function(*args)
+        self.lastSeconds[name] = perf_counter() - start
+        self.calls[name] += 1
+        if devStatus == 0:
+            self.applied[name] = inputs
+        else:
+            self.applied.pop(name, None)
+        return devStatus
+
+    def invalidate(self, *names):
+        """Forget the applied inputs of the given calls, or of all calls, so they are issued again."""
+        if not names:
+            self.applied.clear()
+        for name in names:
+            self.applied.pop(name, None)
+
+    def saved_seconds(self, names):
+        """Time saved by skipping the given calls once, from their last measured durations."""
+        return sum(self.lastSeconds.get(name, 0.) for name in names)
@@ -0,0 +1,254 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/ThorlabsWaveFrontSensor/shot_buffers.py        #
+#                                                                   #
+# This file is part of labscript_devices                            #
+#                                                                   #
+#####################################################################
+import ctypes as ct
+from collections import deque
+import numpy as np
+
+# Array sizes the WFS SDK writes into, see WFS.h. The spot arrays are always
+# [MAX_SPOTS_Y][MAX_SPOTS_X] regardless of the configured camera resolution and
+# the Zernike arrays are indexed from 1, hence the +1.
+MAX_SPOTS_X = 80
+MAX_SPOTS_Y = 80
+MAX_ZERNIKE_ORDERS = 10
+MAX_ZERNIKE_MODES = 66
+ZernikeOrderCount = [0,0,6,10,15,21,28,36,45,55,66]
+
+# Scalar results stored for every measurement, in the order they are saved
+SCALAR_KEYS = (
+    'Beam Center X',
+    'Beam Center Y',
+    'Beam Diameter X',
+    'Beam Diameter Y',
+    'Wavefront Min',
+    'Wavefront Max',
+    'Wavefront Peak-Valley',
+    'Wavefront Mean',
+    'Wavefront RMS',
+    'Wavefront Weighted RMS',
+    'Fourier M',
+    'Fourier J0',
+    'Fourier J45',
+    'Optometric Sphere',
+    'Optometric Cylinder',
+    'Optometric Axis Angle',
+    'Radius of Curvature',
+    'Fit Error Mean',
+    'Fit Error Std',
+)
+# Bookkeeping of every frame: the unix Timestamp of the trigger and the exposure set, then the
+# number of the trigger in the shot, the monotonic perf_counter() Host Time of its arrival, the
+# seconds spent on the capture thread and from there until saving, and the WFS_GetStatus bits
+FRAME_KEYS = ('Timestamp', 'Exposure Time', 'Master Gain',
+              'Trigger Index', 'Host Time', 'Capture Duration', 'Processing Duration', 'Device Status')
+# One row of the per-shot measurement table: the scalar results plus bookkeeping
+RECORD_DTYPE = np.dtype([(key, np.float64) for key in SCALAR_KEYS + FRAME_KEYS])
+# ctypes view of one row, so the SDK can write the scalar results straight into the table
+RECORD_CTYPE = np.ctypeslib.as_ctypes_type(RECORD_DTYPE)
+RECORD_OFFSETS = {name: RECORD_DTYPE.fields[name][1] for name in RECORD_DTYPE.names}
+# Name of the compound dataset holding the table
+RECORD_KEY = 'Measurements'
+# Stored arrays of a measurement: dataset name -> ShotBuffers attribute
+ARRAY_KEYS = {
+    'Wavefront': 'wavefrontStored',
+    'Zernikes Coefficients': 'zernikesStored',
+    'Zernikes RMS': 'zernikeRMSStored',
+    'Spot Deviations': 'deviationStored',
+    'Spot Intensities': 'intensityStored',
+}
+# Wavefront, Spot Deviations and Spot Intensities are stored cropped to
+# (rowStart, rowStop, columnStart, columnStop) of the full spot arrays
+CROP_ATTRS = ('Crop Row Start', 'Crop Row Stop', 'Crop Column Start', 'Crop Column Stop')
+FULL_CROP = (0, MAX_SPOTS_Y, 0, MAX_SPOTS_X)
+
+
+def crop_attrs(crop):
+    """Attributes of the image group recording which part of the spot arrays is stored."""
+    attrs = dict(zip(CROP_ATTRS, crop))
+    attrs['Spot Array Rows'] = MAX_SPOTS_Y
+    attrs['Spot Array Columns'] = MAX_SPOTS_X
+    return attrs
+
+def crop_from_attrs(attrs):
+    """Crop of the stored spot arrays; files written before cropping hold the full arrays."""
+    if CROP_ATTRS[0] not in attrs:
+        return FULL_CROP
+    return tuple(int(attrs[name]) for name in CROP_ATTRS)
+
+def uncrop(stored, crop, interleaved=False, fill=np.nan):
+    """Rebuild full MAX_SPOTS_Y x MAX_SPOTS_X spot arrays from cropped ones.
+
+    stored has the spot rows and columns as its last two axes, or as the two
+    before the last if interleaved (Spot Deviations, (..., rows, cols, 2)).
+    Spots outside the crop are set to fill."""
+    stored = np.asarray(stored)
+    if tuple(crop) == FULL_CROP:
+        return stored
+    rowStart, rowStop, colStart, colStop = crop
+    if interleaved:
+        full = np.full(stored.shape[:-3] + (MAX_SPOTS_Y, MAX_SPOTS_X) + stored.shape[-1:], fill, stored.dtype)
+        full[..., rowStart:rowStop, colStart:colStop, :] = stored
+    else:
+        full = np.full(stored.shape[:-2] + (MAX_SPOTS_Y, MAX_SPOTS_X), fill, stored.dtype)
+        full[..., rowStart:rowStop, colStart:colStop] = stored
+    return full
+
+
+class ShotBuffers(object):
+    """One slot of a ShotBufferPool: everything measured for a single trigger.
+
+    The pointer attributes are handed straight to the SDK so it fills the
+    arrays in place, and ref(key) is a by-reference argument pointing at one
+    field of the measurement's row in the pool's record table, so the SDK
+    writes the scalar results straight into the table as well. The remaining attributes
+    are views of the same memory in the layout that gets stored in the hdf5
+    file; slot[key] returns the stored value of any dataset name. The SDK
+    always writes full MAX_SPOTS_Y x MAX_SPOTS_X spot arrays, so those are
+    allocated in full and only the stored views are cropped, to crop =
+    (rowStart, rowStop, columnStart, columnStop).
+    """
+    __slots__ = ('index', 'record', 'row',
+                 'wavefront', 'deviations', 'intensity', 'zernikes', 'zernikeRMS',
+                 'wavefrontPtr', 'deviationXPtr', 'deviationYPtr', 'intensityPtr',
+                 'zernikesPtr', 'zernikeRMSPtr',
+                 'wavefrontStored', 'deviationStored', 'intensityStored', 'zernikesStored', 'zernikeRMSStored')
+
+    def __init__(self, index, records, row, wavefront, deviations, intensity, zernikes, zernikeRMS, zernikeOrder,
+                 crop=FULL_CROP):
+        self.index = index
+        self.record = records[row]
+        self.row = RECORD_CTYPE.from_buffer(records, row * RECORD_DTYPE.itemsize)
+        self.wavefront = wavefront
+        self.deviations = deviations # (2, y, x): x and y deviations as two contiguous planes
+        self.intensity = intensity
+        self.zernikes = zernikes
+        self.zernikeRMS = zernikeRMS
+
+        floatPtr = ct.POINTER(ct.c_float)
+        self.wavefrontPtr = wavefront.ctypes.data_as(floatPtr)
+        self.deviationXPtr = deviations[0].ctypes.data_as(floatPtr)
+        self.deviationYPtr = deviations[1].ctypes.data_as(floatPtr)
+        self.intensityPtr = intensity.ctypes.data_as(floatPtr)
+        self.zernikesPtr = zernikes.ctypes.data_as(floatPtr)
+        self.zernikeRMSPtr = zernikeRMS.ctypes.data_as(floatPtr)
+
+        rows, columns = slice(crop[0], crop[1]), slice(crop[2], crop[3])
+        self.wavefrontStored = wavefront[rows, columns]
+        self.intensityStored = intensity[rows, columns]
+        # Interleaved (y, x, 2) view of the deviation planes; no copy is made
+        self.deviationStored = np.moveaxis(deviations, 0, -1)[rows, columns]
+        # The SDK fills Zernike modes and orders from index 1
+        self.zernikesStored = zernikes[1:ZernikeOrderCount[zernikeOrder]+1]
+        self.zernikeRMSStored = zernikeRMS[1:zernikeOrder+1]
+
+    def ref(self, key):
+        """byref() of the record field key, for SDK output arguments."""
+        return ct.byref(ct.c_double.from_buffer(self.row, RECORD_OFFSETS[key]))
+
+    def clear(self, keys):
+        """Set the given record fields and stored arrays to NaN, for results not calculated this time."""
+        for key in keys:
+            if key in ARRAY_KEYS:
+                getattr(self, ARRAY_KEYS[key])[...] = np.nan
+            else:
+                self.record[key] = np.nan
+
+    def __getitem__(self, key):
+        if key in ARRAY_KEYS:
+            return getattr(self, ARRAY_KEYS[key])
+        elif key == RECORD_KEY:
+            return self.record
+        return self.record[key]
+
+
+class ShotBufferPool(object):
+    """Ring of preallocated measurement buffers shared with the WFS SDK.
+
+    Arrays and the record table are allocated in blocks, the first of
+    blockSize measurements and each further one as large as all before it,
+    so the capacity grows geometrically. acquire() hands out the next free
+    slot; when every slot of the current shot is in use another block is
+    allocated instead of overwriting data that has not been saved yet.
+    reset() rewinds the ring at the start of the next shot.
+
+    crop selects the part of the spot arrays that is stored, see ShotBuffers.
+
+    With recycle, slots given back with release() are handed out again, so
+    the pool only grows to the number of measurements in flight at once;
+    records() is then meaningless. Either way a slot's index is the number
+    of the measurement in the shot.
+    """
+    def __init__(self, zernikeOrder, blockSize=64, crop=FULL_CROP, recycle=False):
+        self.zernikeOrder = zernikeOrder
+        self.crop = tuple(crop)
+        self.blockSize = blockSize
+        self.recycle = recycle
+        self.free = deque()
+        self.slots = []
+        self.blockRecords = []
+        self.count = 0
+        self._add_block()
+
+    def _add_block(self):
+        n = max(self.blockSize, len(self.slots))
+        records = np.zeros(n, dtype=RECORD_DTYPE)
+        wavefront = np.zeros((n, MAX_SPOTS_Y, MAX_SPOTS_X), dtype=np.float32)
+        deviations = np.zeros((n, 2, MAX_SPOTS_Y, MAX_SPOTS_X), dtype=np.float32)
+        intensity = np.zeros((n, MAX_SPOTS_Y, MAX_SPOTS_X), dtype=np.float32)
+        zernikes = np.zeros((n, MAX_ZERNIKE_MODES+1), dtype=np.float32)
+        zernikeRMS = np.zeros((n, MAX_ZERNIKE_ORDERS+1), dtype=np.float32)
+        for i in range(n):
+            self.slots.append(ShotBuffers(len(self.slots), records, i, wavefront[i], deviations[i], intensity[i],
+                                          zernikes[i], zernikeRMS[i], self.zernikeOrder, self.crop))
+            if self.recycle:
+                self.free.append(self.slots[-1])
+        self.blockRecords.append(records)
+
+    def layout(self, skipped=()):
+        """Stored shape and dtype of everything saved per measurement, keyed by dataset name.
+
+        Datasets and record fields named in skipped are left out."""
+        slot = self.slots[0]
+        layout = {key: (slot[key].shape, slot[key].dtype) for key in ARRAY_KEYS if key not in skipped}
+        layout[RECORD_KEY] = ((), np.dtype([(name, np.float64) for name in RECORD_DTYPE.names if name not in skipped]))
+        return layout
+
+    def records(self):
+        """Record table of the measurements acquired so far this shot."""
+        return np.concatenate(self.blockRecords)[:self.count]
+
+    def nbytes(self):
+        """Memory held by the pool's arrays."""
+        slot = self.slots[0]
+        perSlot = sum(array.nbytes for array in (slot.wavefront, slot.deviations, slot.intensity,
+                                                 slot.zernikes, slot.zernikeRMS))
+        return len(self.slots) * (perSlot + RECORD_DTYPE.itemsize)
+
+    def reset(self):
+        self.count = 0
+        for records in self.blockRecords:
+            records.fill(0)
+        if self.recycle:
+            self.free = deque(self.slots)
+
+    def acquire(self):
+        if self.recycle:
+            if not self.free:
+                self._add_block()
+            slot = self.free.popleft()
+        else:
+            if self.count == len(self.slots):
+                self._add_block()
+            slot = self.slots[self.count]
+        slot.index = self.count
+        self.count += 1
+        return slot
+
+    def release(self, slot):
+        """Give a slot back once its measurement is no longer needed; only with recycle."""
+        if self.recycle:
+            self.free.append(slot)
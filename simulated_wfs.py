@@ -0,0 +1,438 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/ThorlabsWaveFrontSensor/simulated_wfs.py       #
+#                                                                   #
+# This file is part of labscript_devices                            #
+#                                                                   #
+#####################################################################
+import ctypes as ct
+from collections import deque
+from math import atan2, degrees, sqrt
+from time import perf_counter, sleep
+import numpy as np
+
+from labscript_devices.ThorlabsWaveFrontSensor.shot_buffers import (
+    MAX_SPOTS_X,
+    MAX_SPOTS_Y,
+    MAX_ZERNIKE_ORDERS,
+    MAX_ZERNIKE_MODES,
+    ZernikeOrderCount,
+)
+from labscript_devices.ThorlabsWaveFrontSensor.zernike import (
+    SpotGeometry,
+    ZernikeFitter,
+    pupil_coordinates,
+    zernike,
+    zernike_modes,
+)
+from labscript_devices.ThorlabsWaveFrontSensor.trigger_wait import (
+    WFS_ERROR_AWAITING_TRIGGER,
+    WFS_STATBIT_ATR,
+)
+
+
+# Camera resolutions of a WFS30 by camResolIndex, as (columns, rows, pixel pitch in units of the
+# sensor pixel); the sub2 modes sample every other pixel of the same sensor area
+WFS30_RESOLUTIONS = [
+    (1936, 1216, 1), (1216, 1216, 1), (1024, 1024, 1), (768, 768, 1), (512, 512, 1), (360, 360, 1),
+    (968, 608, 2), (608, 608, 2), (512, 512, 2), (384, 384, 2), (256, 256, 2), (180, 180, 2),
+]
+# Serial numbers of the simulated heads every SimulatedWFS finds connected, besides its own
+SIMULATED_SERIALS = ('M00000000', 'M00000001', 'M00000002', 'M00000003')
+# VI_ERROR_RSRC_NFOUND, returned by WFS_init for a resource that is not connected
+WFS_ERROR_RESOURCE_NOT_FOUND = -1073807343
+SENSOR_PITCH_UM = 5.5
+LENSLET_PITCH_UM = 150.
+LENSLET_FOCAL_UM = 3700.
+SPOT_SIGMA_UM = 12. # Spot size on the camera
+SPOT_PEAK = 200 # Counts at the centre of the beam
+NOISE_FRAMES = 8 # Read noise fields cycled through by WFS_GetSpotfieldImageCopy
+
+
+def _ref(arg):
+    """Return the ctypes object behind a byref() argument."""
+    return getattr(arg, '_obj', arg)
+
+def _value(arg):
+    """Value of an input argument, passed as a ctypes object, by reference or as a plain number."""
+    arg = _ref(arg)
+    return getattr(arg, 'value', arg)
+
+def _array(ptr, shape):
+    """Writable float32 view of the memory behind an array pointer argument.
+
+    The SDK arrays are all ViReal32, whatever pointer type the caller cast to.
+    """
+    return np.ctypeslib.as_array(ct.cast(ptr, ct.POINTER(ct.c_float)), shape=shape)
+
+
+class SimulatedWFS(object):
+    """Stand-in for the WFS_64.dll function table.
+
+    Every WFS_* call used by ThorlabsWaveFrontSensorWorker is implemented with
+    the same calling convention as the SDK (ctypes objects passed by reference,
+    arrays passed as pointers), so the worker code runs unchanged.
+
+    The beam is a wavefront made of the Zernike coefficients zernikes (um, a
+    dict keyed by WFS mode number, Z4 astigmatism 45, Z5 defocus, ...) over the
+    pupil set with WFS_SetPupil. Every frame the spot deviations are the
+    gradient of that wavefront across the lenslets, in camera pixels, plus
+    Gaussian noise of noise pixels; the wavefront, Zernike fit, fit error and
+    optometric values are then calculated from those deviations. The Zernike
+    fit is zernike.ZernikeFitter itself, so comparing the two says nothing
+    about either; tests/test_zernike.py checks the fitter against closed-form
+    polynomials instead.
+
+    WFS_ConfigureCam sets the spot grid to the number of lenslets covering
+    the selected camera resolution of a WFS30 (WFS30_RESOLUTIONS); until it is
+    called the grid is spotsX x spotsY.
+
+    In continuous trigger mode (0, the default) every image call returns a
+    frame straight away. In any other trigger mode frames are only returned
+    for triggers queued with schedule_triggers() or schedule_periodic(); until
+    the next one is due the image calls return WFS_ERROR_AWAITING_TRIGGER and
+    WFS_GetStatus reports WFS_STATBIT_ATR. Triggers that come while the
+    worker is busy are kept and returned by the next image call, unless
+    dropUnarmed is set: then the camera is only armed by the first image call
+    after a frame, and triggers before that are lost (counted in
+    droppedTriggers). capturedTriggers holds the time of the trigger of every
+    frame returned.
+
+    WFS_GetInstrumentListLen lists the SIMULATED_SERIALS heads, taking
+    enumerateTime seconds per head like a USB scan. WFS_init takes initTime
+    seconds and fails for resources of heads that are not listed;
+    WFS_GetMlaData takes mlaDataTime seconds.
+
+    WFS_TakeSpotfieldImageAutoExpos spends autoExposureTime seconds on its
+    exposure search; WFS_TakeSpotfieldImage uses the exposure time and gain
+    set with WFS_SetExposureTime and WFS_SetMasterGain.
+
+    WFS_GetSpotfieldImageCopy returns an 8-bit image of the configured
+    resolution: a Gaussian spot under every lenslet, displaced by the spot
+    deviations of the frame, in a Gaussian beam the size of the pupil, plus
+    Poisson read noise of about readNoise counts.
+    """
+    # Set on the class, as the worker creates its SimulatedWFS itself
+    enumerateTime = 0.
+    initTime = 0.
+    mlaDataTime = 0.
+
+    def __init__(self, serialNum='M00000000', spotsX=40, spotsY=30, seed=0, calcTime=0.,
+                 zernikes=None, noise=0.05, configureTime=0., autoExposureTime=0., readNoise=2.):
+        self.serialNum = serialNum
+        self.calcTime = calcTime # seconds spent in WFS_CalcSpotsCentrDiaIntens, like the SDK without holding the GIL
+        self.configureTime = configureTime # seconds spent in WFS_ConfigureCam
+        self.autoExposureTime = autoExposureTime # seconds spent searching in WFS_TakeSpotfieldImageAutoExpos
+        self.exposureTime = 1. # ms
+        self.masterGain = 1.
+        self.spotsX = spotsX
+        self.spotsY = spotsY
+        self.zernikes = dict(zernikes or {})
+        self.noise = noise
+        self.readNoise = readNoise
+        self.resolution = WFS30_RESOLUTIONS[0]
+        self.spotImage = None # Noise free spotfield of the current resolution and pupil
+        self.noiseFields = None
+        self.images = 0
+        self.pupil = (0., 0., 3., 3.)
+        self.rng = np.random.default_rng(seed)
+        self.fitter = ZernikeFitter()
+        self.deviations = np.zeros((2, MAX_SPOTS_Y, MAX_SPOTS_X), dtype=np.float32)
+        self.pattern = None # Noise free (deviations, wavefront) of the current geometry
+        self.wavefront = np.zeros(0) # Wavefront inside the pupil, from WFS_CalcWavefront
+        self.fit = None # Zernike order and coefficients fitted to the current frame
+        self.triggerMode = 0
+        self.triggerTimes = deque()
+        self.lastTriggerTime = None
+        self.dropUnarmed = False
+        self.armed = False
+        self.droppedTriggers = 0
+        self.capturedTriggers = []
+
+    def schedule_triggers(self, times):
+        """Queue synthetic triggers at the given perf_counter() times."""
+        self.triggerTimes.extend(times)
+
+    def schedule_periodic(self, period, count, start=None):
+        """Queue count triggers period seconds apart, the first one period after start (default: now)."""
+        start = perf_counter() if start is None else start
+        self.schedule_triggers(start + period*(1 + np.arange(count)))
+
+    def _awaiting_trigger(self):
+        return self.triggerMode != 0 and not (self.triggerTimes and self.triggerTimes[0] <= perf_counter())
+
+    def _take_image(self):
+        if self.triggerMode != 0 and self.dropUnarmed and not self.armed:
+            self.armed = True
+            armedAt = perf_counter()
+            while self.triggerTimes and self.triggerTimes[0] < armedAt:
+                self.triggerTimes.popleft()
+                self.droppedTriggers += 1
+        if self._awaiting_trigger():
+            return WFS_ERROR_AWAITING_TRIGGER
+        if self.triggerMode != 0:
+            self.lastTriggerTime = self.triggerTimes.popleft()
+            self.capturedTriggers.append(self.lastTriggerTime)
+            self.armed = False
+        return 0
+
+    def geometry(self):
+        return SpotGeometry(self.spotsX, self.spotsY, LENSLET_PITCH_UM, SENSOR_PITCH_UM, LENSLET_FOCAL_UM,
+                            *self.pupil)
+
+    def _pattern(self):
+        """Spot deviations (pixels) and wavefront (um) of the configured aberration, without noise."""
+        if self.pattern is None:
+            geometry = self.geometry()
+            u, v, mask = pupil_coordinates(geometry)
+            wavefront = np.zeros_like(u)
+            slopeX = np.zeros_like(u)
+            slopeY = np.zeros_like(u)
+            modes = zernike_modes(MAX_ZERNIKE_ORDERS)
+            for mode, coefficient in self.zernikes.items():
+                Z, dZdu, dZdv = zernike(*modes[mode-1], u, v)
+                wavefront += coefficient * Z
+                slopeX += coefficient * dZdu / (5e2*geometry.pupilDiameterXMm)
+                slopeY += coefficient * dZdv / (5e2*geometry.pupilDiameterYMm)
+            pixelsPerSlope = geometry.lensletFocalUm / geometry.camPitchUm
+            self.pattern = (pixelsPerSlope * np.stack([slopeX, slopeY]), wavefront, mask)
+        return self.pattern
+
+    def _spotfield(self):
+        """Noise free spotfield image of the current frame, and read noise fields of the same size.
+
+        Every lenslet of the spot grid images a Gaussian spot at its centre plus the spot deviation
+        of the frame, with the beam profile as amplitude; see centroiding.py for the lenslet centres."""
+        if self.spotImage is None:
+            columns, rows, binning = self.resolution
+            pixelUm = binning * SENSOR_PITCH_UM
+            pitch = LENSLET_PITCH_UM / pixelUm
+            sigma = SPOT_SIGMA_UM / pixelUm
+            radius = int(np.ceil(4*sigma))
+            centerX = columns/2. + (np.arange(self.spotsX) - (self.spotsX-1)/2.) * pitch
+            centerY = rows/2. + (np.arange(self.spotsY) - (self.spotsY-1)/2.) * pitch
+            # Deviations are in sensor pixels
+            spotX = centerX + self.deviations[0, :self.spotsY, :self.spotsX] / binning
+            spotY = centerY[:, None] + self.deviations[1, :self.spotsY, :self.spotsX] / binning
+            pupilCenterX, pupilCenterY, diameterX, diameterY = self.pupil
+            beam = np.exp(-((spotX - columns/2.)*pixelUm - 1e3*pupilCenterX)**2 / (2*(5e2*diameterX)**2)
+                          - ((spotY - rows/2.)*pixelUm - 1e3*pupilCenterY)**2 / (2*(5e2*diameterY)**2))
+            pixels = np.arange(-radius, radius + 1)
+            # Patches of the spots, cut out of an image padded by radius on every side
+            firstX = np.floor(spotX).astype(int)[..., None] + pixels
+            firstY = np.floor(spotY).astype(int)[..., None] + pixels
+            profileX = np.exp(-(firstX + 0.5 - spotX[..., None])**2 / (2*sigma**2))
+            profileY = np.exp(-(firstY + 0.5 - spotY[..., None])**2 / (2*sigma**2))
+            patches = SPOT_PEAK * beam[..., None, None] * profileY[..., :, None] * profileX[..., None, :]
+            image = np.zeros((rows + 2*radius, columns + 2*radius), dtype=np.float32)
+            image[np.clip(firstY + radius, 0, rows + 2*radius - 1)[..., :, None],
+                  np.clip(firstX + radius, 0, columns + 2*radius - 1)[..., None, :]] = patches
+            self.spotImage = np.round(image[radius:-radius, radius:-radius]).astype(np.uint8)
+            if self.noiseFields is None or self.noiseFields.shape[1:] != self.spotImage.shape:
+                self.noiseFields = self.rng.poisson(self.readNoise, (NOISE_FRAMES,) + self.spotImage.shape).astype(np.uint8)
+        return self.spotImage, self.noiseFields
+
+    def _instruments(self):
+        return SIMULATED_SERIALS + ((self.serialNum,) if self.serialNum not in SIMULATED_SERIALS else ())
+
+    def WFS_GetInstrumentListLen(self, resource, count):
+        instruments = self._instruments()
+        if self.enumerateTime:
+            sleep(self.enumerateTime * len(instruments))
+        _ref(count).value = len(instruments)
+        return 0
+
+    def WFS_GetInstrumentListInfo(self, resource, index, deviceID, inUse,
+                                  instrumentName, instrumentSN, resourceName):
+        serial = self._instruments()[_value(index)]
+        _ref(deviceID).value = 0x400
+        _ref(inUse).value = 0
+        instrumentName.value = b'WFS30-7AR'
+        instrumentSN.value = serial.encode()
+        resourceName.value = ('USB::SIMULATED::' + serial).encode()
+        return 0
+
+    def WFS_init(self, resourceName, IDQuery, resetDevice, instrumentHandle):
+        if self.initTime:
+            sleep(self.initTime)
+        if resourceName.value.decode() not in ['USB::SIMULATED::' + serial for serial in self._instruments()]:
+            return WFS_ERROR_RESOURCE_NOT_FOUND
+        _ref(instrumentHandle).value = 1
+        return 0
+
+    def WFS_close(self, instrumentHandle):
+        return 0
+
+    def WFS_error_message(self, instrumentHandle, errorCode, errorMessage):
+        errorMessage.value = ('Simulated error %d' % _value(errorCode)).encode()
+        return 0
+
+    def WFS_SetTriggerMode(self, instrumentHandle, triggerMode):
+        self.triggerMode = _value(triggerMode)
+        return 0
+
+    def WFS_SelectMla(self, instrumentHandle, mlaIndex):
+        return 0
+
+    def WFS_GetMlaData(self, instrumentHandle, mlaIndex, mlaName, camPitchUm, lensletPitchUm,
+                       spotOffsetX, spotOffsetY, lensletFUm, grdCorr0, grdCorr45):
+        if self.mlaDataTime:
+            sleep(self.mlaDataTime)
+        mlaName.value = b'MLA150-5C'
+        _ref(camPitchUm).value = SENSOR_PITCH_UM
+        _ref(lensletPitchUm).value = LENSLET_PITCH_UM
+        _ref(spotOffsetX).value = 0.
+        _ref(spotOffsetY).value = 0.
+        _ref(lensletFUm).value = LENSLET_FOCAL_UM
+        _ref(grdCorr0).value = 0.
+        _ref(grdCorr45).value = 0.
+        return 0
+
+    def WFS_ConfigureCam(self, instrumentHandle, pixelFormat, camResolIndex, spotsX, spotsY):
+        if self.configureTime:
+            sleep(self.configureTime)
+        self.resolution = WFS30_RESOLUTIONS[_value(camResolIndex)]
+        columns, rows, binning = self.resolution
+        self.spotImage = None
+        lensletPixels = LENSLET_PITCH_UM / (binning * SENSOR_PITCH_UM)
+        self.spotsX = min(int(columns / lensletPixels), MAX_SPOTS_X)
+        self.spotsY = min(int(rows / lensletPixels), MAX_SPOTS_Y)
+        self.deviations[:] = 0
+        self.pattern = None
+        _ref(spotsX).value = self.spotsX
+        _ref(spotsY).value = self.spotsY
+        return 0
+
+    def WFS_SetReferencePlane(self, instrumentHandle, refInternal):
+        return 0
+
+    def WFS_SetPupil(self, instrumentHandle, centerX, centerY, diameterX, diameterY):
+        self.pupil = tuple(_value(value) for value in (centerX, centerY, diameterX, diameterY))
+        self.pattern = None
+        self.spotImage = None
+        return 0
+
+    def WFS_GetStatus(self, instrumentHandle, status):
+        _ref(status).value = WFS_STATBIT_ATR if self._awaiting_trigger() else 0
+        return 0
+
+    def WFS_SetExposureTime(self, instrumentHandle, exposureTimeSet, exposureTimeAct):
+        self.exposureTime = _value(exposureTimeSet)
+        _ref(exposureTimeAct).value = self.exposureTime
+        return 0
+
+    def WFS_SetMasterGain(self, instrumentHandle, masterGainSet, masterGainAct):
+        self.masterGain = _value(masterGainSet)
+        _ref(masterGainAct).value = self.masterGain
+        return 0
+
+    def WFS_TakeSpotfieldImage(self, instrumentHandle):
+        return self._take_image()
+
+    def WFS_TakeSpotfieldImageAutoExpos(self, instrumentHandle, exposureTimeAct, masterGainAct):
+        devStatus = self._take_image()
+        if devStatus == 0 and self.autoExposureTime:
+            sleep(self.autoExposureTime)
+        self.exposureTime = self.masterGain = 1.
+        _ref(exposureTimeAct).value = self.exposureTime
+        _ref(masterGainAct).value = self.masterGain
+        return devStatus
+
+    def WFS_GetSpotfieldImageCopy(self, instrumentHandle, imageBuf, rows, columns):
+        spotImage, noiseFields = self._spotfield()
+        image = np.ctypeslib.as_array(ct.cast(imageBuf, ct.POINTER(ct.c_uint8)), shape=(spotImage.size,))
+        np.add(spotImage.ravel(), noiseFields[self.images % NOISE_FRAMES].ravel(), out=image)
+        self.images += 1
+        _ref(rows).value, _ref(columns).value = spotImage.shape
+        return 0
+
+    def WFS_CalcSpotsCentrDiaIntens(self, instrumentHandle, dynamicNoiseCut, calculateDiameters):
+        if self.calcTime:
+            sleep(self.calcTime)
+        deviations, _, _ = self._pattern()
+        self.deviations[:, :self.spotsY, :self.spotsX] = deviations + self.rng.normal(
+            0, self.noise, deviations.shape)
+        self.fit = None
+        self.spotImage = None
+        return 0
+
+    def WFS_CalcBeamCentroidDia(self, instrumentHandle, centroidX, centroidY, diameterX, diameterY):
+        _ref(centroidX).value = self.pupil[0]
+        _ref(centroidY).value = self.pupil[1]
+        _ref(diameterX).value = self.pupil[2]
+        _ref(diameterY).value = self.pupil[3]
+        return 0
+
+    def WFS_CalcSpotToReferenceDeviations(self, instrumentHandle, cancelWavefrontTilt):
+        return 0
+
+    def WFS_GetSpotDeviations(self, instrumentHandle, deviationX, deviationY):
+        _array(deviationX, (MAX_SPOTS_Y, MAX_SPOTS_X))[:] = self.deviations[0]
+        _array(deviationY, (MAX_SPOTS_Y, MAX_SPOTS_X))[:] = self.deviations[1]
+        return 0
+
+    def WFS_GetSpotIntensities(self, instrumentHandle, intensity):
+        _array(intensity, (MAX_SPOTS_Y, MAX_SPOTS_X))[:self.spotsY, :self.spotsX] = 1.
+        return 0
+
+    def WFS_CalcWavefront(self, instrumentHandle, wavefrontType, limitToPupil, wavefront):
+        _, pattern, mask = self._pattern()
+        wavefrontArray = _array(wavefront, (MAX_SPOTS_Y, MAX_SPOTS_X))
+        wavefrontArray[:self.spotsY, :self.spotsX] = pattern
+        if _value(limitToPupil):
+            wavefrontArray[:self.spotsY, :self.spotsX][~mask] = np.nan
+        self.wavefront = wavefrontArray[:self.spotsY, :self.spotsX][mask]
+        return 0
+
+    def WFS_CalcWavefrontStatistics(self, instrumentHandle, minimum, maximum, diff, mean, rms, weightedRms):
+        wavefront = self.wavefront if len(self.wavefront) else np.zeros(1)
+        _ref(minimum).value = wavefront.min()
+        _ref(maximum).value = wavefront.max()
+        _ref(diff).value = wavefront.max() - wavefront.min()
+        _ref(mean).value = wavefront.mean()
+        _ref(rms).value = wavefront.std()
+        _ref(weightedRms).value = wavefront.std()
+        return 0
+
+    def _zernike_fit(self, order):
+        if self.fit is None or self.fit[0] != order:
+            deviations = np.moveaxis(self.deviations, 0, -1)
+            self.fit = (order, self.fitter.fit(deviations, self.geometry(), order))
+        return self.fit[1]
+
+    def WFS_CalcFourierOptometric(self, instrumentHandle, zernikeOrder, fourierOrder,
+                                  fourierM, fourierJ0, fourierJ45, optoSphere, optoCylinder, optoAxisDeg):
+        coefficients = self._zernike_fit(_value(zernikeOrder))
+        radiusMm = (self.pupil[2] + self.pupil[3]) / 4
+        # Power vector in diopters from the second order terms, Z4 astigmatism 45, Z5 defocus, Z6 astigmatism 0
+        M = -4*sqrt(3) * coefficients[4] / radiusMm**2
+        J0 = -2*sqrt(6) * coefficients[5] / radiusMm**2
+        J45 = -2*sqrt(6) * coefficients[3] / radiusMm**2
+        cylinder = 2*sqrt(J0**2 + J45**2)
+        _ref(fourierM).value = M
+        _ref(fourierJ0).value = J0
+        _ref(fourierJ45).value = J45
+        _ref(optoSphere).value = M + cylinder/2
+        _ref(optoCylinder).value = -cylinder
+        _ref(optoAxisDeg).value = degrees(atan2(J45, J0)) / 2 % 180
+        return 0
+
+    def WFS_ZernikeLsf(self, instrumentHandle, zernikeOrder, zernikes, zernikeRMS, radiusOfCurvature):
+        order = _value(zernikeOrder)
+        coefficients = self._zernike_fit(order)
+        basis = self.fitter.basis(self.geometry(), order)
+        _array(zernikes, (MAX_ZERNIKE_MODES+1,))[1:ZernikeOrderCount[order]+1] = coefficients
+        _array(zernikeRMS, (MAX_ZERNIKE_ORDERS+1,))[1:order+1] = basis.order_rms(coefficients)
+        _ref(radiusOfCurvature).value = basis.radius_of_curvature(coefficients)
+        return 0
+
+    def WFS_CalcReconstrDeviations(self, instrumentHandle, zernikeOrder, reconstructSelect,
+                                   doSphericalReference, fitErrMean, fitErrStdev):
+        order = _value(zernikeOrder)
+        basis = self.fitter.basis(self.geometry(), order)
+        coefficients = self._zernike_fit(order)
+        residual = basis.slopes(np.moveaxis(self.deviations, 0, -1)) - basis.matrix @ coefficients[1:]
+        residual /= basis.slopeScale
+        _ref(fitErrMean).value = np.abs(residual).mean()
+        _ref(fitErrStdev).value = residual.std()
+        return 0
@@ -0,0 +1,291 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/ThorlabsWaveFrontSensor/spotfield.py           #
+#                                                                   #
+# This file is part of labscript_devices                            #
+#                                                                   #
+#####################################################################
+"""Raw spotfield images, saved next to the derived results.
+
+With spotfieldImages set, the capture thread copies the 8-bit camera image
+of every trigger with WFS_GetSpotfieldImageCopy, so a shot can be
+reprocessed when a fit setting was wrong. The SDK copies into one full size
+buffer; the window kept, the whole image or a crop of spotfieldCrop pixels
+centred on the beam centroid from WFS_CalcBeamCentroidDia, is copied from
+there into a preallocated ring of uint8 frames. A writer thread compresses
+the ring frames, one deflate chunk per frame (zlib releases the GIL), and
+appends them with direct chunk writes to
+
+    <image group>/SPOTFIELD_KEY/SPOTFIELD_KEY    uint8, frames x rows x columns
+    <image group>/SPOTFIELD_KEY/WINDOW_KEY       measurement index and window corner
+
+The ring holds ringSize frames; if the writer falls that far behind, the
+capture thread waits for it.
+
+With spotfieldDelta, frames are stored as their difference to the previous
+frame, modulo 256, except every keyframeInterval-th frame, which is stored
+as it is. A spot that does not move becomes runs of zeros, which deflate
+compresses better than the noise floor of the raw image. read_spotfield()
+undoes the encoding; it is lossless either way.
+"""
+import ctypes as ct
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from threading import Lock, Thread
+from time import perf_counter
+import numpy as np
+
+from labscript_devices.ThorlabsWaveFrontSensor.h5_writer import StorageCodec
+
+# Largest image of any WFS camera; WFS_GetSpotfieldImageCopy needs a buffer this large
+MAX_IMAGE_ROWS = 2048
+MAX_IMAGE_COLUMNS = 2048
+# Group in the image group holding the images
+SPOTFIELD_KEY = 'Spotfield'
+WINDOW_KEY = 'Window'
+WINDOW_DTYPE = np.dtype([('Frame', np.int32), ('Row', np.int32), ('Column', np.int32)])
+KEYFRAME_INTERVAL = 64
+DEFAULT_LEVEL = 1
+
+
+def pixel_pitch(camPitchUm, lensletPitchUm, spotsX, columns):
+    """Pitch (um) of the image pixels; twice the sensor pitch in the binned and subsampled resolutions.
+
+    The SDK does not report the binning, but the spots across the image span about
+    its width, so the ratio of the two sizes is 1 or 2."""
+    if not (spotsX and columns and camPitchUm):
+        return camPitchUm
+    binning = max(1, int(round(spotsX * lensletPitchUm / (columns * camPitchUm))))
+    return binning * camPitchUm
+
+
+def beam_window(centerXMm, centerYMm, rows, columns, pixelPitchUm, shape):
+    """(row, column) of the top left corner of the window of the given shape centred on the beam.
+
+    The beam centroid is in mm from the centre of the image; the window is
+    moved inside the image if it sticks out, and centred on the image if the
+    centroid is NaN (not calculated for this frame) or the pitch unknown."""
+    height, width = shape
+    centerRow, centerColumn = rows / 2., columns / 2.
+    if np.isfinite(centerXMm) and np.isfinite(centerYMm) and np.isfinite(pixelPitchUm):
+        centerColumn += 1e3 * centerXMm / pixelPitchUm
+        centerRow += 1e3 * centerYMm / pixelPitchUm
+    row = min(max(int(round(centerRow - height / 2.)), 0), rows - height)
+    column = min(max(int(round(centerColumn - width / 2.)), 0), columns - width)
+    return row, column
+
+
+def read_spotfield(group, start=0, stop=None):
+    """(images, window) of the measurements start:stop saved in group, an image group.
+
+    images are the decoded uint8 frames and window the rows of WINDOW_KEY
+    for them. Delta encoded frames are decoded from the last keyframe before
+    start."""
+    spotfield = group[SPOTFIELD_KEY]
+    dataset = spotfield[SPOTFIELD_KEY]
+    stop = len(dataset) if stop is None else min(stop, len(dataset))
+    window = spotfield[WINDOW_KEY][start:stop]
+    if not spotfield.attrs.get('Delta Encoded', False):
+        return dataset[start:stop], window
+    keyframeInterval = int(spotfield.attrs['Keyframe Interval'])
+    first = start - start % keyframeInterval
+    images = dataset[first:stop]
+    # Each keyframe restarts the running sum; uint8 arithmetic wraps like the encoding did
+    for keyframe in range(0, len(images), keyframeInterval):
+        block = images[keyframe:keyframe + keyframeInterval]
+        np.cumsum(block, axis=0, dtype=np.uint8, out=block)
+    return images[start - first:], window
+
+
+class SpotfieldRecorder(object):
+    """Copies, crops and saves the spotfield image of every measurement of one shot.
+
+    The capture thread calls WFS_GetSpotfieldImageCopy with imagePtr, rows
+    and columns, then put(frame, centerXMm, centerYMm) with the measurement
+    index and the beam centroid. crop is the window size in pixels, an int
+    or (rows, columns), or None for the whole image. The centroid is
+    converted to pixels with geometry, a zernike.SpotGeometry, see
+    pixel_pitch(); without it the window is centred on the image. The frames
+    are compressed with codec, a gzip or uncompressed StorageCodec, using
+    its threads if it has any. fileLock serialises the file access with the
+    StreamingShotWriter of the shot, which writes to the same file from its
+    own thread.
+
+    If a stage_timing.StageTimer is given, the time of each batch write is
+    recorded, shared equally, as the 'Spotfield Write' stage of its frames.
+    """
+    enabled = True
+
+    def __init__(self, h5_filepath, groupPath, crop=None, delta=False, geometry=None,
+                 codec=None, keyframeInterval=KEYFRAME_INTERVAL, ringSize=32, flushSize=16,
+                 fileLock=None, timer=None):
+        self.h5_filepath = h5_filepath
+        self.groupPath = groupPath
+        if crop is not None and np.ndim(crop) == 0:
+            crop = (crop, crop)
+        self.crop = None if crop is None else tuple(int(size) for size in crop)
+        self.delta = bool(delta)
+        self.geometry = geometry
+        self.pixelPitchUm = np.nan
+        self.codec = codec if codec is not None else StorageCodec('gzip', DEFAULT_LEVEL)
+        if self.codec.codec not in ('gzip', None) or self.codec.shuffle:
+            raise ValueError('spotfield images are stored with gzip or uncompressed, without shuffle')
+        self.keyframeInterval = keyframeInterval
+        self.ringSize = ringSize
+        self.flushSize = flushSize
+        self.fileLock = fileLock if fileLock is not None else Lock()
+        self.timer = timer
+        # Filled by WFS_GetSpotfieldImageCopy
+        self.image = np.zeros(MAX_IMAGE_ROWS * MAX_IMAGE_COLUMNS, dtype=np.uint8)
+        self.imagePtr = self.image.ctypes.data_as(ct.POINTER(ct.c_uint8))
+        self.rows = ct.c_int32()
+        self.columns = ct.c_int32()
+        self.ring = None # Allocated by the first put(), once the image size is known
+        self.free = Queue()
+        self.queue = Queue()
+        self.previous = None
+        self.imageShape = None
+        self.count = 0
+        self.error = None
+        self.thread = None
+        self.encoders = None
+
+    def start(self):
+        if self.codec.threads:
+            self.encoders = ThreadPoolExecutor(self.codec.threads)
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def nbytes(self):
+        return self.image.nbytes + (self.ring.nbytes if self.ring is not None else 0)
+
+    def put(self, frame, centerXMm=np.nan, centerYMm=np.nan):
+        """Queue the window of the image just copied by WFS_GetSpotfieldImageCopy for saving."""
+        rows, columns = self.rows.value, self.columns.value
+        image = self.image[:rows*columns].reshape(rows, columns)
+        if self.ring is None:
+            self.imageShape = (rows, columns)
+            if self.geometry is not None:
+                self.pixelPitchUm = pixel_pitch(self.geometry.camPitchUm, self.geometry.lensletPitchUm,
+                                                self.geometry.spotsX, columns)
+            shape = (rows, columns) if self.crop is None else (min(self.crop[0], rows), min(self.crop[1], columns))
+            self.ring = np.empty((self.ringSize,) + shape, dtype=np.uint8)
+            for slot in range(self.ringSize):
+                self.free.put(slot)
+        elif (rows, columns) != self.imageShape:
+            raise ValueError('spotfield image size changed during the shot')
+        height, width = self.ring.shape[1:]
+        if (height, width) == (rows, columns):
+            row = column = 0
+        else:
+            row, column = beam_window(centerXMm, centerYMm, rows, columns, self.pixelPitchUm, (height, width))
+        slot = self.free.get() # Waits for the writer if the ring is full
+        self.ring[slot] = image[row:row+height, column:column+width]
+        self.queue.put((frame, slot, row, column))
+
+    def close(self):
+        """Write out everything still queued and stop the writer thread.
+
+        Returns the number of images written to the file."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.encoders is not None:
+            self.encoders.shutdown()
+            self.encoders = None
+        if self.error is not None:
+            raise self.error
+        return self.count
+
+    def _run(self):
+        finished = False
+        while not finished:
+            batch = [self.queue.get()]
+            while len(batch) < self.flushSize:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            if batch[-1] is None:
+                finished = True
+                batch.pop()
+            if not batch:
+                continue
+            if self.error is None:
+                try:
+                    self._write(batch)
+                except Exception as e:
+                    # Keep draining the queue so put() never blocks forever; report in close()
+                    self.error = e
+            for frame, slot, row, column in batch:
+                self.free.put(slot)
+
+    def _payload(self, index, slot):
+        """Image number index of the shot as it is stored: the window itself, or its difference to the previous one."""
+        frame = self.ring[slot]
+        if not self.delta:
+            return frame
+        if index % self.keyframeInterval == 0:
+            payload = frame.copy()
+        else:
+            payload = np.subtract(frame, self.previous)
+        self.previous = frame.copy()
+        return payload
+
+    def _write(self, batch):
+        import h5py
+        begin = perf_counter()
+        start = self.count
+        stop = start + len(batch)
+        payloads = [self._payload(index, slot) for index, (frame, slot, row, column) in enumerate(batch, start)]
+        if self.encoders is not None:
+            chunks = [self.encoders.submit(self.codec.encode, payload) for payload in payloads]
+        else:
+            chunks = [self.codec.encode(payload) for payload in payloads]
+        window = np.array([(frame, row, column) for frame, slot, row, column in batch], dtype=WINDOW_DTYPE)
+        with self.fileLock, h5py.File(self.h5_filepath, 'r+') as f:
+            group = f[self.groupPath]
+            if start == 0:
+                self._create(group)
+            spotfield = group[SPOTFIELD_KEY]
+            dataset = spotfield[SPOTFIELD_KEY]
+            dataset.resize(stop, axis=0)
+            for frame, chunk in zip(range(start, stop), chunks):
+                data, filterMask = chunk.result() if self.encoders is not None else chunk
+                dataset.id.write_direct_chunk((frame, 0, 0), data, filterMask)
+            dataset = spotfield[WINDOW_KEY]
+            dataset.resize(stop, axis=0)
+            dataset[start:stop] = window
+        self.count = stop
+        if self.timer is not None:
+            seconds = (perf_counter() - begin) / len(batch)
+            for frame, slot, row, column in batch:
+                self.timer.record(frame, 'Spotfield Write', seconds)
+
+    def _create(self, group):
+        if SPOTFIELD_KEY in group:
+            del group[SPOTFIELD_KEY]
+        spotfield = group.create_group(SPOTFIELD_KEY)
+        spotfield.attrs['Image Rows'], spotfield.attrs['Image Columns'] = self.imageShape
+        spotfield.attrs['Pixel Pitch'] = self.pixelPitchUm
+        spotfield.attrs['Delta Encoded'] = self.delta
+        spotfield.attrs['Keyframe Interval'] = self.keyframeInterval
+        shape = self.ring.shape[1:]
+        spotfield.create_dataset(SPOTFIELD_KEY, shape=(0,) + shape, dtype=np.uint8, maxshape=(None,) + shape,
+                                 chunks=(1,) + shape, **self.codec.options)
+        spotfield.create_dataset(WINDOW_KEY, shape=(0,), dtype=WINDOW_DTYPE, maxshape=(None,), chunks=(1024,))
+
+
+class NullSpotfieldRecorder(object):
+    """SpotfieldRecorder that records nothing."""
+    enabled = False
+
+    def start(self):
+        pass
+
+    def put(self, frame, centerXMm=np.nan, centerYMm=np.nan):
+        pass
+
+    def close(self):
+        return 0
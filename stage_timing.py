@@ -0,0 +1,148 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/ThorlabsWaveFrontSensor/stage_timing.py        #
+#                                                                   #
+# This file is part of labscript_devices                            #
+#                                                                   #
+#####################################################################
+"""Per-frame timing of the stages of the acquisition loop.
+
+The capture thread calls start(frame) when it begins a measurement and
+lap(stage) after every step, which books the time since the previous lap to
+that stage. Stages run on other threads (saving, the HDF5 write) report their
+durations with record(frame, stage, seconds). NullTimer has the same methods
+doing nothing, so the loop is instrumented unconditionally and timing costs
+one no-op call per stage when it is switched off.
+"""
+from time import perf_counter
+import numpy as np
+
+# Stages timed on the capture thread, in the order they run
+CAPTURE_STAGES = (
+    'Set Exposure',
+    'Trigger Wait',
+    'Take Image',
+    'Calc Spots',
+    'Beam Centroid',
+    'Spotfield Copy',
+    'Reference Deviations',
+    'Get Deviations',
+    'Get Intensities',
+    'Zernike Fit',
+    'Publish',
+    'Reconstruct Deviations',
+    'Fourier Optometric',
+    'Calc Wavefront',
+    'Wavefront Statistics',
+    'Queue',
+)
+# Stages timed on the processing and writer threads
+STORAGE_STAGES = (
+    'Zonal Wavefront',
+    'Save',
+    'HDF5 Write',
+    'Spotfield Write',
+)
+STAGES = CAPTURE_STAGES + STORAGE_STAGES
+# Name of the timing table dataset next to the measurement data
+TIMING_KEY = 'Stage Timings'
+
+
+class StageTimer(object):
+    """Collects the duration of every stage for every frame of a shot.
+
+    Rows are kept in fixed blocks of blockSize frames that are never
+    reallocated, so the capture thread can add frames while other threads
+    record into earlier ones. endOfShot holds single durations of the steps
+    of transition_to_manual.
+    """
+    enabled = True
+
+    def __init__(self, stages=STAGES, blockSize=1024):
+        self.stages = tuple(stages)
+        self.columns = {stage: i for i, stage in enumerate(self.stages)}
+        self.blockSize = blockSize
+        self.reset()
+
+    def reset(self):
+        self.blocks = []
+        self.frames = 0
+        self.frame = None
+        self.row = None
+        self.last = None
+        self.endOfShot = {}
+
+    def _row(self, frame):
+        return self.blocks[frame // self.blockSize][frame % self.blockSize]
+
+    def start(self, frame):
+        while frame >= len(self.blocks) * self.blockSize:
+            self.blocks.append(np.zeros((self.blockSize, len(self.stages))))
+        self.frames = max(self.frames, frame + 1)
+        self.row = self._row(frame)
+        self.frame = frame
+        self.last = perf_counter()
+
+    def lap(self, stage, accumulate=False):
+        """Book the time since the last lap (or start) to stage; with accumulate, add to it."""
+        now = perf_counter()
+        if accumulate:
+            self.row[self.columns[stage]] += now - self.last
+        else:
+            self.row[self.columns[stage]] = now - self.last
+        self.last = now
+
+    def record(self, frame, stage, seconds):
+        if frame < self.frames:
+            self._row(frame)[self.columns[stage]] = seconds
+
+    def end_of_shot(self, step, seconds):
+        self.endOfShot[step] = seconds
+
+    def truncate(self, frames):
+        """Drop rows past the first frames, e.g. the slot still waiting for a trigger when the shot ended."""
+        self.frames = min(self.frames, frames)
+
+    def table(self):
+        """Structured array with one row per frame and one float32 field (seconds) per stage."""
+        dtype = np.dtype([(stage, np.float32) for stage in self.stages])
+        rows = np.concatenate(self.blocks)[:self.frames] if self.blocks else np.zeros((0, len(self.stages)))
+        table = np.zeros(len(rows), dtype=dtype)
+        for stage, i in self.columns.items():
+            table[stage] = rows[:, i]
+        return table
+
+    def summary(self):
+        """Lines of p50 and p99 latency per stage, in microseconds."""
+        table = self.table()
+        lines = ['Stage timings over %d frames (us):     p50        p99' % len(table)]
+        if len(table):
+            for stage in self.stages:
+                p50, p99 = 1e6 * np.percentile(table[stage], [50, 99])
+                lines.append('  %-24s %10.1f %10.1f' % (stage, p50, p99))
+        for step, seconds in self.endOfShot.items():
+            lines.append('  %-24s %10.1f (end of shot)' % (step, 1e6*seconds))
+        return lines
+
+
+class NullTimer(object):
+    """StageTimer that records nothing."""
+    enabled = False
+
+    def reset(self):
+        pass
+
+    def start(self, frame):
+        pass
+
+    def lap(self, stage, accumulate=False):
+        pass
+
+    def record(self, frame, stage, seconds):
+        pass
+
+    def end_of_shot(self, step, seconds):
+        pass
+
+    def truncate(self, frames):
+        pass
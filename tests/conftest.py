@@ -0,0 +1,29 @@
+import io
+from contextlib import redirect_stdout
+
+import pytest
+
+
+@pytest.fixture
+def make_worker():
+    """Factory of ThorlabsWaveFrontSensorWorkers on the simulated SDK, initialised and programmed with the
+    default front panel; keyword arguments override connection table properties. Skipped without blacs."""
+    pytest.importorskip('blacs')
+    from labscript_devices.ThorlabsWaveFrontSensor.wfs_benchmarks import _front_panel, _simulated_worker
+    workers = []
+    def make(**properties):
+        worker = _simulated_worker(**properties)
+        with redirect_stdout(io.StringIO()):
+            worker.init()
+            worker.program_manual(_front_panel())
+        workers.append(worker)
+        return worker
+    yield make
+    with redirect_stdout(io.StringIO()):
+        for worker in workers:
+            worker.shutdown()
+
+
+@pytest.fixture
+def worker(make_worker):
+    return make_worker()
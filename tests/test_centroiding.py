@@ -0,0 +1,74 @@
+"""centroiding.py on spots drawn here at random positions, independent of SimulatedWFS, whose
+spotfield images are drawn on the same lenslet grid the engine assumes."""
+import numpy as np
+import pytest
+
+from labscript_devices.ThorlabsWaveFrontSensor.centroiding import CentroidEngine, deviations
+from labscript_devices.ThorlabsWaveFrontSensor.reprocess import _engine
+
+PIXEL_UM = 5.5
+LENSLET_UM = 150.
+SHAPE = (210, 240)
+SPOTS_X, SPOTS_Y = 8, 7
+OFFSET = (1.3, -0.7) # MLA spot offsets, pixels
+SIGMA = 2. # spot radius, pixels
+
+
+def draw(frames, seed=0, readNoise=2.):
+    """Gaussian spots of random height, displaced by up to 3 pixels from the lenslet centres, with
+    Poisson read noise; a few lenslets have no spot. Returns images and true (x, y) deviations."""
+    rng = np.random.default_rng(seed)
+    pitch = LENSLET_UM / PIXEL_UM
+    centerX = SHAPE[1]/2. + (np.arange(SPOTS_X) - (SPOTS_X-1)/2.) * pitch + OFFSET[0]
+    centerY = SHAPE[0]/2. + (np.arange(SPOTS_Y) - (SPOTS_Y-1)/2.) * pitch + OFFSET[1]
+    # Pixel k spans k to k+1
+    y, x = np.mgrid[:SHAPE[0], :SHAPE[1]] + 0.5
+    images = np.empty((frames,) + SHAPE, dtype=np.uint8)
+    truth = rng.uniform(-3, 3, (frames, SPOTS_Y, SPOTS_X, 2))
+    truth[:, 2, 3] = np.nan
+    for n in range(frames):
+        image = np.zeros(SHAPE)
+        for i in range(SPOTS_Y):
+            for j in range(SPOTS_X):
+                if np.isnan(truth[n, i, j, 0]):
+                    continue
+                spotX, spotY = centerX[j] + truth[n, i, j, 0], centerY[i] + truth[n, i, j, 1]
+                image += rng.uniform(80, 220) * np.exp(-((x - spotX)**2 + (y - spotY)**2) / (2*SIGMA**2))
+        images[n] = np.clip(np.round(image) + rng.poisson(readNoise, SHAPE), 0, 255)
+    return images, truth
+
+
+@pytest.mark.parametrize('dynamicNoiseCut', [True, False])
+def test_deviations_of_independent_spots(dynamicNoiseCut):
+    images, truth = draw(8)
+    engine = CentroidEngine(PIXEL_UM, LENSLET_UM, *OFFSET, dynamicNoiseCut=dynamicNoiseCut, noiseCut=8.)
+    measured = deviations(engine.centroid(images, 0, SPOTS_X, SPOTS_Y))
+    assert np.array_equal(np.isnan(measured), np.isnan(truth))
+    error = (measured - truth)[np.isfinite(truth)]
+    assert np.sqrt(np.mean(error**2)) < 0.03
+    assert np.abs(error).max() < 0.1
+
+
+def test_windows_and_single_frames():
+    images, truth = draw(2, seed=1)
+    engine = CentroidEngine(PIXEL_UM, LENSLET_UM, *OFFSET)
+    stack = deviations(engine.centroid(images, 0, SPOTS_X, SPOTS_Y))
+    single = deviations(engine.centroid(images[1], 0, SPOTS_X, SPOTS_Y))
+    assert np.array_equal(single, stack[1], equal_nan=True)
+    # A window only holds the lenslets whose cells lie entirely inside it
+    corner = (40, 60)
+    window = deviations(engine.centroid(images[:, 40:170, 60:200], 0, SPOTS_X, SPOTS_Y, SHAPE, corner))
+    inside = np.isfinite(window[..., 0])
+    assert 0 < inside.sum() < inside.size
+    assert np.allclose(window[inside], stack[inside], atol=1e-4)
+
+
+def test_fixed_noise_cut_must_be_given():
+    attrs = {'Camera Pitch': PIXEL_UM, 'Lenslet Pitch': LENSLET_UM, 'Spot Offset X': OFFSET[0],
+             'Spot Offset Y': OFFSET[1], 'Dynamic Noise Cut': 0}
+    with pytest.raises(ValueError):
+        _engine(attrs)
+    engine = _engine(attrs, noiseCut=8.)
+    assert not engine.dynamicNoiseCut and engine.noiseCut == 8.
+    attrs['Dynamic Noise Cut'] = 1
+    assert _engine(attrs, noiseCut=8.).dynamicNoiseCut
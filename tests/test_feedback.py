@@ -0,0 +1,54 @@
+"""Feedback publishers of feedback.py, through the shared memory ring."""
+import os
+
+import numpy as np
+
+from labscript_devices.ThorlabsWaveFrontSensor.feedback import (
+    FEEDBACK_DTYPE,
+    FeedbackPublisher,
+    FeedbackSubscriber,
+    NullPublisher,
+    make_publisher,
+)
+from labscript_devices.ThorlabsWaveFrontSensor.shot_buffers import ShotBufferPool
+
+
+def filled_buffers(pool, frame):
+    buffers = pool.acquire()
+    assert buffers.index == frame
+    buffers.record['Exposure Time'] = 1. + frame
+    buffers.zernikes[:] = frame
+    return buffers
+
+
+def test_base_publisher_keeps_latest_message():
+    pool = ShotBufferPool(4, blockSize=4)
+    publisher = FeedbackPublisher(np.zeros(1, dtype=FEEDBACK_DTYPE))
+    for frame in range(3):
+        publisher.publish(filled_buffers(pool, frame), 4)
+    message = publisher.messages[0]
+    assert message['Sequence'] == 3 and message['Frame'] == 2
+    assert message['Exposure Time'] == 3.
+    assert message['Zernike Order'] == 4 and np.all(message['Zernikes'] == 2)
+
+
+def test_shared_memory_round_trip():
+    name = 'wfs_feedback_test_%d' % os.getpid()
+    publisher = make_publisher(name)
+    subscriber = FeedbackSubscriber(name)
+    try:
+        pool = ShotBufferPool(4, blockSize=4)
+        for frame in range(3):
+            publisher.publish(filled_buffers(pool, frame), 0)
+        received = [subscriber.receive(timeout=1.) for frame in range(3)]
+        assert [int(message['Frame']) for message in received] == [0, 1, 2]
+        assert np.isnan(received[0]['Zernikes']).all()
+        assert subscriber.receive(timeout=0.) is None
+        assert subscriber.dropped == 0
+    finally:
+        subscriber.close()
+        publisher.close()
+
+
+def test_null_publisher():
+    assert isinstance(make_publisher(None), NullPublisher)
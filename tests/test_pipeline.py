@@ -0,0 +1,131 @@
+"""ProcessingStage of pipeline.py, and how transition_to_manual handles its errors."""
+import io
+import threading
+from contextlib import redirect_stdout
+from time import sleep
+
+import h5py
+import numpy as np
+import pytest
+
+from labscript_devices.ThorlabsWaveFrontSensor.pipeline import ProcessingStage
+from labscript_devices.ThorlabsWaveFrontSensor.shot_buffers import crop_from_attrs, uncrop
+from labscript_devices.ThorlabsWaveFrontSensor.zernike import geometry_from_attrs
+from labscript_devices.ThorlabsWaveFrontSensor.zonal import ZonalReconstructor
+
+
+def test_processes_in_order():
+    delivered = []
+    stage = ProcessingStage([delivered.append], [lambda x: 2*x], workers=4)
+    stage.start()
+    for i in range(100):
+        stage.put(i)
+    stage.close()
+    assert delivered == [2*i for i in range(100)]
+
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_error_raised_once(workers):
+    delivered = []
+    def sink(x):
+        if x == 3:
+            raise ValueError('sink failed')
+        delivered.append(x)
+    stage = ProcessingStage([sink], [lambda x: x], workers=workers)
+    stage.start()
+    for i in range(10):
+        stage.put(i)
+    with pytest.raises(ValueError):
+        stage.close()
+    # The queue was drained and the error is not raised again
+    assert stage.queue.empty()
+    stage.close()
+    assert delivered == [0, 1, 2]
+
+
+def test_transition_to_manual_after_processing_error(worker, tmp_path):
+    path = str(tmp_path / 'shot.h5')
+    h5py.File(path, 'w').close()
+    def failing(buffers):
+        raise RuntimeError('processor failed')
+    with redirect_stdout(io.StringIO()):
+        worker.transition_to_buffered('wfs', path, {}, True)
+        worker.processingStage.processors.append(failing)
+        worker.wfs.schedule_periodic(2e-3, 5)
+        sleep(0.1)
+        with pytest.raises(RuntimeError):
+            worker.transition_to_manual()
+    # The shot is closed anyway, and the next one starts cleanly
+    assert worker.h5_filepath is None
+    assert worker.shotWriter.thread is None
+    assert not worker.thread.is_alive()
+    path = str(tmp_path / 'next.h5')
+    h5py.File(path, 'w').close()
+    with redirect_stdout(io.StringIO()):
+        worker.transition_to_buffered('wfs', path, {}, False)
+        worker.wfs.schedule_periodic(2e-3, 5)
+        sleep(0.1)
+        assert worker.transition_to_manual()
+    with h5py.File(path, 'r') as f:
+        assert len(f['images/wfs/Spot Deviations/Spot Deviations']) == 5
+
+
+def test_zonal_wavefront_in_processing_workers(make_worker, tmp_path):
+    worker = make_worker(wavefrontSolver='zonal', processingWorkers=4)
+    path = str(tmp_path / 'shot.h5')
+    h5py.File(path, 'w').close()
+    with redirect_stdout(io.StringIO()):
+        worker.transition_to_buffered('wfs', path, {}, True)
+        assert worker.processingStage.workers == 4
+        worker.wfs.schedule_periodic(2e-3, 40)
+        while len(worker.dataList) < 40:
+            sleep(1e-3)
+        assert worker.transition_to_manual()
+    with h5py.File(path, 'r') as f:
+        group = f['images/wfs']
+        crop = crop_from_attrs(group.attrs)
+        deviations = uncrop(group['Spot Deviations/Spot Deviations'][:], crop, interleaved=True)
+        wavefronts = uncrop(group['Wavefront/Wavefront'][:], crop)
+        hostTimes = group['Host Time/Host Time'][:]
+        geometry = geometry_from_attrs(group.attrs)
+    # Saved in acquisition order, each frame with its own wavefront
+    assert len(hostTimes) == 40 and np.all(np.diff(hostTimes) > 0)
+    expected = ZonalReconstructor().reconstruct(deviations, geometry)
+    assert np.allclose(wavefronts, expected, equal_nan=True, atol=1e-5)
+
+
+def test_failed_start_stops_the_shot_threads(worker, tmp_path, monkeypatch):
+    path = str(tmp_path / 'shot.h5')
+    h5py.File(path, 'w').close()
+    def failing(stage):
+        raise RuntimeError('processing stage failed to start')
+    monkeypatch.setattr(ProcessingStage, 'start', failing)
+    with redirect_stdout(io.StringIO()):
+        with pytest.raises(RuntimeError):
+            worker.transition_to_buffered('wfs', path, {}, True)
+        # The writer thread started before the failure is stopped, and the abort has nothing left to do
+        assert worker.shotWriter.thread is None
+        assert worker.h5_filepath is None
+        assert worker.abort_transition_to_buffered()
+    monkeypatch.undo()
+    path = str(tmp_path / 'next.h5')
+    h5py.File(path, 'w').close()
+    with redirect_stdout(io.StringIO()):
+        worker.transition_to_buffered('wfs', path, {}, False)
+        worker.wfs.schedule_periodic(2e-3, 5)
+        sleep(0.1)
+        assert worker.transition_to_manual()
+    with h5py.File(path, 'r') as f:
+        assert len(f['images/wfs/Spot Deviations/Spot Deviations']) == 5
+
+
+def test_unknown_trigger_wait_mode_starts_nothing(worker, tmp_path):
+    path = str(tmp_path / 'shot.h5')
+    h5py.File(path, 'w').close()
+    worker.triggerWaitMode = 'spin'
+    threads = threading.active_count()
+    with redirect_stdout(io.StringIO()):
+        with pytest.raises(ValueError):
+            worker.transition_to_buffered('wfs', path, {}, True)
+    assert threading.active_count() == threads
+    assert worker.h5_filepath is None
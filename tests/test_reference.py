@@ -0,0 +1,58 @@
+"""Reference subtraction and the statistics-only mode of reference.py."""
+import h5py
+import numpy as np
+
+from labscript_devices.ThorlabsWaveFrontSensor.reference import REFERENCE_KEY, ReferenceTracker
+from labscript_devices.ThorlabsWaveFrontSensor.shot_buffers import ShotBufferPool
+
+
+def random_shot(frames, seed=0):
+    rng = np.random.default_rng(seed)
+    pool = ShotBufferPool(4, blockSize=frames)
+    dataList = []
+    for n in range(frames):
+        buffers = pool.acquire()
+        buffers.wavefront[:] = rng.normal(size=buffers.wavefront.shape)
+        buffers.deviations[:] = rng.normal(size=buffers.deviations.shape)
+        buffers.intensity[:] = rng.uniform(size=buffers.intensity.shape)
+        buffers.zernikes[:] = rng.normal(size=buffers.zernikes.shape)
+        dataList.append(buffers)
+    return dataList
+
+
+def test_capture_then_subtract():
+    dataList = random_shot(20)
+    wavefronts = np.array([buffers.wavefront for buffers in dataList], dtype=np.float64)
+    tracker = ReferenceTracker(captureFrames=5)
+    for buffers in dataList:
+        tracker(buffers)
+    reference = wavefronts[:5].mean(axis=0)
+    assert np.allclose(tracker.reference.wavefront, reference)
+    assert tracker.subtracted == 15
+    assert np.allclose(dataList[-1].wavefront, wavefronts[-1] - reference, atol=1e-5)
+    assert np.allclose(tracker.wavefrontDelta.std(), (wavefronts[5:] - reference).std(axis=0, ddof=1), atol=1e-5)
+
+
+def test_statistics_only_keeps_spot_statistics(tmp_path):
+    dataList = random_shot(20)
+    deviations = np.array([buffers.deviationStored for buffers in dataList], dtype=np.float64)
+    intensity = np.array([buffers.intensity for buffers in dataList], dtype=np.float64)
+    tracker = ReferenceTracker(captureFrames=5, statisticsOnly=True)
+    for buffers in dataList:
+        tracker(buffers)
+    with h5py.File(tmp_path / 'shot.h5', 'w') as f:
+        out = tracker.save(f.create_group('images/wfs'))
+        # Over every frame of the shot, captured or subtracted
+        assert np.allclose(out['Spot Deviations Mean'][:], deviations.mean(axis=0))
+        assert np.allclose(out['Spot Deviations Std'][:], deviations.std(axis=0, ddof=1))
+        assert np.allclose(out['Spot Intensities Mean'][:], intensity.mean(axis=0))
+        assert np.allclose(out['Spot Intensities Std'][:], intensity.std(axis=0, ddof=1))
+
+
+def test_spot_statistics_only_when_asked(tmp_path):
+    tracker = ReferenceTracker(captureFrames=1)
+    for buffers in random_shot(3):
+        tracker(buffers)
+    with h5py.File(tmp_path / 'shot.h5', 'w') as f:
+        tracker.save(f.create_group('images/wfs'))
+        assert 'Spot Deviations Mean' not in f['images/wfs'][REFERENCE_KEY]
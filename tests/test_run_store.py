@@ -0,0 +1,85 @@
+"""Run store of run_store.py: queries over several shots, sensors sharing a file and clock steps."""
+import h5py
+import numpy as np
+import pytest
+
+from labscript_devices.ThorlabsWaveFrontSensor.run_store import RunStore, RunStoreWriter
+
+KEYS = ['Wavefront RMS', 'Exposure Time']
+
+
+def append(writer, name, times, seed):
+    times = np.asarray(times, dtype=np.float64)
+    rng = np.random.default_rng(seed)
+    scalars = np.stack([times, rng.normal(size=len(times))], axis=-1)
+    writer.append_shot(name, times, scalars, rng.normal(size=(len(times), 15)))
+
+
+def test_shots_of_one_device(tmp_path):
+    path = str(tmp_path / 'run.h5')
+    writer = RunStoreWriter(path, KEYS, 'wfs')
+    for i in range(3):
+        append(writer, 'shot_%d.h5' % i, 100. + 10*i + np.arange(5), i)
+    store = RunStore(path)
+    assert len(store) == 15
+    window = store.time_window(112., 123.)
+    assert list(window['time']) == [112., 113., 114., 120., 121., 122.]
+    assert list(window['shot']) == ['shot_1.h5'] * 3 + ['shot_2.h5'] * 3
+    assert list(window['frame']) == [2, 3, 4, 0, 1, 2]
+    assert np.array_equal(window['Wavefront RMS'], window['time'])
+    assert window['zernikes'].shape == (6, 66)
+    assert np.isnan(window['zernikes'][:, 15:]).all()
+    shot = store.shot('/some/folder/shot_1.h5')
+    assert list(shot['time']) == [110., 111., 112., 113., 114.]
+    assert set(shot['device']) == {'wfs'}
+    with pytest.raises(KeyError):
+        store.shot('shot_9.h5')
+    assert len(store.time_window(200., 300.)['time']) == 0
+
+
+def test_devices_sharing_a_store(tmp_path):
+    path = str(tmp_path / 'run.h5')
+    x, y = RunStoreWriter(path, KEYS, 'wfs_x'), RunStoreWriter(path, KEYS, 'wfs_y')
+    # Overlapping shots: the same shot file for both sensors, appended one after the other
+    append(x, 'shot_0.h5', [0., 2., 4., 6.], 0)
+    append(y, 'shot_0.h5', [1., 3., 5., 7.], 1)
+    append(x, 'shot_1.h5', [10., 12.], 2)
+    store = RunStore(path)
+    window = store.time_window(2., 6.)
+    assert list(window['time']) == [2., 3., 4., 5.]
+    assert list(window['device']) == ['wfs_x', 'wfs_y', 'wfs_x', 'wfs_y']
+    assert np.array_equal(window['Wavefront RMS'], window['time'])
+    assert list(store.time_window(2., 6., device='wfs_y')['time']) == [3., 5.]
+    assert list(store.time_window(0., 20., device='wfs_x')['time']) == [0., 2., 4., 6., 10., 12.]
+    assert list(store.shot('shot_0.h5')['time']) == list(range(8))
+    assert list(store.shot('shot_0.h5', device='wfs_y')['frame']) == [0, 1, 2, 3]
+    with pytest.raises(KeyError):
+        store.shot('shot_1.h5', device='wfs_y')
+
+
+def test_clock_step(tmp_path):
+    path = str(tmp_path / 'run.h5')
+    writer = RunStoreWriter(path, KEYS, 'wfs')
+    append(writer, 'shot_0.h5', [50., 51., 52.], 0)
+    # The clock was set back between shots
+    append(writer, 'shot_1.h5', [40., 41., 42.], 1)
+    store = RunStore(path)
+    window = store.time_window(41., 51.)
+    assert list(window['time']) == [41., 42., 50.]
+    assert list(window['shot']) == ['shot_1.h5', 'shot_1.h5', 'shot_0.h5']
+    assert np.array_equal(window['Wavefront RMS'], window['time'])
+
+
+def test_store_without_devices(tmp_path):
+    path = str(tmp_path / 'run.h5')
+    writer = RunStoreWriter(path, KEYS, 'wfs')
+    append(writer, 'shot_0.h5', [0., 1.], 0)
+    with h5py.File(path, 'r+') as f:
+        # As written before the device column
+        del f['shots/device']
+    store = RunStore(path)
+    assert list(store.shot('shot_0.h5')['device']) == ['', '']
+    append(writer, 'shot_1.h5', [2., 3.], 1)
+    store.refresh()
+    assert list(store.time_window(0., 5.)['device']) == ['', '', 'wfs', 'wfs']
+    assert list(store.rows()['frame']) == [0, 1, 0, 1]
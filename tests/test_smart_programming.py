@@ -0,0 +1,100 @@
+"""Skipping unchanged settings in program_manual (settings_cache.py), counted at the simulated SDK."""
+import ctypes as ct
+import io
+from collections import Counter
+from contextlib import redirect_stdout
+
+import pytest
+
+from labscript_devices.ThorlabsWaveFrontSensor.settings_cache import SettingsCache
+from labscript_devices.ThorlabsWaveFrontSensor.simulated_wfs import SimulatedWFS
+
+
+class CountingSDK(object):
+    """Forwards to an SDK and counts every WFS_* call made through it."""
+    def __init__(self, wfs):
+        self.wfs = wfs
+        self.calls = Counter()
+
+    def __getattr__(self, name):
+        function = getattr(self.wfs, name)
+        if not name.startswith('WFS_'):
+            return function
+        def counted(*args):
+            self.calls[name] += 1
+            return function(*args)
+        return counted
+
+
+def front_panel(resolution=0, pupilDiameterMm=3.):
+    return {'Resolution Index': resolution, 'Pupil Center X': 0., 'Pupil Center Y': 0.,
+            'Pupil Diameter X': pupilDiameterMm, 'Pupil Diameter Y': pupilDiameterMm,
+            'Highest Zernike Order': 4, 'Fourier Order': 2, 'Limited to Pupil?': 1}
+
+def program(worker, frontPanel):
+    """SDK calls made by one program_manual."""
+    worker.wfs.calls.clear()
+    with redirect_stdout(io.StringIO()):
+        worker.program_manual(frontPanel)
+    return dict(worker.wfs.calls)
+
+@pytest.fixture
+def counted(worker):
+    worker.wfs = CountingSDK(worker.wfs)
+    program(worker, front_panel())
+    return worker
+
+
+def test_cache_skips_unchanged_inputs():
+    wfs = CountingSDK(SimulatedWFS())
+    cache = SettingsCache()
+    handle = ct.c_longlong(1)
+    assert cache.call('WFS_SetPupil', (0., 0., 3., 3.), wfs.WFS_SetPupil, handle, 0., 0., 3., 3.) == 0
+    assert cache.call('WFS_SetPupil', (0., 0., 3., 3.), wfs.WFS_SetPupil, handle, 0., 0., 3., 3.) is None
+    assert cache.call('WFS_SetPupil', (0., 0., 2., 2.), wfs.WFS_SetPupil, handle, 0., 0., 2., 2.) == 0
+    cache.invalidate('WFS_SetPupil')
+    assert cache.call('WFS_SetPupil', (0., 0., 2., 2.), wfs.WFS_SetPupil, handle, 0., 0., 2., 2.) == 0
+    assert wfs.calls == {'WFS_SetPupil': 3}
+    assert cache.calls == {'WFS_SetPupil': 3}
+    assert cache.skipped == {'WFS_SetPupil': 1}
+
+
+def test_failed_call_is_retried():
+    cache = SettingsCache()
+    answers = [0, -1]
+    assert cache.call('WFS_SetReferencePlane', (0,), answers.pop) == -1
+    assert cache.call('WFS_SetReferencePlane', (0,), answers.pop) == 0
+    assert cache.call('WFS_SetReferencePlane', (0,), answers.pop) is None
+    assert cache.calls['WFS_SetReferencePlane'] == 2
+
+
+def test_identical_front_panel_makes_no_sdk_calls(counted):
+    assert program(counted, front_panel()) == {}
+    assert program(counted, front_panel()) == {}
+
+
+def test_new_resolution_reissues_reference_and_pupil(counted):
+    assert program(counted, front_panel(resolution=2)) == {
+        'WFS_ConfigureCam': 1, 'WFS_SetReferencePlane': 1, 'WFS_SetPupil': 1}
+    assert program(counted, front_panel(resolution=2)) == {}
+
+
+def test_new_pupil_only_sets_the_pupil(counted):
+    assert program(counted, front_panel(pupilDiameterMm=2.)) == {'WFS_SetPupil': 1}
+    assert counted.wfs.wfs.pupil[2] == 2.
+
+
+def test_invalidated_cache_reprograms_everything(counted):
+    counted.settingsCache.invalidate()
+    assert program(counted, front_panel()) == {
+        'WFS_ConfigureCam': 1, 'WFS_SetReferencePlane': 1, 'WFS_SetPupil': 1}
+
+
+def test_failed_configure_is_retried(counted):
+    configure = counted.wfs.wfs.WFS_ConfigureCam
+    counted.wfs.wfs.WFS_ConfigureCam = lambda *args: -1
+    with pytest.raises(KeyError):
+        program(counted, front_panel(resolution=2))
+    counted.wfs.wfs.WFS_ConfigureCam = configure
+    assert program(counted, front_panel(resolution=2)) == {
+        'WFS_ConfigureCam': 1, 'WFS_SetReferencePlane': 1, 'WFS_SetPupil': 1}
@@ -0,0 +1,47 @@
+"""StageTimer of stage_timing.py, and the end of shot steps it times in the worker."""
+import io
+from contextlib import redirect_stdout
+from time import perf_counter, sleep
+
+import h5py
+import numpy as np
+
+from labscript_devices.ThorlabsWaveFrontSensor.stage_timing import TIMING_KEY, StageTimer
+
+
+def test_laps_and_records():
+    timer = StageTimer(stages=('A', 'B', 'C'), blockSize=4)
+    for frame in range(10):
+        timer.start(frame)
+        timer.lap('A')
+        timer.lap('B', accumulate=True)
+        timer.lap('B', accumulate=True)
+    timer.record(9, 'C', 0.5)
+    timer.record(10, 'C', 0.5) # not started, ignored
+    table = timer.table()
+    assert len(table) == 10
+    assert (table['A'] >= 0).all() and (table['B'] > 0).all()
+    assert table['C'][9] == 0.5 and not table['C'][:9].any()
+
+
+def test_end_of_shot_steps(make_worker, tmp_path):
+    worker = make_worker(stageTiming=True)
+    path = str(tmp_path / 'shot.h5')
+    h5py.File(path, 'w').close()
+    with redirect_stdout(io.StringIO()):
+        worker.transition_to_buffered('wfs', path, {}, True)
+        worker.wfs.schedule_periodic(2e-3, 20)
+        while len(worker.dataList) < 20:
+            sleep(1e-3)
+        start = perf_counter()
+        worker.transition_to_manual()
+        seconds = perf_counter() - start
+    endOfShot = worker.stageTimer.endOfShot
+    # Stopping the capture thread takes one trigger wait interval, not a fixed join timeout
+    assert endOfShot['Stop Capture'] < 0.1
+    assert sum(endOfShot.values()) <= seconds
+    with h5py.File(path, 'r') as f:
+        table = f['images/wfs/%s/%s' % (TIMING_KEY, TIMING_KEY)]
+        assert len(table) == 20
+        assert np.all(table['Take Image'] > 0)
+        assert table.attrs['End of Shot Stop Capture'] == endOfShot['Stop Capture']
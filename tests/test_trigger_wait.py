@@ -0,0 +1,114 @@
+"""Trigger wait strategies of trigger_wait.py against the simulated SDK."""
+import ctypes as ct
+from threading import Event, Timer
+from time import perf_counter
+
+import pytest
+
+from labscript_devices.ThorlabsWaveFrontSensor.simulated_wfs import SimulatedWFS
+from labscript_devices.ThorlabsWaveFrontSensor.trigger_wait import (
+    TRIGGER_WAIT_MODES,
+    WFS_ERROR_AWAITING_TRIGGER,
+    BackoffWait,
+    StatusPollWait,
+    TriggerWait,
+    make_trigger_wait,
+)
+
+HANDLE = ct.c_longlong(1)
+
+
+def triggered_wfs():
+    wfs = SimulatedWFS()
+    wfs.WFS_SetTriggerMode(HANDLE, ct.c_int32(2))
+    return wfs
+
+
+class CountingTake(object):
+    """take() for TriggerWait.wait that counts the image calls."""
+    def __init__(self, wfs):
+        self.wfs = wfs
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.wfs.WFS_TakeSpotfieldImage(HANDLE)
+
+
+@pytest.mark.parametrize('mode', sorted(TRIGGER_WAIT_MODES))
+def test_stop_event_ends_wait(mode):
+    wfs = triggered_wfs()
+    stopEvent = Event()
+    wait = make_trigger_wait(mode, wfs, HANDLE, stopEvent)
+    # Even the slowest retry interval must not delay the end of the shot
+    wait.interval = wait.maxInterval = 5. if mode == 'fixed' else 1.
+    Timer(0.05, stopEvent.set).start()
+    start = perf_counter()
+    assert wait.wait(CountingTake(wfs)) is None
+    assert perf_counter() - start < 0.5
+
+
+@pytest.mark.parametrize('mode', sorted(TRIGGER_WAIT_MODES))
+def test_timeout_returns_none(mode):
+    wfs = triggered_wfs()
+    wait = make_trigger_wait(mode, wfs, HANDLE, Event(), timeout=0.05)
+    start = perf_counter()
+    assert wait.wait(CountingTake(wfs)) is None
+    assert 0.05 <= perf_counter() - start < 0.5
+
+
+@pytest.mark.parametrize('mode', sorted(TRIGGER_WAIT_MODES))
+def test_frame_after_trigger(mode):
+    wfs = triggered_wfs()
+    wait = make_trigger_wait(mode, wfs, HANDLE, Event())
+    wfs.schedule_triggers([perf_counter() + 0.02])
+    assert wait.wait(CountingTake(wfs)) == 0
+    assert perf_counter() >= wfs.lastTriggerTime
+
+
+def test_retries_counted():
+    answers = [WFS_ERROR_AWAITING_TRIGGER] * 3 + [0]
+    wait = BackoffWait(None, HANDLE, Event())
+    assert wait.wait(lambda: answers.pop(0)) == 0
+    assert wait.retries == 3
+    # A frame already held by the camera comes with the first call
+    assert wait.wait(lambda: 0) == 0
+    assert wait.retries == 0
+
+
+def test_status_gates_image_calls():
+    wfs = triggered_wfs()
+    take = CountingTake(wfs)
+    wait = StatusPollWait(wfs, HANDLE, Event())
+    wfs.schedule_triggers([perf_counter() + 0.02])
+    assert wait.wait(take) == 0
+    # One call to find the camera waiting, one once the status bit cleared
+    assert take.calls == 2
+    assert wait.retries == 1
+
+
+def test_status_error_falls_back_to_image_calls():
+    wfs = triggered_wfs()
+    wfs.WFS_GetStatus = lambda instrumentHandle, status: -1
+    take = CountingTake(wfs)
+    wait = StatusPollWait(wfs, HANDLE, Event())
+    wfs.schedule_triggers([perf_counter() + 0.02])
+    assert wait.wait(take) == 0
+    assert take.calls > 2
+
+
+def test_backoff_interval_capped():
+    wait = BackoffWait(None, HANDLE, Event(), minInterval=20e-6, maxInterval=1e-3)
+    pauses = [wait.pause(attempt) for attempt in range(1, 10)]
+    assert pauses[0] == 20e-6
+    assert pauses == sorted(pauses)
+    assert pauses[-1] == 1e-3
+    # Long waits without a trigger used to overflow the power
+    assert wait.pause(100000) == 1e-3
+
+
+def test_mode_names():
+    assert type(make_trigger_wait('fixed', None, HANDLE, Event())) is TriggerWait
+    assert type(make_trigger_wait('blocking', None, HANDLE, Event())) is TriggerWait
+    with pytest.raises(ValueError):
+        make_trigger_wait('spin', None, HANDLE, Event())
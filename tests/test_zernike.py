@@ -0,0 +1,99 @@
+"""zernike.py against closed-form Zernike polynomials, independent of SimulatedWFS (whose
+WFS_ZernikeLsf is this same fitter)."""
+from math import sqrt
+
+import numpy as np
+import pytest
+
+from labscript_devices.ThorlabsWaveFrontSensor.zernike import (
+    SpotGeometry,
+    ZernikeFitter,
+    lenslet_coordinates,
+    zernike,
+    zernike_modes,
+)
+
+# Z2..Z15 in WFS numbering, written out in unit pupil coordinates (Noll/ANSI tables, RMS-normalised)
+CLOSED_FORM = {
+    2: lambda u, v: 2*v,
+    3: lambda u, v: 2*u,
+    4: lambda u, v: sqrt(6) * 2*u*v,
+    5: lambda u, v: sqrt(3) * (2*(u*u + v*v) - 1),
+    6: lambda u, v: sqrt(6) * (u*u - v*v),
+    7: lambda u, v: sqrt(8) * (3*u*u*v - v**3),
+    8: lambda u, v: sqrt(8) * (3*(u*u + v*v) - 2) * v,
+    9: lambda u, v: sqrt(8) * (3*(u*u + v*v) - 2) * u,
+    10: lambda u, v: sqrt(8) * (u**3 - 3*u*v*v),
+    11: lambda u, v: sqrt(10) * 4*(u**3*v - u*v**3),
+    12: lambda u, v: sqrt(10) * (4*(u*u + v*v) - 3) * 2*u*v,
+    13: lambda u, v: sqrt(5) * (6*(u*u + v*v)**2 - 6*(u*u + v*v) + 1),
+    14: lambda u, v: sqrt(10) * (4*(u*u + v*v) - 3) * (u*u - v*v),
+    15: lambda u, v: sqrt(10) * (u**4 - 6*u*u*v*v + v**4),
+}
+GEOMETRY = SpotGeometry(40, 30, 150., 5.5, 3700., 0.3, -0.2, 4., 3.5)
+
+
+def wavefront(coefficients, geometry, x, y):
+    """Wavefront (um) at sensor coordinates x, y (um) from {mode: coefficient}."""
+    u = (x - 1e3*geometry.pupilCenterXMm) / (5e2*geometry.pupilDiameterXMm)
+    v = (y - 1e3*geometry.pupilCenterYMm) / (5e2*geometry.pupilDiameterYMm)
+    return sum(c * CLOSED_FORM[mode](u, v) for mode, c in coefficients.items())
+
+def spot_deviations(coefficients, geometry, h=1e-2):
+    """(rows, cols, 2) spot deviations in camera pixels, from central differences of the wavefront."""
+    x, y = lenslet_coordinates(geometry)
+    slopeX = (wavefront(coefficients, geometry, x + h, y) - wavefront(coefficients, geometry, x - h, y)) / (2*h)
+    slopeY = (wavefront(coefficients, geometry, x, y + h) - wavefront(coefficients, geometry, x, y - h)) / (2*h)
+    return np.stack([slopeX, slopeY], axis=-1) * geometry.lensletFocalUm / geometry.camPitchUm
+
+
+def test_polynomials_match_closed_form():
+    u, v = np.meshgrid(np.linspace(-1, 1, 41), np.linspace(-1, 1, 41))
+    for mode, (n, m) in enumerate(zernike_modes(4), 1):
+        if mode == 1:
+            continue
+        Z, dZdu, dZdv = zernike(n, m, u, v)
+        assert np.allclose(Z, CLOSED_FORM[mode](u, v)), mode
+        h = 1e-6
+        assert np.allclose(dZdu, (CLOSED_FORM[mode](u + h, v) - CLOSED_FORM[mode](u - h, v)) / (2*h), atol=1e-6)
+        assert np.allclose(dZdv, (CLOSED_FORM[mode](u, v + h) - CLOSED_FORM[mode](u, v - h)) / (2*h), atol=1e-6)
+
+
+def test_unit_rms_over_the_pupil():
+    u, v = np.meshgrid(np.linspace(-1, 1, 801), np.linspace(-1, 1, 801))
+    inside = u*u + v*v <= 1
+    for mode in CLOSED_FORM:
+        assert np.sqrt(np.mean(CLOSED_FORM[mode](u, v)[inside]**2)) == pytest.approx(1., abs=5e-3), mode
+
+
+@pytest.mark.parametrize('coefficients', [
+    {5: 0.5},
+    {2: 0.1, 3: -0.2, 4: 0.05, 6: 0.3},
+    {5: -0.4, 7: 0.02, 9: 0.1, 13: 0.07, 15: -0.03},
+])
+def test_fit_recovers_coefficients(coefficients):
+    fitted = ZernikeFitter().fit(spot_deviations(coefficients, GEOMETRY), GEOMETRY, 4)
+    expected = np.zeros(15)
+    for mode, c in coefficients.items():
+        expected[mode - 1] = c
+    assert np.allclose(fitted, expected, atol=1e-6)
+
+
+def test_missing_spots_and_batches():
+    fitter = ZernikeFitter()
+    frames = np.stack([spot_deviations({5: 0.5, 9: 0.1}, GEOMETRY), spot_deviations({4: -0.2}, GEOMETRY)])
+    frames[1, 10:13, 15:20] = np.nan
+    fitted = fitter.fit(frames, GEOMETRY, 4)
+    assert np.allclose(fitted[0, [4, 8]], [0.5, 0.1], atol=1e-6)
+    assert np.allclose(fitted[1, 3], -0.2, atol=1e-6)
+    assert np.allclose(np.delete(fitted[1], 3), 0., atol=1e-6)
+
+
+def test_radius_of_curvature_of_a_sphere():
+    geometry = GEOMETRY._replace(pupilCenterXMm=0., pupilCenterYMm=0., pupilDiameterYMm=4.)
+    radiusMm = 500.
+    x, y = lenslet_coordinates(geometry)
+    # Paraxial sphere: slopes x/R, y/R
+    deviations = np.stack([x, y], axis=-1) / (1e3*radiusMm) * geometry.lensletFocalUm / geometry.camPitchUm
+    basis = ZernikeFitter().basis(geometry, 4)
+    assert basis.radius_of_curvature(basis.fit(deviations)) == pytest.approx(radiusMm)
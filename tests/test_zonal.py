@@ -0,0 +1,89 @@
+"""zonal.py against analytic wavefronts, and against WFS_CalcWavefront on a stored hardware shot.
+
+The hardware check needs a shot file saved by the worker with the real SDK, with
+wavefrontSolver='sdk' so its Wavefront dataset comes from WFS_CalcWavefront, and its Spot
+Deviations stored; point WFS_HARDWARE_SHOT at it. It is skipped otherwise."""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import h5py
+import numpy as np
+import pytest
+
+from labscript_devices.ThorlabsWaveFrontSensor.reprocess import _wfs_groups, zonal_difference
+from labscript_devices.ThorlabsWaveFrontSensor.zernike import SpotGeometry, pupil_coordinates, zernike, zernike_modes
+from labscript_devices.ThorlabsWaveFrontSensor.zonal import ZonalReconstructor
+
+HARDWARE_SHOT = os.environ.get('WFS_HARDWARE_SHOT')
+# Zonal against SDK wavefront, rms over the lenslets of every frame: both are least-squares
+# integrations of the same deviations, but the SDK's scheme and edge handling are not documented
+HARDWARE_TOLERANCE_UM = 0.02
+HARDWARE_TOLERANCE_RELATIVE = 0.05 # of the rms of the SDK wavefront
+GEOMETRY = SpotGeometry(71, 44, 150., 5.5, 3700., 0.2, -0.1, 4., 3.5)
+
+
+def analytic(coefficients, geometry):
+    """Wavefront (um, zero mean over the pupil) and spot deviations (px) of {mode: coefficient}."""
+    u, v, mask = pupil_coordinates(geometry)
+    wavefront = np.zeros(u.shape)
+    deviations = np.zeros(u.shape + (2,))
+    modes = zernike_modes(10)
+    for mode, coefficient in coefficients.items():
+        Z, dZdu, dZdv = zernike(*modes[mode-1], u, v)
+        wavefront += coefficient * Z
+        deviations[..., 0] += coefficient * dZdu / (5e2*geometry.pupilDiameterXMm)
+        deviations[..., 1] += coefficient * dZdv / (5e2*geometry.pupilDiameterYMm)
+    wavefront -= wavefront[mask].mean()
+    return wavefront, mask, deviations * geometry.lensletFocalUm / geometry.camPitchUm
+
+
+@pytest.mark.parametrize('coefficients', [{5: 0.5}, {3: 0.2, 5: 0.5, 8: 0.1, 12: 0.05}, {7: -0.1, 14: 0.08}])
+def test_reconstructs_analytic_wavefront(coefficients):
+    wavefront, mask, deviations = analytic(coefficients, GEOMETRY)
+    reconstructed = ZonalReconstructor().reconstruct(deviations.astype(np.float32), GEOMETRY)
+    assert np.isfinite(reconstructed[mask]).all()
+    assert np.isnan(reconstructed[~mask]).all()
+    # The Southwell differences are exact for quadratics; higher orders lose a few percent on this grid
+    error = reconstructed[mask] - wavefront[mask]
+    assert np.sqrt(np.mean(error**2)) < 3e-2 * np.sqrt(np.mean(wavefront[mask]**2)) + 1e-4
+
+
+def test_missing_spots():
+    wavefront, mask, deviations = analytic({5: 0.5}, GEOMETRY)
+    frames = np.stack([deviations, deviations]).astype(np.float32)
+    missing = np.argwhere(mask)[::17]
+    frames[1, missing[:, 0], missing[:, 1]] = np.nan
+    reconstructed = ZonalReconstructor().reconstruct(frames, GEOMETRY)
+    # Every difference to a lenslet without a spot is lost, so those alone are NaN
+    valid = mask.copy()
+    valid[missing[:, 0], missing[:, 1]] = False
+    assert np.isfinite(reconstructed[1][valid]).all()
+    assert np.isnan(reconstructed[1][mask & ~valid]).all()
+    first, second = reconstructed[0][valid], reconstructed[1][valid]
+    assert np.sqrt(np.mean((second - second.mean() - first + first.mean())**2)) < 1e-3
+
+
+@pytest.mark.skipif(not HARDWARE_SHOT, reason='set WFS_HARDWARE_SHOT to a shot taken with the real SDK')
+def test_hardware_shot():
+    with h5py.File(HARDWARE_SHOT, 'r') as f:
+        groups = [path for path in _wfs_groups(f) if 'Wavefront' in f[path]]
+        assert groups, 'no image group with Spot Deviations and Wavefront in ' + HARDWARE_SHOT
+        for path in groups:
+            rmsDifference, rmsWavefront, count = zonal_difference(f[path])
+            tolerance = HARDWARE_TOLERANCE_UM + HARDWARE_TOLERANCE_RELATIVE * rmsWavefront
+            assert rmsDifference < tolerance, '%s: zonal - SDK rms %.4f um over %d lenslets, wavefront rms %.4f um' % (
+                path, rmsDifference, count, rmsWavefront)
+
+
+def test_threads_share_a_reconstructor():
+    geometries = [GEOMETRY._replace(pupilDiameterXMm=d, pupilDiameterYMm=d) for d in (2., 2.5, 3., 3.5, 4.)]
+    frames = [analytic({5: 0.5, 7: 0.05}, geometry)[2].astype(np.float32) for geometry in geometries]
+    expected = [ZonalReconstructor().reconstruct(frame, geometry) for frame, geometry in zip(frames, geometries)]
+    # Fewer cache slots than geometries, so solvers are built and evicted while others are in use
+    shared = ZonalReconstructor(maxCached=2)
+    jobs = [i % len(geometries) for i in range(100)]
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(lambda i: shared.reconstruct(frames[i], geometries[i]), jobs))
+    for i, result in zip(jobs, results):
+        assert np.array_equal(result, expected[i], equal_nan=True)
+    assert len(shared.cache) <= 2
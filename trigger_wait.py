@@ -0,0 +1,119 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/ThorlabsWaveFrontSensor/trigger_wait.py        #
+#                                                                   #
+# This file is part of labscript_devices                            #
+#                                                                   #
+#####################################################################
+import ctypes as ct
+from time import perf_counter
+
+# Returned by WFS_TakeSpotfieldImage* in trigger mode while no trigger has arrived yet
+WFS_ERROR_AWAITING_TRIGGER = -1074001642
+# WFS_GetStatus bit: camera is still awaiting a trigger
+WFS_STATBIT_ATR = 0x00000080
+
+
+class TriggerWait(object):
+    """Waits for the next hardware trigger by retrying a spotfield image call.
+
+    wait(take) calls take(), which should return the status of a
+    WFS_TakeSpotfieldImage* call, until it returns something other than
+    WFS_ERROR_AWAITING_TRIGGER. Between attempts the thread waits on stopEvent,
+    which releases the GIL and returns immediately once the shot is over.
+    wait() returns the final status of take(), or None if stopEvent was set or
+    no trigger arrived within timeout seconds. retries is the number of calls
+    to take() after the first one in the last wait(); none means the camera
+    already held a frame when it was called.
+
+    This base class ('fixed' mode) waits a fixed interval between attempts
+    and is meant to be used with a timeout. It does not block inside the SDK:
+    in a trigger mode WFS_TakeSpotfieldImage returns WFS_ERROR_AWAITING_TRIGGER
+    straight away and the SDK has no call that waits for the trigger, so every
+    mode has to retry. Subclasses change how long to wait between attempts and
+    how to tell that a trigger has arrived.
+    """
+    def __init__(self, wfs, instrumentHandle, stopEvent, interval=1e-3, timeout=None, reportInterval=5.):
+        self.wfs = wfs
+        self.instrumentHandle = instrumentHandle
+        self.stopEvent = stopEvent
+        self.interval = interval
+        self.timeout = timeout
+        self.reportInterval = reportInterval
+        self.retries = 0
+
+    def pause(self, attempt):
+        """Seconds to wait before retry number attempt (counting from 1)."""
+        return self.interval
+
+    def triggered(self):
+        """Whether a trigger may have arrived since the last attempt."""
+        return True
+
+    def wait(self, take):
+        start = lastReport = perf_counter()
+        attempt = self.retries = 0
+        devStatus = take()
+        while devStatus == WFS_ERROR_AWAITING_TRIGGER:
+            attempt += 1
+            if self.stopEvent.wait(self.pause(attempt)):
+                return None
+            now = perf_counter()
+            if self.timeout is not None and now - start > self.timeout:
+                print('No trigger within %g s' % self.timeout)
+                return None
+            if now - lastReport > self.reportInterval:
+                print('Waiting for trigger')
+                lastReport = now
+            if self.triggered():
+                self.retries += 1
+                devStatus = take()
+        return devStatus
+
+
+class BackoffWait(TriggerWait):
+    """Retries quickly right after a miss and backs off geometrically up to maxInterval."""
+    def __init__(self, wfs, instrumentHandle, stopEvent, minInterval=20e-6, maxInterval=1e-3, factor=2.,
+                 **kwargs):
+        TriggerWait.__init__(self, wfs, instrumentHandle, stopEvent, **kwargs)
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.factor = factor
+        # Retries after which the interval stays at maxInterval; the power would overflow after ~1000
+        self.backoffSteps = 0
+        while self.factor > 1 and self.minInterval * self.factor**self.backoffSteps < self.maxInterval:
+            self.backoffSteps += 1
+
+    def pause(self, attempt):
+        return min(self.minInterval * self.factor**min(attempt - 1, self.backoffSteps), self.maxInterval)
+
+
+class StatusPollWait(BackoffWait):
+    """Polls the trigger status bit of WFS_GetStatus, with backoff, and only
+    fetches the image once the camera is no longer awaiting a trigger."""
+    def __init__(self, wfs, instrumentHandle, stopEvent, **kwargs):
+        BackoffWait.__init__(self, wfs, instrumentHandle, stopEvent, **kwargs)
+        self.status = ct.c_int32()
+
+    def triggered(self):
+        devStatus = self.wfs.WFS_GetStatus(self.instrumentHandle, ct.byref(self.status))
+        # On a status error fall back to trying the image call itself
+        return devStatus != 0 or not (self.status.value & WFS_STATBIT_ATR)
+
+
+TRIGGER_WAIT_MODES = {
+    'backoff': BackoffWait,
+    'status': StatusPollWait,
+    'fixed': TriggerWait,
+}
+# Earlier names of the modes, still accepted from existing connection tables
+TRIGGER_WAIT_ALIASES = {
+    'blocking': 'fixed',
+}
+
+def make_trigger_wait(mode, wfs, instrumentHandle, stopEvent, timeout=None):
+    """Trigger wait strategy by name, as set by triggerWaitMode in the connection table."""
+    mode = TRIGGER_WAIT_ALIASES.get(mode, mode)
+    if mode not in TRIGGER_WAIT_MODES:
+        raise ValueError('Unknown trigger wait mode %r, expected one of %s' % (mode, ', '.join(TRIGGER_WAIT_MODES)))
+    return TRIGGER_WAIT_MODES[mode](wfs, instrumentHandle, stopEvent, timeout=timeout)
@@ -0,0 +1,1502 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/ThorlabsWaveFrontSensor/wfs_benchmarks.py      #
+#                                                                   #
+# This file is part of labscript_devices                            #
+#                                                                   #
+#####################################################################
+"""Microbenchmarks for the acquisition and storage paths of the WFS worker.
+
+Run with e.g.
+    python -m labscript_devices.ThorlabsWaveFrontSensor.wfs_benchmarks readout
+No hardware is needed: the SDK is replaced by SimulatedWFS. The lifecycle
+benchmark runs the worker itself and needs blacs and labscript_utils.
+"""
+import argparse
+import ctypes as ct
+import io
+import os
+import tempfile
+import tracemalloc
+import warnings
+from time import perf_counter, process_time, sleep
+from threading import Event
+from contextlib import redirect_stdout
+from multiprocessing import get_context
+import numpy as np
+import h5py
+
+from labscript_devices.ThorlabsWaveFrontSensor.shot_buffers import (
+    FULL_CROP,
+    SCALAR_KEYS,
+    ShotBufferPool,
+    crop_from_attrs,
+    uncrop,
+)
+from labscript_devices.ThorlabsWaveFrontSensor.simulated_wfs import (
+    LENSLET_PITCH_UM,
+    SENSOR_PITCH_UM,
+    SIMULATED_SERIALS,
+    SimulatedWFS,
+    WFS30_RESOLUTIONS,
+)
+from labscript_devices.ThorlabsWaveFrontSensor.h5_writer import StorageCodec, StreamingShotWriter
+from labscript_devices.ThorlabsWaveFrontSensor.pipeline import ProcessingStage
+from labscript_devices.ThorlabsWaveFrontSensor.zernike import (
+    SpotGeometry,
+    ZernikeFitter,
+    pupil_coordinates,
+    pupil_crop,
+    spot_grid_crop,
+    zernike,
+    zernike_modes,
+)
+from labscript_devices.ThorlabsWaveFrontSensor.reprocess import refit_file, reprocess
+from labscript_devices.ThorlabsWaveFrontSensor.centroiding import CentroidEngine, deviations as centroid_deviations
+from labscript_devices.ThorlabsWaveFrontSensor.zonal import ZonalReconstructor
+from labscript_devices.ThorlabsWaveFrontSensor.frame_timing import FRAME_EXPOSURES_KEY, reconcile
+from labscript_devices.ThorlabsWaveFrontSensor.run_store import RunStore, RunStoreWriter
+from labscript_devices.ThorlabsWaveFrontSensor.exposure_table import (
+    COMPUTE_PROFILE_ATTR,
+    EXPOSURE_DTYPE,
+    EXPOSURES_KEY,
+    PROFILES,
+    outputs_mask,
+)
+from labscript_devices.ThorlabsWaveFrontSensor.aggregation import AGGREGATE_KEY, Aggregator
+from labscript_devices.ThorlabsWaveFrontSensor.reference import (
+    REFERENCE_FILE_ATTR,
+    REFERENCE_FRAMES_ATTR,
+    REFERENCE_KEY,
+    STATISTICS_ONLY_SKIPPED,
+    STORE_WAVEFRONTS_ATTR,
+    SUBTRACT_REFERENCE_ATTR,
+    ReferenceTracker,
+    Welford,
+)
+from labscript_devices.ThorlabsWaveFrontSensor.spotfield import SPOTFIELD_KEY, SpotfieldRecorder, read_spotfield
+from labscript_devices.ThorlabsWaveFrontSensor.feedback import FeedbackSubscriber, make_publisher
+from labscript_devices.ThorlabsWaveFrontSensor.device_manager import InstrumentList
+from labscript_devices.ThorlabsWaveFrontSensor.monitor import CONTINUOUS_TRIGGER_MODE, Monitor
+from labscript_devices.ThorlabsWaveFrontSensor.stage_timing import CAPTURE_STAGES, NullTimer, StageTimer
+from labscript_devices.ThorlabsWaveFrontSensor.trigger_wait import (
+    TRIGGER_WAIT_MODES,
+    WFS_ERROR_AWAITING_TRIGGER,
+    make_trigger_wait,
+)
+
+
+def _report(name, seconds, frames):
+    print('%-28s %10.2f us/frame  %10.1f frames/s' % (name, 1e6*seconds/frames, frames/seconds))
+
+
+def bench_readout(frames=1000, zernikeOrder=4):
+    """Post-trigger readout of the spot arrays: legacy double loop vs. the buffer pool."""
+    wfs = SimulatedWFS()
+    handle = ct.c_longlong(1)
+    wfs.WFS_CalcSpotsCentrDiaIntens(handle, 1, 0)
+
+    # Legacy path: shared 80x80 buffers, interleaved element by element
+    arrayDeviation_x = np.zeros((80,80),dtype=np.float32)
+    arrayDeviation_y = np.zeros((80,80),dtype=np.float32)
+    arrayDeviation = np.zeros((80,80,2),dtype=np.float32)
+    arrayIntensity = np.zeros((80,80),dtype=np.float32)
+    dataList = []
+    start = perf_counter()
+    for _ in range(frames):
+        wfs.WFS_GetSpotDeviations(handle, arrayDeviation_x.ctypes.data_as(ct.POINTER(ct.c_double)),
+                                  arrayDeviation_y.ctypes.data_as(ct.POINTER(ct.c_double)))
+        for i in range(80):
+            for j in range(80):
+                arrayDeviation[i][j][0] = arrayDeviation_x[i][j]
+                arrayDeviation[i][j][1] = arrayDeviation_y[i][j]
+        wfs.WFS_GetSpotIntensities(handle, arrayIntensity.ctypes.data_as(ct.POINTER(ct.c_double)))
+        dataList.append({'Spot Deviations':arrayDeviation, 'Spot Intensities':arrayIntensity})
+    _report('legacy loop', perf_counter() - start, frames)
+
+    pool = ShotBufferPool(zernikeOrder)
+    dataList = []
+    start = perf_counter()
+    for _ in range(frames):
+        buffers = pool.acquire()
+        wfs.WFS_GetSpotDeviations(handle, buffers.deviationXPtr, buffers.deviationYPtr)
+        wfs.WFS_GetSpotIntensities(handle, buffers.intensityPtr)
+        dataList.append({'Spot Deviations':buffers.deviationStored, 'Spot Intensities':buffers.intensity})
+    _report('buffer pool', perf_counter() - start, frames)
+    # Every measurement must own its own snapshot
+    assert dataList[0]['Spot Deviations'] is not dataList[-1]['Spot Deviations']
+    assert np.shares_memory(dataList[0]['Spot Deviations'], pool.slots[0].deviations)
+
+
+def _synthetic_shot(frames, zernikeOrder=4):
+    """Measurements with the stored keys and shapes of the worker, filled from a SimulatedWFS."""
+    wfs = SimulatedWFS()
+    handle = ct.c_longlong(1)
+    pool = ShotBufferPool(zernikeOrder)
+    order = ct.c_int32(zernikeOrder)
+    dataList = []
+    for n in range(frames):
+        buffers = pool.acquire()
+        wfs.WFS_CalcSpotsCentrDiaIntens(handle, 1, 0)
+        wfs.WFS_GetSpotDeviations(handle, buffers.deviationXPtr, buffers.deviationYPtr)
+        wfs.WFS_GetSpotIntensities(handle, buffers.intensityPtr)
+        wfs.WFS_CalcWavefront(handle, 0, 1, buffers.wavefrontPtr)
+        wfs.WFS_ZernikeLsf(handle, ct.byref(order), buffers.zernikesPtr, buffers.zernikeRMSPtr,
+                           buffers.ref('Radius of Curvature'))
+        for key in SCALAR_KEYS:
+            buffers.record[key] = n
+        dataList.append(buffers)
+    return pool.layout(), dataList
+
+
+def _legacy_dict(buffers):
+    """The per-measurement dict the worker used to build, with boxed floats for every scalar."""
+    storedData = {key: float(buffers.record[key]) for key in SCALAR_KEYS}
+    storedData.update({
+        'Wavefront': buffers.wavefront,
+        'Zernikes Coefficients': buffers.zernikesStored,
+        'Zernikes RMS': buffers.zernikeRMSStored,
+        'Spot Deviations': buffers.deviationStored,
+        'Spot Intensities': buffers.intensity,
+        'Timestamp': float(buffers.record['Timestamp']),
+    })
+    return storedData
+
+
+def bench_end_of_shot(exposures=(1, 100, 1000), frameInterval=2e-3):
+    """Time spent in transition_to_manual: the old write of the whole shot at once, and the worker's
+    own transition_to_manual on the simulated SDK after the measurements were streamed during the shot."""
+    worker = _simulated_worker()
+    log = io.StringIO()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if worker is not None:
+            with redirect_stdout(log):
+                worker.init()
+                worker.program_manual(_front_panel())
+        for frames in exposures:
+            layout, dataList = _synthetic_shot(frames)
+            legacyList = [_legacy_dict(buffers) for buffers in dataList]
+
+            path = os.path.join(tmpdir, 'legacy_%d.h5' % frames)
+            h5py.File(path, 'w').close()
+            start = perf_counter()
+            with h5py.File(path, 'r+') as f:
+                image_group = f.require_group('images/wfs')
+                for i in range(len(legacyList[0])):
+                    group = image_group.require_group(list(legacyList[0].items())[i][0])
+                    datalistset = []
+                    for j in range(len(legacyList)):
+                        datalistset.append(list(legacyList[j].items())[i][1])
+                    group.create_dataset(list(legacyList[0].items())[i][0], data=datalistset, compression='gzip')
+            legacy = perf_counter() - start
+            if worker is None:
+                print('%5d exposures: end of shot %9.2f ms at once' % (frames, 1e3*legacy))
+                continue
+
+            path = os.path.join(tmpdir, 'streamed_%d.h5' % frames)
+            h5py.File(path, 'w').close()
+            with redirect_stdout(log):
+                worker.transition_to_buffered('wfs', path, {}, False)
+                worker.wfs.schedule_periodic(frameInterval, frames)
+                armed = perf_counter()
+                while len(worker.dataList) < frames and perf_counter() - armed < 10 + 2*frameInterval*frames:
+                    sleep(1e-3)
+                start = perf_counter()
+                worker.transition_to_manual()
+                streamed = perf_counter() - start
+            print('%5d exposures: end of shot %9.2f ms at once, %7.2f ms transition_to_manual' % (
+                frames, 1e3*legacy, 1e3*streamed))
+    if worker is not None:
+        with redirect_stdout(log):
+            worker.shutdown()
+
+
+def bench_trigger_wait(triggers=200, period=5e-3):
+    """CPU load and trigger-to-frame latency of every trigger wait mode, and of the old busy-poll."""
+    handle = ct.c_longlong(1)
+    exposure = ct.c_double()
+    gain = ct.c_double()
+
+    def busy_poll(take):
+        devStatus = take()
+        while devStatus == WFS_ERROR_AWAITING_TRIGGER:
+            sleep(1e-9)
+            devStatus = take()
+        return devStatus
+
+    for mode in ['busy-poll'] + sorted(TRIGGER_WAIT_MODES):
+        wfs = SimulatedWFS()
+        wfs.WFS_SetTriggerMode(handle, ct.c_int32(2))
+        take = lambda: wfs.WFS_TakeSpotfieldImageAutoExpos(handle, ct.byref(exposure), ct.byref(gain))
+        if mode == 'busy-poll':
+            wait = busy_poll
+        else:
+            wait = make_trigger_wait(mode, wfs, handle, Event()).wait
+        latencies = []
+        wfs.schedule_triggers(perf_counter() + period*(1 + np.arange(triggers)))
+        wall, cpu = perf_counter(), process_time()
+        for _ in range(triggers):
+            wait(take)
+            latencies.append(perf_counter() - wfs.lastTriggerTime)
+        wall, cpu = perf_counter() - wall, process_time() - cpu
+        print('%-10s CPU %5.1f %%  latency p50 %7.1f us  p99 %7.1f us' % (
+            mode, 100*cpu/wall, 1e6*np.percentile(latencies, 50), 1e6*np.percentile(latencies, 99)))
+
+
+def bench_pipeline(frames=500, calcTime=1e-3, fitRepeats=8):
+    """Burst throughput with measurements saved on the capture thread vs. on a processing stage.
+
+    The SDK calculations take calcTime per frame and every measurement goes
+    through fitRepeats NumPy least-squares projections standing in for the
+    processors."""
+    rng = np.random.default_rng(0)
+    projection = rng.normal(size=(66, 2*80*80)).astype(np.float32)
+
+    def fit(buffers):
+        for _ in range(fitRepeats):
+            projection @ buffers['Spot Deviations'].ravel()
+        return buffers
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, workers in [('serial', None), ('pipelined', 1), ('pipelined x4', 4)]:
+            wfs = SimulatedWFS(calcTime=calcTime)
+            handle = ct.c_longlong(1)
+            exposure = ct.c_double()
+            gain = ct.c_double()
+            pool = ShotBufferPool(4)
+            layout = pool.layout()
+            path = os.path.join(tmpdir, name + '.h5')
+            h5py.File(path, 'w').close()
+            writer = StreamingShotWriter(path, 'images/wfs', layout)
+            writer.start()
+            stage = ProcessingStage([writer.append], [fit], workers or 1)
+            if workers:
+                stage.start()
+            start = perf_counter()
+            for _ in range(frames):
+                buffers = pool.acquire()
+                wfs.WFS_TakeSpotfieldImageAutoExpos(handle, ct.byref(exposure), ct.byref(gain))
+                wfs.WFS_CalcSpotsCentrDiaIntens(handle, 1, 0)
+                wfs.WFS_GetSpotDeviations(handle, buffers.deviationXPtr, buffers.deviationYPtr)
+                wfs.WFS_GetSpotIntensities(handle, buffers.intensityPtr)
+                wfs.WFS_CalcWavefront(handle, 0, 1, buffers.wavefrontPtr)
+                if workers:
+                    stage.put(buffers)
+                else:
+                    writer.append(fit(buffers))
+            capture = perf_counter() - start
+            stage.close()
+            writer.close()
+            total = perf_counter() - start
+            print('%-13s capture %7.1f shots/s  end to end %7.1f shots/s' % (name, frames/capture, frames/total))
+
+
+def bench_records(frames=10000):
+    """Per-measurement bookkeeping of a long burst: dicts of boxed floats vs. rows of the record table.
+
+    Reports the memory held per measurement besides the (shared) array slots,
+    and the time to turn the shot into a (frames, scalars) table at the end."""
+    pool = ShotBufferPool(4)
+    for _ in range(frames):
+        pool.acquire()
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=(frames, len(SCALAR_KEYS)))
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    dataList = []
+    for buffers, row in zip(pool.slots, values.tolist()):
+        storedData = dict(zip(SCALAR_KEYS, row))
+        storedData.update({
+            'Wavefront': buffers.wavefront,
+            'Zernikes Coefficients': buffers.zernikesStored,
+            'Zernikes RMS': buffers.zernikeRMSStored,
+            'Spot Deviations': buffers.deviationStored,
+            'Spot Intensities': buffers.intensity,
+            'Timestamp': row[0],
+        })
+        dataList.append(storedData)
+    legacyBytes = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    start = perf_counter()
+    table = np.array([[storedData[key] for key in SCALAR_KEYS] for storedData in dataList])
+    legacyTable = perf_counter() - start
+    del dataList
+
+    pool.reset()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    dataList = []
+    for row in values:
+        buffers = pool.acquire()
+        for i, key in enumerate(SCALAR_KEYS):
+            buffers.record[key] = row[i]
+        buffers.record['Timestamp'] = row[0]
+        dataList.append(buffers)
+    recordBytes = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    # The record table itself is allocated with the pool; count it as well
+    recordBytes += sum(records.nbytes for records in pool.blockRecords) * frames / len(pool.slots)
+    start = perf_counter()
+    records = pool.records()[[buffers.index for buffers in dataList]]
+    recordTable = np.stack([records[key] for key in SCALAR_KEYS], axis=-1)
+    recordTime = perf_counter() - start
+    assert np.array_equal(table, recordTable)
+    print('dict per measurement   %7.0f bytes, table %8.2f ms' % (legacyBytes/frames, 1e3*legacyTable))
+    print('record per measurement %7.0f bytes, table %8.2f ms' % (recordBytes/frames, 1e3*recordTime))
+
+
+def bench_crop(frames=500, resolutions=range(6), pupilDiameterMm=3.):
+    """Shot file size and write time per camera resolution, storing the full 80x80 spot arrays,
+    the spot grid of the resolution, or the lenslets around the pupil."""
+    handle = ct.c_longlong(1)
+    spotsX, spotsY = ct.c_int32(), ct.c_int32()
+    order = ct.c_int32(4)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for resolution in resolutions:
+            wfs = SimulatedWFS()
+            wfs.WFS_ConfigureCam(handle, ct.c_int32(0), ct.c_int32(resolution), ct.byref(spotsX), ct.byref(spotsY))
+            geometry = SpotGeometry(spotsX.value, spotsY.value, 150., 5.5, 3700., 0., 0.,
+                                    pupilDiameterMm, pupilDiameterMm)
+            results = []
+            for name, crop in [('full', FULL_CROP), ('grid', spot_grid_crop(geometry)),
+                               ('pupil', pupil_crop(geometry))]:
+                pool = ShotBufferPool(4, crop=crop)
+                path = os.path.join(tmpdir, '%d_%s.h5' % (resolution, name))
+                h5py.File(path, 'w').close()
+                writer = StreamingShotWriter(path, 'images/wfs', pool.layout())
+                writer.start()
+                start = perf_counter()
+                for _ in range(frames):
+                    buffers = pool.acquire()
+                    wfs.WFS_CalcSpotsCentrDiaIntens(handle, 1, 0)
+                    wfs.WFS_GetSpotDeviations(handle, buffers.deviationXPtr, buffers.deviationYPtr)
+                    wfs.WFS_GetSpotIntensities(handle, buffers.intensityPtr)
+                    wfs.WFS_CalcWavefront(handle, 0, 1, buffers.wavefrontPtr)
+                    wfs.WFS_ZernikeLsf(handle, ct.byref(order), buffers.zernikesPtr, buffers.zernikeRMSPtr,
+                                       buffers.ref('Radius of Curvature'))
+                    writer.append(buffers)
+                writer.close()
+                elapsed = perf_counter() - start
+                results.append('%s %6.2f MB %6.0f ms' % (name, os.path.getsize(path)/1e6, 1e3*elapsed))
+            print('res %2d (%2dx%2d spots): %s' % (resolution, spotsX.value, spotsY.value, ' | '.join(results)))
+
+
+def _realistic_shot(frames, resolution=0, zernikeOrder=4, wavefrontNoiseUm=0.005, intensityNoise=0.02):
+    """Measurements as the worker stores them at the given camera resolution: noisy spot
+    deviations from a SimulatedWFS, the wavefront and a Gaussian beam intensity profile
+    with measurement noise added, since the simulator's are the same every frame."""
+    wfs = SimulatedWFS()
+    handle = ct.c_longlong(1)
+    spotsX, spotsY = ct.c_int32(), ct.c_int32()
+    wfs.WFS_ConfigureCam(handle, ct.c_int32(0), ct.c_int32(resolution), ct.byref(spotsX), ct.byref(spotsY))
+    geometry = SpotGeometry(spotsX.value, spotsY.value, 150., 5.5, 3700., 0., 0., 3., 3.)
+    crop = spot_grid_crop(geometry)
+    pool = ShotBufferPool(zernikeOrder, crop=crop)
+    order = ct.c_int32(zernikeOrder)
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[:spotsY.value, :spotsX.value]
+    beam = np.exp(-((x - spotsX.value/2)**2 + (y - spotsY.value/2)**2) / (0.3*spotsX.value)**2)
+    dataList = []
+    for n in range(frames):
+        buffers = pool.acquire()
+        wfs.WFS_CalcSpotsCentrDiaIntens(handle, 1, 0)
+        wfs.WFS_GetSpotDeviations(handle, buffers.deviationXPtr, buffers.deviationYPtr)
+        wfs.WFS_GetSpotIntensities(handle, buffers.intensityPtr)
+        wfs.WFS_CalcWavefront(handle, 0, 1, buffers.wavefrontPtr)
+        wfs.WFS_ZernikeLsf(handle, ct.byref(order), buffers.zernikesPtr, buffers.zernikeRMSPtr,
+                           buffers.ref('Radius of Curvature'))
+        grid = (slice(0, spotsY.value), slice(0, spotsX.value))
+        buffers.wavefront[grid] += rng.normal(0, wavefrontNoiseUm, beam.shape).astype(np.float32)
+        buffers.intensity[grid] = beam * (1 + rng.normal(0, intensityNoise, beam.shape))
+        for key in SCALAR_KEYS:
+            buffers.record[key] = rng.normal()
+        dataList.append(buffers)
+    return pool.layout(), dataList
+
+
+def bench_codecs(frames=1000, resolution=0, threads=4,
+                 codecs=(None, ('gzip', 1), ('gzip', 4), ('gzip', 9), 'lzf', 'blosc', 'zstd')):
+    """Write time and file size per storage codec, with and without the shuffle filter, and for
+    gzip also compressed in a pool of threads with direct chunk writes; the time is from the
+    first append to close(), as at the end of a shot, and every file is read back and checked."""
+    layout, dataList = _realistic_shot(frames, resolution)
+    print('%d frames, camera resolution %d, %d CPUs' % (frames, resolution, os.cpu_count()))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for codec in codecs:
+            codec, level = codec if isinstance(codec, tuple) else (codec, None)
+            try:
+                StorageCodec(codec, level)
+            except ImportError as e:
+                print('%-18s skipped: %s' % (codec, e))
+                continue
+            for shuffle in (False, True):
+                for codecThreads in ((0, threads) if codec in ('gzip', None) else (0,)):
+                    storage = StorageCodec(codec, level, shuffle, codecThreads)
+                    path = os.path.join(tmpdir, 'codec.h5')
+                    h5py.File(path, 'w').close()
+                    writer = StreamingShotWriter(path, 'images/wfs', layout, compression=storage)
+                    writer.start()
+                    start = perf_counter()
+                    for buffers in dataList:
+                        writer.append(buffers)
+                    writer.close()
+                    elapsed = perf_counter() - start
+                    with h5py.File(path, 'r') as f:
+                        for key in ('Wavefront', 'Spot Deviations', 'Spot Intensities'):
+                            stored = f['images/wfs/%s/%s' % (key, key)][:]
+                            assert np.array_equal(stored, np.array([buffers[key] for buffers in dataList]),
+                                                  equal_nan=True), key
+                    name = '%s%s%s' % (codec, '' if level is None else '-%d' % level, '+shuffle' if shuffle else '')
+                    print('%-18s %-9s %8.0f ms %9.0f frames/s %8.2f MB %7.0f bytes/frame' % (
+                        name, '%d threads' % codecThreads if codecThreads else 'in HDF5', 1e3*elapsed,
+                        frames/elapsed, os.path.getsize(path)/1e6, os.path.getsize(path)/frames))
+                    os.remove(path)
+
+
+def bench_reference(frames=1000, captureFrames=100, shotFrames=300):
+    """Reference subtraction in the worker against reloading the shot to subtract a baseline:
+    cost per frame, shot file size and the post-processing it replaces; then two worker shots,
+    one capturing a reference and one subtracting it loaded from the first shot's file."""
+    # Spots outside the pupil are NaN in every frame
+    warnings.simplefilter('ignore', RuntimeWarning)
+    layout, dataList = _realistic_shot(frames)
+    absolute = np.array([buffers.wavefront for buffers in dataList], dtype=np.float64)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        def write(name, layout, dataList):
+            path = os.path.join(tmpdir, name + '.h5')
+            h5py.File(path, 'w').close()
+            writer = StreamingShotWriter(path, 'images/wfs', layout)
+            writer.start()
+            for buffers in dataList:
+                writer.append(buffers)
+            writer.close()
+            return path
+
+        # Post-processing as it is done now: reload the shot and difference it against its mean
+        path = write('absolute', layout, dataList)
+        start = perf_counter()
+        with h5py.File(path, 'r') as f:
+            wavefronts = f['images/wfs/Wavefront/Wavefront'][:]
+            zernikes = f['images/wfs/Zernikes Coefficients/Zernikes Coefficients'][:]
+        baseline = wavefronts[:captureFrames].mean(axis=0)
+        deltas = wavefronts[captureFrames:] - baseline
+        np.nanmean(deltas, axis=0), np.nanstd(deltas, axis=0, ddof=1)
+        zernikeDeltas = zernikes[captureFrames:] - zernikes[:captureFrames].mean(axis=0)
+        np.mean(zernikeDeltas, axis=0), np.std(zernikeDeltas, axis=0, ddof=1)
+        postTime = perf_counter() - start
+        absoluteSize = os.path.getsize(path)
+
+        tracker = ReferenceTracker(captureFrames=captureFrames)
+        start = perf_counter()
+        for buffers in dataList:
+            tracker(buffers)
+        trackTime = perf_counter() - start
+        _report('tracker (capture+subtract)', trackTime, frames)
+        # The running statistics agree with the ones from the whole stack
+        expected = absolute[captureFrames:] - absolute[:captureFrames].mean(axis=0)
+        assert np.allclose(tracker.wavefrontDelta.mean_or_nan(), np.nanmean(expected, axis=0), equal_nan=True, atol=1e-9)
+        assert np.allclose(tracker.wavefrontDelta.std(), np.nanstd(expected, axis=0, ddof=1), equal_nan=True, atol=1e-9)
+        batched = Welford(expected.shape[1:])
+        batched.update_many(expected[:frames//2])
+        batched.update_many(expected[frames//2:])
+        assert np.allclose(batched.std(), tracker.wavefrontDelta.std(), equal_nan=True, atol=1e-9)
+
+        path = write('deltas', layout, dataList)
+        deltaSize = os.path.getsize(path)
+        with h5py.File(path, 'r') as f:
+            datasetSizes = sorted(((f['images/wfs'][key][key].id.get_storage_size(), key) for key in layout),
+                                  reverse=True)
+        # Statistics only: the spot arrays are not stored, only their statistics; the shot is the same
+        _, statsList = _realistic_shot(frames)
+        statsTracker = ReferenceTracker(captureFrames=captureFrames, statisticsOnly=True)
+        start = perf_counter()
+        for buffers in statsList:
+            statsTracker(buffers)
+        _report('tracker, statistics only', perf_counter() - start, frames)
+        statsLayout = {key: value for key, value in layout.items() if key not in STATISTICS_ONLY_SKIPPED}
+        path = write('statistics', statsLayout, statsList)
+        with h5py.File(path, 'r+') as f:
+            statsTracker.save(f['images/wfs'])
+        statsSize = os.path.getsize(path)
+        print('post-processing reload + subtract %8.1f ms for %d frames' % (1e3*postTime, frames))
+        print('shot file: absolute %6.2f MB, differences %6.2f MB, statistics only %6.2f MB' % (
+            absoluteSize/1e6, deltaSize/1e6, statsSize/1e6))
+        print('largest datasets of the differences: ' + ', '.join(
+            '%s %.2f MB' % (key, size/1e6) for size, key in datasetSizes[:3]))
+
+        worker = _simulated_worker()
+        if worker is None:
+            return
+        with redirect_stdout(io.StringIO()):
+            worker.init()
+            worker.program_manual(_front_panel())
+            capturePath = os.path.join(tmpdir, 'capture.h5')
+            _exposures_file(capturePath, 'wfs', [])
+            with h5py.File(capturePath, 'r+') as f:
+                f['devices/wfs'].attrs[REFERENCE_FRAMES_ATTR] = captureFrames
+            captureRate = _free_running_shot(worker, capturePath, shotFrames)
+            worker.reference = None
+            subtractPath = os.path.join(tmpdir, 'subtract.h5')
+            _exposures_file(subtractPath, 'wfs', [])
+            with h5py.File(subtractPath, 'r+') as f:
+                f['devices/wfs'].attrs[SUBTRACT_REFERENCE_ATTR] = True
+                f['devices/wfs'].attrs[REFERENCE_FILE_ATTR] = capturePath
+                f['devices/wfs'].attrs[STORE_WAVEFRONTS_ATTR] = False
+            subtractRate = _free_running_shot(worker, subtractPath, shotFrames)
+            worker.shutdown()
+        for path, rate in ((capturePath, captureRate), (subtractPath, subtractRate)):
+            with h5py.File(path, 'r') as f:
+                group = f['images/wfs']
+                reference = group[REFERENCE_KEY]
+                print('%-8s %7.1f frames/s, reference of %d frames from %s, %d frames subtracted, '
+                      'spot arrays stored: %s, mean |Z5 difference| %.2e um' % (
+                    os.path.basename(path)[:-3], rate, reference.attrs['Frames'],
+                    os.path.basename(reference.attrs['Source']), reference.attrs['Frames Subtracted'],
+                    all(key in group for key in STATISTICS_ONLY_SKIPPED), abs(reference['Zernikes Difference Mean'][4])))
+
+
+def bench_aggregate(frames=1000, binFrames=10, period=1e-3):
+    """Aggregate storage mode against saving every frame: worker memory, time spent writing
+    the shot file and its size for a shot of frames triggers, with and without binning.
+    The reductions are first checked against NumPy on the whole stack."""
+    layout, dataList = _realistic_shot(200)
+    aggregator = Aggregator(layout, binFrames)
+    bins = [binned for binned in map(aggregator.add, dataList) if binned is not None]
+    stack = np.array([buffers['Wavefront'] for buffers in dataList], dtype=np.float64)
+    warnings.simplefilter('ignore', RuntimeWarning)
+    reductions = aggregator.reductions('Wavefront')
+    assert np.allclose(reductions['Mean'], np.nanmean(stack, axis=0), equal_nan=True, atol=1e-6)
+    assert np.allclose(reductions['Std'], np.nanstd(stack, axis=0, ddof=1), equal_nan=True, atol=1e-6)
+    assert np.array_equal(reductions['Max'], np.nanmax(stack, axis=0).astype(np.float32), equal_nan=True)
+    assert np.allclose(bins[0]['Wavefront'], np.nanmean(stack[:binFrames], axis=0), equal_nan=True, atol=1e-6)
+
+    worker = _simulated_worker(stageTiming=True)
+    if worker is None:
+        return
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with redirect_stdout(io.StringIO()):
+            worker.init()
+            worker.program_manual(_front_panel())
+            for mode, bins in (('frames', 0), ('aggregate', 0), ('aggregate', binFrames)):
+                worker.storageMode, worker.binFrames = mode, bins
+                path = os.path.join(tmpdir, '%s_%d.h5' % (mode, bins))
+                h5py.File(path, 'w').close()
+                tracemalloc.start()
+                worker.transition_to_buffered('wfs', path, {}, False)
+                armed = perf_counter()
+                worker.wfs.schedule_periodic(period, frames)
+                while worker.frameCount < frames and perf_counter() - armed < 10 + 2*period*frames:
+                    sleep(1e-3)
+                rate = worker.frameCount / (perf_counter() - armed)
+                worker.transition_to_manual()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                timer = worker.stageTimer
+                writeTime = (timer.table()['HDF5 Write'].sum() + timer.endOfShot['Close Writer']
+                             + timer.endOfShot.get('Save Aggregate', 0.))
+                with h5py.File(path, 'r') as f:
+                    group = f['images/wfs']
+                    stored = len(group['Wavefront/Wavefront']) if 'Wavefront' in group else 0
+                    aggregated = group[AGGREGATE_KEY].attrs['Frames'] if AGGREGATE_KEY in group else 0
+                results.append((mode if not bins else '%s, %d-frame bins' % (mode, bins), rate,
+                                worker.bufferPool.nbytes(), peak, writeTime, os.path.getsize(path),
+                                stored, aggregated))
+            worker.shutdown()
+    print('%d triggers at %.0f/s' % (frames, 1/period))
+    for name, rate, poolBytes, peak, writeTime, size, stored, aggregated in results:
+        print('%-24s %6.0f frames/s  buffers %6.1f MB  peak Python memory %6.1f MB  '
+              'writing %7.1f ms  file %6.2f MB  (%d rows, %d aggregated)' % (
+            name, rate, poolBytes/1e6, peak/1e6, 1e3*writeTime, size/1e6, stored, aggregated))
+
+
+def bench_spotfield(frames=300, resolution=0, crop=512, levels=(1, 4), threads=4, period=2e-3):
+    """Raw spotfield images from SimulatedWFS: capture cost per frame, write throughput from the
+    first image to close() and bytes per frame in the file, whole and cropped, with and without
+    delta encoding. Then the acquisition rate of the worker with and without image capture, with
+    all triggers due at once. Every file is read back with read_spotfield() and checked."""
+    wfs = SimulatedWFS()
+    handle = ct.c_longlong(1)
+    wfs.WFS_ConfigureCam(handle, 0, resolution, ct.byref(ct.c_int32()), ct.byref(ct.c_int32()))
+    spotImage, noiseFields = wfs._spotfield()
+    rows, columns = spotImage.shape
+    print('%d frames of %dx%d, %d CPUs' % (frames, columns, rows, os.cpu_count()))
+    configurations = [(None, False), (None, True), (crop, False), (crop, True)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for level in levels:
+            for codecThreads in (0, threads):
+                for window, delta in configurations:
+                    path = os.path.join(tmpdir, 'spotfield.h5')
+                    with h5py.File(path, 'w') as f:
+                        f.create_group('images/wfs')
+                    recorder = SpotfieldRecorder(path, 'images/wfs', window, delta, wfs.geometry(),
+                                                 StorageCodec('gzip', level, threads=codecThreads))
+                    recorder.start()
+                    wfs.images = 0
+                    captureTime = 0.
+                    start = perf_counter()
+                    for n in range(frames):
+                        begin = perf_counter()
+                        wfs.WFS_GetSpotfieldImageCopy(handle, recorder.imagePtr, ct.byref(recorder.rows),
+                                                      ct.byref(recorder.columns))
+                        recorder.put(n, 0., 0.)
+                        captureTime += perf_counter() - begin
+                    recorder.close()
+                    elapsed = perf_counter() - start
+                    with h5py.File(path, 'r') as f:
+                        group = f['images/wfs']
+                        stored = group[SPOTFIELD_KEY][SPOTFIELD_KEY].id.get_storage_size()
+                        check = frames - 5
+                        images, corners = read_spotfield(group, check, frames)
+                    for n, image, (frame, row, column) in zip(range(check, frames), images, corners):
+                        expected = spotImage + noiseFields[n % len(noiseFields)]
+                        assert frame == n
+                        assert np.array_equal(image, expected[row:row+image.shape[0], column:column+image.shape[1]])
+                    name = '%s%s' % ('whole' if window is None else '%d crop' % window, ' +delta' if delta else '')
+                    print('gzip-%d %-9s %-16s capture %6.0f us/frame  write %6.0f frames/s %7.1f MB/s  '
+                          '%9.0f bytes/frame' % (
+                        level, '%d threads' % codecThreads if codecThreads else 'inline', name,
+                        1e6*captureTime/frames, frames/elapsed, stored/elapsed/1e6, stored/frames))
+                    os.remove(path)
+
+        worker = _simulated_worker(stageTiming=True)
+        if worker is None:
+            return
+        results = []
+        with redirect_stdout(io.StringIO()):
+            worker.init()
+            worker.program_manual(_front_panel(resolution))
+            for images, window, delta in ((False, None, False), (True, None, False), (True, crop, True)):
+                worker.spotfieldImages, worker.spotfieldCrop, worker.spotfieldDelta = images, window, delta
+                path = os.path.join(tmpdir, 'shot.h5')
+                h5py.File(path, 'w').close()
+                rate = _free_running_shot(worker, path, frames)
+                copy = np.median(worker.stageTimer.table()['Spotfield Copy'])
+                closing = worker.stageTimer.endOfShot.get('Close Spotfield', 0.)
+                with h5py.File(path, 'r') as f:
+                    group = f['images/wfs']
+                    saved = len(group[SPOTFIELD_KEY][SPOTFIELD_KEY]) if SPOTFIELD_KEY in group else 0
+                results.append((images, window, delta, rate, copy, closing, saved))
+                os.remove(path)
+            worker.shutdown()
+    for images, window, delta, rate, copy, closing, saved in results:
+        name = 'no images' if not images else '%s%s' % ('whole' if window is None else '%d crop' % window,
+                                                        ' +delta' if delta else '')
+        print('worker, %-16s %6.0f frames/s  copy p50 %6.0f us  images left at the end %6.0f ms  (%d saved)' % (
+            name, rate, 1e6*copy, 1e3*closing, saved))
+
+
+def bench_zernike(frames=1000, order=6):
+    """NumPy Zernike fit: building the basis, then per-frame and batched fits from the cache."""
+    geometry = SpotGeometry(40, 30, 150., 5.5, 3700., 0., 0., 4., 4.)
+    deviations = np.random.default_rng(0).normal(0, 0.1, (frames, 80, 80, 2)).astype(np.float32)
+    fitter = ZernikeFitter()
+    start = perf_counter()
+    fitter.basis(geometry, order)
+    print('basis build %8.2f ms' % (1e3*(perf_counter() - start)))
+    start = perf_counter()
+    for frame in deviations:
+        fitter.fit(frame, geometry, order)
+    _report('per frame (cached)', perf_counter() - start, frames)
+    start = perf_counter()
+    fitter.fit(deviations, geometry, order)
+    _report('batch', perf_counter() - start, frames)
+
+
+def _spotfield_frames(frames, resolution, zernikes=None, noise=0.1):
+    """(images, deviations in sensor pixels, spotsX, spotsY) of frames SimulatedWFS frames."""
+    wfs = SimulatedWFS(zernikes=zernikes, noise=noise)
+    handle = ct.c_longlong(1)
+    spotsX, spotsY = ct.c_int32(), ct.c_int32()
+    wfs.WFS_ConfigureCam(handle, 0, resolution, ct.byref(spotsX), ct.byref(spotsY))
+    recorder = SpotfieldRecorder(None, None)
+    images, deviations = [], []
+    for _ in range(frames):
+        wfs.WFS_CalcSpotsCentrDiaIntens(handle, 1, 0)
+        wfs.WFS_GetSpotfieldImageCopy(handle, recorder.imagePtr, ct.byref(recorder.rows), ct.byref(recorder.columns))
+        images.append(recorder.image[:recorder.rows.value*recorder.columns.value].reshape(
+            recorder.rows.value, recorder.columns.value).copy())
+        deviations.append(np.moveaxis(wfs.deviations[:, :spotsY.value, :spotsX.value], 0, -1).copy())
+    return np.array(images), np.array(deviations), spotsX.value, spotsY.value
+
+
+def bench_centroiding(frames=64, resolutions=(0, 4, 6, 10), zernikes={3: 0.2, 5: 0.5}, shotFrames=200):
+    """NumPy centroiding of simulated spotfield images: grid build, frame by frame and whole stacks,
+    and the error of the deviations against the ones the images were drawn with, with the dynamic
+    and a fixed noise cut. Then a shot saved with spotfieldImages is refitted from its images
+    (reprocess --recentroid) and compared with the refit of its stored deviations."""
+    print('%-14s %10s %14s %14s %9s %10s %10s' % ('resolution', 'grid ms', 'frame ms', 'stack ms', 'found',
+                                                   'rms px', 'p99 px'))
+    for resolution in resolutions:
+        columns, rows, binning = WFS30_RESOLUTIONS[resolution]
+        images, expected, spotsX, spotsY = _spotfield_frames(frames, resolution, zernikes)
+        for dynamicNoiseCut in (True, False):
+            engine = CentroidEngine(SENSOR_PITCH_UM, LENSLET_PITCH_UM, dynamicNoiseCut=dynamicNoiseCut,
+                                    noiseCut=8.)
+            start = perf_counter()
+            engine.grid(resolution, images.shape[1:], spotsX, spotsY)
+            gridTime = perf_counter() - start
+            start = perf_counter()
+            for image in images:
+                engine.centroid(image, resolution, spotsX, spotsY)
+            frameTime = (perf_counter() - start) / frames
+            start = perf_counter()
+            centroids = engine.centroid(images, resolution, spotsX, spotsY)
+            stackTime = (perf_counter() - start) / frames
+            error = binning * centroid_deviations(centroids) - expected
+            found = np.isfinite(error[..., 0])
+            name = '%dx%d%s' % (columns, rows, '' if dynamicNoiseCut else ' cut 8')
+            print('%-14s %10.2f %14.2f %14.2f %8.0f%% %10.3f %10.3f' % (
+                name, 1e3*gridTime, 1e3*frameTime, 1e3*stackTime, 100*found.mean(),
+                np.sqrt(np.mean(error[found]**2)), np.percentile(np.abs(error[found]), 99)))
+
+    worker = _simulated_worker(spotfieldImages=True)
+    if worker is None:
+        return
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, 'shot.h5')
+        h5py.File(path, 'w').close()
+        with redirect_stdout(io.StringIO()):
+            worker.init()
+            worker.program_manual(_front_panel())
+            worker.wfs.zernikes = dict(zernikes)
+            _free_running_shot(worker, path, shotFrames)
+            worker.shutdown()
+        start = perf_counter()
+        (_, stored, _, _), = refit_file(path, 4)
+        storedTime = perf_counter() - start
+        start = perf_counter()
+        (_, recentroided, _, _), = refit_file(path, 4, recentroid=True)
+        recentroidTime = perf_counter() - start
+    print('refit of a %d-frame shot: stored deviations %.0f ms, recentroided from the images %.0f ms '
+          '(%.1f ms/frame)' % (shotFrames, 1e3*storedTime, 1e3*recentroidTime, 1e3*recentroidTime/shotFrames))
+    print('Zernike coefficients Z2-Z15, recentroided - stored: rms %.4f um, max %.4f um (defocus %.3f um)' % (
+        np.sqrt(np.mean((recentroided - stored)[:, 1:]**2)), np.abs(recentroided - stored)[:, 1:].max(),
+        stored[:, 4].mean()))
+
+
+def _dense_southwell(deviations, geometry):
+    """Zonal wavefront of one (rows, cols, 2) frame by a dense least-squares solve of its own
+    Southwell differences, built for the frame, as a reference for zonal.py."""
+    _, _, mask = pupil_coordinates(geometry)
+    deviations = deviations[:geometry.spotsY, :geometry.spotsX]
+    index = np.full(mask.shape, -1)
+    index[mask] = np.arange(mask.sum())
+    scale = 0.5 * geometry.lensletPitchUm * geometry.camPitchUm / geometry.lensletFocalUm
+    rows, differences = [], []
+    for axis, step in ((1, (0, 1)), (0, (1, 0))):
+        first = index[:mask.shape[0]-step[0], :mask.shape[1]-step[1]]
+        second = index[step[0]:, step[1]:]
+        difference = scale * (deviations[:mask.shape[0]-step[0], :mask.shape[1]-step[1], 1-axis]
+                              + deviations[step[0]:, step[1]:, 1-axis])
+        edges = (first >= 0) & (second >= 0) & np.isfinite(difference)
+        rows += list(zip(first[edges], second[edges]))
+        differences.append(difference[edges])
+    matrix = np.zeros((len(rows), mask.sum()))
+    matrix[np.arange(len(rows)), [j for i, j in rows]] = 1.
+    matrix[np.arange(len(rows)), [i for i, j in rows]] = -1.
+    solution = np.linalg.lstsq(matrix, np.concatenate(differences), rcond=None)[0]
+    wavefront = np.full(mask.shape, np.nan)
+    wavefront[mask] = solution - solution.mean()
+    return wavefront
+
+
+def bench_zonal(frames=256, denseFrames=4, pupils=(3., 6., 9.), zernikes={3: 0.2, 5: 0.5, 8: 0.1, 12: 0.05},
+                noise=0.05, shotFrames=300):
+    """Zonal wavefront reconstruction (zonal.py) of the spot deviations of a WFS30 lenslet grid for
+    several pupils: building the cached solver, frame by frame and whole stacks, against a dense
+    least-squares solve built for every frame, and the error against the noise free wavefront.
+    Then shots of the worker on the simulated SDK: the zonal reconstruction of the stored
+    deviations against the Wavefront dataset from WFS_CalcWavefront, and the frame rate with
+    wavefrontSolver 'sdk' and 'zonal'. The simulator's WFS_CalcWavefront is its own analytic
+    wavefront, not the SDK's reconstruction, so this only shows that the solver recovers a known
+    wavefront; tests/test_zonal.py checks it against a shot taken with the real SDK."""
+    rng = np.random.default_rng(0)
+    print('%-8s %8s %10s %10s %10s %10s %12s %12s %12s' % ('pupil', 'lenslets', 'build ms', 'dense ms', 'frame ms',
+                                                          'stack ms', 'vs dense um', 'rms err um', 'iterations'))
+    for pupilDiameterMm in pupils:
+        geometry = SpotGeometry(71, 44, LENSLET_PITCH_UM, SENSOR_PITCH_UM, 3700., 0., 0.,
+                                pupilDiameterMm, pupilDiameterMm)
+        u, v, mask = pupil_coordinates(geometry)
+        wavefront = np.zeros(u.shape)
+        slopes = np.zeros(u.shape + (2,))
+        modes = zernike_modes(10)
+        for mode, coefficient in zernikes.items():
+            Z, dZdu, dZdv = zernike(*modes[mode-1], u, v)
+            wavefront += coefficient * Z
+            slopes[..., 0] += coefficient * dZdu / (5e2*pupilDiameterMm)
+            slopes[..., 1] += coefficient * dZdv / (5e2*pupilDiameterMm)
+        wavefront -= wavefront[mask].mean()
+        deviations = (slopes * geometry.lensletFocalUm / geometry.camPitchUm
+                      + rng.normal(0, noise, (frames,) + slopes.shape)).astype(np.float32)
+        reconstructor = ZonalReconstructor()
+        start = perf_counter()
+        solver = reconstructor.solver(geometry)
+        buildTime = perf_counter() - start
+        start = perf_counter()
+        dense = [_dense_southwell(frame, geometry) for frame in deviations[:denseFrames]]
+        denseTime = (perf_counter() - start) / denseFrames
+        start = perf_counter()
+        for frame in deviations:
+            reconstructor.reconstruct(frame, geometry)
+        frameTime = (perf_counter() - start) / frames
+        start = perf_counter()
+        stack = reconstructor.reconstruct(deviations, geometry)
+        stackTime = (perf_counter() - start) / frames
+        print('%-8s %8d %10.2f %10.1f %10.3f %10.3f %12.2g %12.4f %12d' % (
+            '%g mm' % pupilDiameterMm, mask.sum(), 1e3*buildTime, 1e3*denseTime, 1e3*frameTime, 1e3*stackTime,
+            np.abs(stack[:denseFrames][:, mask] - np.array(dense)[:, mask]).max(),
+            np.sqrt(np.mean((stack[:, mask] - wavefront[mask])**2)), solver.iterations))
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for solverName in ('sdk', 'zonal'):
+            worker = _simulated_worker(wavefrontSolver=solverName)
+            if worker is None:
+                return
+            path = os.path.join(tmpdir, solverName + '.h5')
+            h5py.File(path, 'w').close()
+            with redirect_stdout(io.StringIO()):
+                worker.init()
+                worker.program_manual(_front_panel(pupilDiameterMm=4.))
+                worker.wfs.zernikes = dict(zernikes)
+                rate = _free_running_shot(worker, path, shotFrames)
+                worker.shutdown()
+            start = perf_counter()
+            refit_file(path, 4, groupName='Zonal', zonal=True)
+            refitTime = perf_counter() - start
+            with h5py.File(path, 'r') as f:
+                group = f['images/wfs']
+                stored = uncrop(group['Wavefront/Wavefront'][:], crop_from_attrs(group.attrs))
+                zonal = uncrop(group['Zonal/Wavefront'][:], crop_from_attrs(group['Zonal'].attrs))
+                rms = group['Wavefront RMS/Wavefront RMS'][:]
+            results.append((solverName, rate, refitTime, stored, zonal, rms))
+    (_, sdkRate, refitTime, sdkWavefront, zonal, sdkRMS), (_, zonalRate, _, zonalWavefront, _, zonalRMS) = results
+    valid = np.isfinite(sdkWavefront) & np.isfinite(zonal)
+    # WFS_CalcWavefront leaves the piston in, so both are compared without their means
+    piston = lambda w: np.where(valid, w, 0.).sum(axis=(1, 2), keepdims=True) / valid.sum(axis=(1, 2), keepdims=True)
+    difference = (zonal - piston(zonal)) - (sdkWavefront - piston(sdkWavefront))
+    print('shot of %d frames, 4 mm pupil: zonal refit %.0f ms (%.2f ms/frame); zonal - SDK Wavefront rms %.4f um, '
+          'max %.4f um, over %.0f%% of the SDK lenslets (SDK wavefront rms %.3f um)' % (
+              shotFrames, 1e3*refitTime, 1e3*refitTime/shotFrames, np.sqrt(np.mean(difference[valid]**2)),
+              np.abs(difference[valid]).max(), 100*valid.sum()/np.isfinite(sdkWavefront).sum(),
+              np.nanmean(sdkRMS)))
+    print('worker: wavefrontSolver sdk %.0f frames/s, zonal %.0f frames/s; Wavefront RMS sdk %.4f um, zonal %.4f um; '
+          'stored zonal - refit max %.2g um' % (sdkRate, zonalRate, np.nanmean(sdkRMS), np.nanmean(zonalRMS),
+                                              np.nanmax(np.abs(zonalWavefront[:len(zonal)] - results[1][4]))))
+
+
+def _write_shot_corpus(directory, files, frames, orientation='wfs'):
+    """Shot files with the images/<orientation> layout and attributes written by the worker."""
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(files):
+        path = os.path.join(directory, 'shot_%04d.h5' % i)
+        with h5py.File(path, 'w') as f:
+            group = f.require_group('images/' + orientation)
+            group.attrs.update({'Spots X': 40, 'Spots Y': 30, 'Camera Pitch': 5.5, 'Lenslet Pitch': 150.,
+                                'Lenslet Focal Length': 3700., 'Pupil Center X': 0., 'Pupil Center Y': 0.,
+                                'Pupil Diameter X': 4., 'Pupil Diameter Y': 4., 'Highest Zernike Order': 4})
+            deviations = np.zeros((frames, 80, 80, 2), dtype=np.float32)
+            deviations[:, :30, :40] = rng.normal(0, 0.1, (frames, 30, 40, 2))
+            group.require_group('Spot Deviations').create_dataset('Spot Deviations', data=deviations,
+                                                                  compression='gzip')
+        paths.append(path)
+    return paths
+
+
+def bench_reprocess(files=200, frames=20, order=8):
+    """Offline Zernike refit of a synthetic corpus of shot files, in files per second."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = _write_shot_corpus(tmpdir, files, frames)
+        for processes in (1, os.cpu_count()):
+            start = perf_counter()
+            reprocess(paths, order, processes=processes, progress=False,
+                      summaryPath=os.path.join(tmpdir, 'summary.h5'))
+            elapsed = perf_counter() - start
+            print('%2d processes: %7.1f files/s (%d frames each)' % (processes, files/elapsed, frames))
+
+
+def bench_run_store(shots=500, frames=20, scalars=19):
+    """Pulling Zernikes and Wavefront RMS for a time window: run store query vs. walking shot files."""
+    rng = np.random.default_rng(0)
+    keys = ['Wavefront RMS'] + ['Scalar %d' % i for i in range(scalars - 1)]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = RunStoreWriter(os.path.join(tmpdir, 'run.h5'), keys)
+        paths = []
+        t0 = 1.7e9
+        for i in range(shots):
+            times = t0 + 10*i + 0.1*np.arange(frames)
+            values = rng.normal(size=(frames, scalars))
+            zernikes = rng.normal(size=(frames, 15)).astype(np.float32)
+            path = os.path.join(tmpdir, 'shot_%04d.h5' % i)
+            with h5py.File(path, 'w') as f:
+                group = f.require_group('images/wfs')
+                group.require_group('Timestamp').create_dataset('Timestamp', data=times)
+                group.require_group('Wavefront RMS').create_dataset('Wavefront RMS', data=values[:, 0])
+                group.require_group('Zernikes Coefficients').create_dataset(
+                    'Zernikes Coefficients', data=zernikes, compression='gzip')
+            store.append_shot(os.path.basename(path), times, values, zernikes)
+            paths.append(path)
+
+        # The last quarter of the run
+        start, stop = t0 + 7.5*shots, t0 + 10*shots
+        begin = perf_counter()
+        walked = []
+        for path in paths:
+            with h5py.File(path, 'r') as f:
+                group = f['images/wfs']
+                times = group['Timestamp/Timestamp'][:]
+                selected = (times >= start) & (times < stop)
+                if selected.any():
+                    walked.append((group['Zernikes Coefficients/Zernikes Coefficients'][:][selected],
+                                   group['Wavefront RMS/Wavefront RMS'][:][selected]))
+        walk = perf_counter() - begin
+
+        begin = perf_counter()
+        reader = RunStore(os.path.join(tmpdir, 'run.h5'))
+        opened = perf_counter() - begin
+        begin = perf_counter()
+        result = reader.time_window(start, stop)
+        query = perf_counter() - begin
+        assert len(result['time']) == sum(len(rms) for _, rms in walked)
+        print('%d shots x %d frames, %d rows selected' % (shots, frames, len(result['time'])))
+        print('walk shot files   %9.2f ms' % (1e3*walk))
+        print('run store open    %9.2f ms, time window query %6.2f ms' % (1e3*opened, 1e3*query))
+
+
+def _simulated_worker(**properties):
+    """ThorlabsWaveFrontSensorWorker on the simulated SDK, without the BLACS process plumbing;
+    None if the worker cannot be imported. properties override the connection table defaults."""
+    try:
+        from labscript_devices.ThorlabsWaveFrontSensor.blacs_workers import ThorlabsWaveFrontSensorWorker
+    except ImportError as e:
+        print('skipped, the worker cannot be imported: %s' % e)
+        return None
+    worker = ThorlabsWaveFrontSensorWorker.__new__(ThorlabsWaveFrontSensorWorker)
+    # What the tab passes to create_worker
+    worker.__dict__.update(serialNum='M00000000', orientation=None, device_name='wfs',
+                           triggerWaitMode='backoff', triggerWaitTimeout=None, runStorePath=None,
+                           cropToPupil=False, sdkBackend='simulated', stageTiming=False,
+                           computeProfile='full', feedbackAddress=None, compression='gzip',
+                           compressionLevel=None, shuffle=False, compressionThreads=0,
+                           storageMode='frames', binFrames=0, spotfieldImages=False,
+                           spotfieldCrop=None, spotfieldDelta=False, wavefrontSolver='sdk',
+                           processingWorkers=1)
+    worker.__dict__.update(properties)
+    return worker
+
+def _front_panel(resolution=0, zernikeOrder=4, pupilDiameterMm=3.):
+    return {'Resolution Index': resolution, 'Pupil Center X': 0., 'Pupil Center Y': 0.,
+            'Pupil Diameter X': pupilDiameterMm, 'Pupil Diameter Y': pupilDiameterMm,
+            'Highest Zernike Order': zernikeOrder, 'Fourier Order': 2, 'Limited to Pupil?': 1}
+
+
+def bench_lifecycle(shots=5, frames=500, period=2e-3, resolution=0, zernikeOrder=4):
+    """The whole worker against the simulated SDK: init and program_manual, then per shot
+    transition_to_buffered, frames triggers period seconds apart and transition_to_manual.
+
+    Reports the acquisition rate, the time spent in transition_to_manual and the
+    peak Python memory over all shots."""
+    worker = _simulated_worker()
+    if worker is None:
+        return
+    frontPanel = _front_panel(resolution, zernikeOrder)
+    log = io.StringIO()
+    with tempfile.TemporaryDirectory() as tmpdir, redirect_stdout(log):
+        start = perf_counter()
+        worker.init()
+        worker.program_manual(frontPanel)
+        startup = perf_counter() - start
+        tracemalloc.start()
+        results = []
+        for shot in range(shots):
+            path = os.path.join(tmpdir, 'shot_%d.h5' % shot)
+            h5py.File(path, 'w').close()
+            start = perf_counter()
+            worker.transition_to_buffered('wfs', path, {}, shot == 0)
+            armed = perf_counter()
+            worker.wfs.schedule_periodic(period, frames)
+            while len(worker.dataList) < frames and perf_counter() - armed < 10 + 2*period*frames:
+                sleep(1e-3)
+            acquired = perf_counter()
+            worker.transition_to_manual()
+            done = perf_counter()
+            results.append((armed - start, len(worker.dataList) / (acquired - armed), done - acquired))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        worker.shutdown()
+    print('startup (init + program_manual) %8.1f ms' % (1e3*startup))
+    for shot, (arm, rate, endOfShot) in enumerate(results):
+        print('shot %d: arm %7.1f ms  %7.1f frames/s (trigger rate %.0f/s)  end of shot %7.1f ms' % (
+            shot, 1e3*arm, rate, 1/period, 1e3*endOfShot))
+    print('peak Python memory %8.1f MB' % (peak/1e6))
+
+
+def bench_smart_programming(shots=50, configureTime=0.1):
+    """program_manual after every shot with unchanged front panel values: every setting sent
+    again vs. only the changed ones, with WFS_ConfigureCam taking configureTime seconds."""
+    worker = _simulated_worker()
+    if worker is None:
+        return
+    log = io.StringIO()
+    with redirect_stdout(log):
+        worker.init()
+        worker.wfs.configureTime = configureTime
+        worker.program_manual(_front_panel())
+    for name, smart in [('reprogram all', False), ('smart', True)]:
+        worker.settingsCache.calls.clear()
+        start = perf_counter()
+        with redirect_stdout(log):
+            for shot in range(shots):
+                if not smart:
+                    worker.settingsCache.invalidate()
+                worker.program_manual(_front_panel())
+        elapsed = perf_counter() - start
+        print('%-14s %7.1f ms per shot, SDK calls %s' % (name, 1e3*elapsed/shots, dict(worker.settingsCache.calls)))
+    # A changed pupil is still applied, without reconfiguring the camera; tests/test_smart_programming.py
+    # checks the calls of every case
+    worker.settingsCache.calls.clear()
+    with redirect_stdout(log):
+        worker.program_manual(_front_panel(pupilDiameterMm=2.))
+    print('new pupil      SDK calls %s' % dict(worker.settingsCache.calls))
+    worker.shutdown()
+
+
+def bench_stage_timing(frames=20000, shotFrames=300, period=2e-3):
+    """Cost of the stage instrumentation per frame, off and on, then the per-stage summary of
+    a shot of the worker on the simulated SDK."""
+    for timer in (NullTimer(), StageTimer()):
+        lap = timer.lap
+        start = perf_counter()
+        for frame in range(frames):
+            timer.start(frame)
+            for stage in CAPTURE_STAGES:
+                lap(stage)
+        _report('%s, %d laps' % (type(timer).__name__, len(CAPTURE_STAGES)), perf_counter() - start, frames)
+
+    worker = _simulated_worker(stageTiming=True)
+    if worker is None:
+        return
+    log = io.StringIO()
+    with tempfile.TemporaryDirectory() as tmpdir, redirect_stdout(log):
+        worker.init()
+        worker.program_manual(_front_panel())
+        path = os.path.join(tmpdir, 'shot.h5')
+        h5py.File(path, 'w').close()
+        worker.transition_to_buffered('wfs', path, {}, True)
+        worker.wfs.schedule_periodic(period, shotFrames)
+        while len(worker.dataList) < shotFrames:
+            sleep(1e-3)
+        worker.transition_to_manual()
+        worker.shutdown()
+        with h5py.File(path, 'r') as f:
+            table = f['images/wfs/Stage Timings/Stage Timings']
+            assert len(table) >= shotFrames
+    print('\n'.join(worker.stageTimer.summary()))
+
+
+
+def _exposures_file(path, device, exposures, computeProfile=None):
+    """Shot file holding what generate_code compiles: the EXPOSURES table from the given
+    expose() rows and the compute profile set for the shot, if any."""
+    with h5py.File(path, 'w') as f:
+        group = f.require_group('devices/' + device)
+        if computeProfile is not None:
+            group.attrs[COMPUTE_PROFILE_ATTR] = outputs_mask(computeProfile)
+        if exposures:
+            group.create_dataset(EXPOSURES_KEY, data=np.array(exposures, dtype=EXPOSURE_DTYPE))
+
+def _free_running_shot(worker, path, frames):
+    """One shot with all frames triggered at once, so the worker runs as fast as it can; frames/s."""
+    worker.transition_to_buffered('wfs', path, {}, False)
+    start = perf_counter()
+    worker.wfs.schedule_triggers([start] * frames)
+    while len(worker.dataList) < frames and perf_counter() - start < 60:
+        sleep(1e-3)
+    rate = len(worker.dataList) / (perf_counter() - start)
+    worker.transition_to_manual()
+    return rate
+
+
+def bench_exposures(frames=300, autoExposureTime=5e-3):
+    """Frames per second of a shot with auto exposure and every output, the default, against
+    fixed exposures from an EXPOSURES table, with every output and with the centroid only.
+    The simulated exposure search takes autoExposureTime seconds per frame."""
+    worker = _simulated_worker()
+    if worker is None:
+        return
+    log = io.StringIO()
+    fixed = lambda outputs: [(1e-3*i, 0.5, 1., -1, -1, -1 if outputs is None else outputs_mask(outputs))
+                             for i in range(frames)]
+    shots = [
+        ('auto exposure, all outputs', []),
+        ('fixed exposure, all outputs', fixed(None)),
+        ('fixed exposure, centroid', fixed(['centroid'])),
+    ]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with redirect_stdout(log):
+            worker.init()
+            worker.wfs.autoExposureTime = autoExposureTime
+            worker.program_manual(_front_panel())
+        for i, (name, exposures) in enumerate(shots):
+            path = os.path.join(tmpdir, 'shot_%d.h5' % i)
+            _exposures_file(path, 'wfs', exposures)
+            with redirect_stdout(log):
+                rate = _free_running_shot(worker, path, frames)
+            with h5py.File(path, 'r') as f:
+                measurements = f['images/wfs/Measurements/Measurements'][:]
+            print('%-28s %8.1f frames/s, exposure %s ms, beam center %s, wavefront RMS %s' % (
+                name, rate, measurements['Exposure Time'][0], measurements['Beam Center X'][0],
+                measurements['Wavefront RMS'][0]))
+        worker.shutdown()
+
+
+
+def bench_frame_timing(exposures=300, periods=(5e-3, 2e-3, 1e-3), calcTime=1.5e-3, frames=100000):
+    """Reconciliation of the frames with the expose() times: shots of exposures triggers period
+    seconds apart against a worker that takes about calcTime seconds per frame, with a camera that
+    loses the triggers it is not armed for and with one that keeps them. The Frame Exposures table
+    is checked against the trigger the simulated SDK actually returned for every frame. Then the
+    cost of reconciling a shot of frames frames."""
+    worker = _simulated_worker()
+    if worker is None:
+        return
+    log = io.StringIO()
+    print('%-22s %7s %7s %8s %6s %10s %8s %12s %10s' % ('shot', 'frames', 'dropped', 'truth', 'late',
+                                                       'unmatched', 'correct', 'delay p99 ms', 'safe Hz'))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with redirect_stdout(log):
+            worker.init()
+            worker.program_manual(_front_panel())
+        wfs = worker.wfs
+        wfs.calcTime = calcTime
+        for dropUnarmed in (True, False):
+            for period in periods:
+                path = os.path.join(tmpdir, 'shot_%g_%d.h5' % (period, dropUnarmed))
+                times = period * np.arange(exposures)
+                _exposures_file(path, 'wfs', [(t, 0.5, 1., -1, -1, -1) for t in times])
+                wfs.dropUnarmed = dropUnarmed
+                wfs.droppedTriggers = 0
+                wfs.capturedTriggers = []
+                with redirect_stdout(log):
+                    worker.transition_to_buffered('wfs', path, {}, False)
+                    start = perf_counter() + 0.05
+                    wfs.schedule_triggers(start + times)
+                    while perf_counter() < start + times[-1] + 0.5 and len(worker.dataList) < exposures:
+                        sleep(1e-3)
+                    worker.transition_to_manual()
+                # Triggers still queued at the end were never captured either
+                lost = wfs.droppedTriggers + len(wfs.triggerTimes)
+                wfs.triggerTimes.clear()
+                truth = np.searchsorted(start + times, np.array(wfs.capturedTriggers))
+                with h5py.File(path, 'r') as f:
+                    dataset = f['images/wfs/%s/%s' % (FRAME_EXPOSURES_KEY, FRAME_EXPOSURES_KEY)]
+                    table, attrs = dataset[:], dict(dataset.attrs)
+                matched = table[(table['Frame'] >= 0) & (table['Exposure'] >= 0)]
+                correct = (truth[matched['Frame']] == matched['Exposure']).sum()
+                print('%-22s %7d %7d %8d %6d %10d %7.0f%% %12.2f %10.0f' % (
+                    '%g ms, %s' % (1e3*period, 'drop unarmed' if dropUnarmed else 'keep triggers'),
+                    attrs['Frames'], attrs['Dropped'], lost, attrs['Late'], attrs['Unmatched Frames'],
+                    100*correct/max(len(truth), 1), 1e3*np.nanpercentile(table['Delay'], 99),
+                    attrs['Max Safe Trigger Rate']))
+        worker.shutdown()
+
+    rng = np.random.default_rng(0)
+    times = 1e-3 * np.arange(frames)
+    arrival = times + 2e-4 + rng.exponential(1e-4, frames)
+    ready = np.concatenate([[-1.], arrival[:-1] + 5e-4])
+    start = perf_counter()
+    table, summary = reconcile(times, ready, arrival)
+    _report('reconcile %d frames' % frames, perf_counter() - start, frames)
+    assert summary['Dropped'] == 0 and (table['Frame'] == np.arange(frames)).all()
+
+
+def bench_profiles(frames=300, calcTime=0., custom=('wavefront', 'statistics')):
+    """Frames per second of a free running shot for each compute profile, set per shot, and
+    for the custom list of outputs set in the connection table; and the datasets stored."""
+    worker = _simulated_worker(computeProfile=list(custom))
+    if worker is None:
+        return
+    log = io.StringIO()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        with redirect_stdout(log):
+            worker.init()
+            worker.wfs.calcTime = calcTime
+            worker.program_manual(_front_panel())
+        for profile in list(PROFILES) + [None]:
+            path = os.path.join(tmpdir, 'shot_%s.h5' % profile)
+            _exposures_file(path, 'wfs', [], profile)
+            with redirect_stdout(log):
+                rate = _free_running_shot(worker, path, frames)
+            with h5py.File(path, 'r') as f:
+                group = f['images/wfs']
+                datasets = [key for key in group if key not in group['Measurements/Measurements'].dtype.names]
+                fields = len(group['Measurements/Measurements'].dtype.names)
+            print('%-14s %8.1f frames/s  %2d record fields, %s' % (
+                profile or 'custom', rate, fields, ', '.join(sorted(datasets))))
+        worker.shutdown()
+
+
+
+def _feedback_subscriber(address, messages, ready, results):
+    """Subscriber process of bench_feedback: publish-to-receive latency of every message."""
+    subscriber = FeedbackSubscriber(address)
+    ready.set()
+    latencies = []
+    while len(latencies) < messages:
+        message = subscriber.receive(timeout=5.)
+        if message is None:
+            break
+        latencies.append(perf_counter() - message['Publish Time'])
+    results.put((latencies, subscriber.dropped))
+    subscriber.close()
+
+def bench_feedback(messages=2000, period=1e-3, addresses=('wfs_bench_feedback', 'tcp://127.0.0.1:5561')):
+    """Cost of publishing a frame, and publish-to-receive latency in a subscriber process
+    with messages published period seconds apart, for each transport."""
+    # A subscriber started like any other program, with its own resource tracker
+    multiprocessing = get_context('spawn')
+    pool = ShotBufferPool(6)
+    buffers = pool.acquire()
+    for address in addresses:
+        try:
+            publisher = make_publisher(address)
+        except ImportError as e:
+            print('%s: skipped, %s' % (address, e))
+            continue
+        try:
+            start = perf_counter()
+            for i in range(messages):
+                publisher.publish(buffers, 6)
+            _report('publish %s' % address, perf_counter() - start, messages)
+
+            ready = multiprocessing.Event()
+            results = multiprocessing.Queue()
+            subscriber = multiprocessing.Process(target=_feedback_subscriber,
+                                                 args=(address, messages, ready, results))
+            subscriber.start()
+            ready.wait(10)
+            sleep(0.2) # Let a ZeroMQ subscription reach the publisher
+            due = perf_counter()
+            for i in range(messages):
+                due += period
+                while perf_counter() < due:
+                    pass
+                publisher.publish(buffers, 6)
+            latencies, dropped = results.get(timeout=30)
+            subscriber.join()
+            p50, p99, worst = 1e6 * np.percentile(latencies, [50, 99, 100])
+            print('%-28s latency p50 %7.1f us  p99 %7.1f us  max %7.1f us, %d received, %d dropped' % (
+                address, p50, p99, worst, len(latencies), dropped))
+        finally:
+            publisher.close()
+
+
+
+class _SlowDisplay(object):
+    """Stands in for the tab: busy for drawTime seconds after every frame it is shown."""
+    def __init__(self, drawTime):
+        self.drawTime = drawTime
+        self.busyUntil = 0.
+
+    def ready(self):
+        return perf_counter() >= self.busyUntil
+
+    def show(self, buffers, info):
+        self.busyUntil = perf_counter() + self.drawTime
+
+
+def bench_monitor(seconds=2., maxRate=20., drawTimes=(0., 0.03, 0.2)):
+    """Live view of the worker on the simulated SDK in continuous mode: acquisition and
+    display rates with a display taking drawTime seconds per frame."""
+    worker = _simulated_worker()
+    if worker is None:
+        return
+    log = io.StringIO()
+    with redirect_stdout(log):
+        worker.init()
+        worker.program_manual(_front_panel())
+    worker.wfs.WFS_SetTriggerMode(worker.instrumentHandle, ct.c_int32(CONTINUOUS_TRIGGER_MODE))
+    for drawTime in drawTimes:
+        buffers = ShotBufferPool(worker.zernikeOrder.value, blockSize=1).acquire()
+        monitor = Monitor(worker.monitor_frame, buffers, _SlowDisplay(drawTime), maxRate)
+        with redirect_stdout(log):
+            monitor.start()
+            sleep(seconds)
+            monitor.stop()
+        print('draw %5.0f ms: %7.1f frames/s acquired, %5.1f frames/s shown, %d dropped' % (
+            1e3*drawTime, monitor.frames/seconds, monitor.shown/seconds, monitor.dropped))
+    worker.shutdown()
+
+
+
+def _run_head(serial, frames, tmpdir, barrier):
+    """One sensor of bench_heads: init, program_manual and a free running shot started at the
+    barrier, printing the worker's output; returns (init seconds, instrument scans, shot start, shot end, frames saved)."""
+    worker = _simulated_worker(serialNum=serial, orientation='wfs_' + serial)
+    start = perf_counter()
+    worker.init()
+    initTime = perf_counter() - start
+    worker.program_manual(_front_panel())
+    path = os.path.join(tmpdir, serial + '.h5')
+    _exposures_file(path, 'wfs', [])
+    worker.transition_to_buffered('wfs', path, {}, False)
+    barrier.wait()
+    start = perf_counter()
+    worker.wfs.schedule_triggers([start] * frames)
+    while len(worker.dataList) < frames and perf_counter() - start < 120:
+        sleep(1e-3)
+    end = perf_counter()
+    worker.transition_to_manual()
+    worker.shutdown()
+    with h5py.File(path, 'r') as f:
+        saved = len(f['images/wfs_%s/Measurements/Measurements' % serial])
+    return initTime, worker.instrumentList.scans, start, end, saved
+
+def _head_process(serial, frames, tmpdir, enumerateTime, barrier, results):
+    SimulatedWFS.enumerateTime = enumerateTime
+    with redirect_stdout(io.StringIO()):
+        results.put(_run_head(serial, frames, tmpdir, barrier))
+
+
+# Run in a new interpreter, so the import is timed from scratch as when BLACS starts a worker
+_STARTUP_SCRIPT = """
+import io, json, sys
+from contextlib import redirect_stdout
+from time import perf_counter
+start = perf_counter()
+from labscript_devices.ThorlabsWaveFrontSensor.blacs_workers import ThorlabsWaveFrontSensorWorker
+imported = perf_counter()
+from labscript_devices.ThorlabsWaveFrontSensor import device_manager
+from labscript_devices.ThorlabsWaveFrontSensor.simulated_wfs import SimulatedWFS
+device_manager.PROFILE_DIR, SimulatedWFS.enumerateTime, SimulatedWFS.initTime, SimulatedWFS.mlaDataTime = json.loads(sys.argv[1])
+worker = ThorlabsWaveFrontSensorWorker.__new__(ThorlabsWaveFrontSensorWorker)
+worker.__dict__.update(json.loads(sys.argv[2]))
+with redirect_stdout(io.StringIO()):
+    begin = perf_counter()
+    worker.init()
+    initialized = perf_counter()
+    worker.shutdown()
+print(json.dumps([imported - start, initialized - begin, worker.instrumentList.scans]))
+"""
+
+
+def bench_startup(starts=3, enumerateTime=0.05, initTime=0.2, mlaDataTime=0.02):
+    """Worker start in a new interpreter with the simulated SDK: module import and init, cold (no
+    instrument list cache, no device profile) and warm (profile saved by an earlier start), and
+    with a stale profile whose resource cannot be opened. Scanning takes enumerateTime per
+    connected head, WFS_init initTime and WFS_GetMlaData mlaDataTime."""
+    import json
+    import subprocess
+    import sys
+    worker = _simulated_worker()
+    if worker is None:
+        return
+    from labscript_devices.ThorlabsWaveFrontSensor.device_manager import DeviceProfile
+    with tempfile.TemporaryDirectory() as profileDir:
+        profile = DeviceProfile('simulated', 'M00000000', profileDir)
+        settings = json.dumps([profileDir, enumerateTime, initTime, mlaDataTime])
+        for case in ('cold', 'warm', 'stale profile'):
+            times = []
+            for _ in range(starts):
+                if case == 'cold':
+                    profile.clear()
+                elif case == 'stale profile':
+                    profile.save(dict(profile.load(), resourceName='USB::SIMULATED::UNPLUGGED'))
+                if case != 'warm':
+                    InstrumentList(None, 'simulated').invalidate()
+                output = subprocess.run([sys.executable, '-c', _STARTUP_SCRIPT, settings, json.dumps(worker.__dict__)],
+                                        capture_output=True, text=True, check=True).stdout
+                times.append(json.loads(output.splitlines()[-1]))
+            imports, inits, scans = zip(*times)
+            print('%-14s import %6.1f ms  init %6.1f ms  (median of %d, %d instrument scans)' % (
+                case, 1e3*np.median(imports), 1e3*np.median(inits), starts, sum(scans)))
+
+
+def bench_heads(frames=300, heads=(1, 2, 3, 4), enumerateTime=0.05):
+    """Aggregate frames per second of 1 to 4 simulated sensors acquiring at once, each
+    with its own worker, in its own process as under BLACS or as threads of one process.
+    Enumerating takes enumerateTime seconds per connected head; only the first worker
+    to start scans, the others use the shared instrument list."""
+    if _simulated_worker() is None:
+        return
+    import threading
+    multiprocessing = get_context('spawn')
+    print('%d CPUs' % os.cpu_count())
+    for mode in ('processes', 'threads'):
+        for n in heads:
+            InstrumentList(None, 'simulated').invalidate()
+            serials = SIMULATED_SERIALS[:n]
+            with tempfile.TemporaryDirectory() as tmpdir:
+                if mode == 'processes':
+                    barrier = multiprocessing.Barrier(n)
+                    queue = multiprocessing.Queue()
+                    processes = [multiprocessing.Process(target=_head_process,
+                                                         args=(serial, frames, tmpdir, enumerateTime, barrier, queue))
+                                 for serial in serials]
+                    for process in processes:
+                        process.start()
+                    results = [queue.get(timeout=300) for process in processes]
+                    for process in processes:
+                        process.join()
+                else:
+                    SimulatedWFS.enumerateTime = enumerateTime
+                    barrier = threading.Barrier(n)
+                    results = [None] * n
+                    def run(i):
+                        results[i] = _run_head(serials[i], frames, tmpdir, barrier)
+                    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+                    # sys.stdout is shared by the threads, so it is redirected once around all of them
+                    with redirect_stdout(io.StringIO()):
+                        for thread in threads:
+                            thread.start()
+                        for thread in threads:
+                            thread.join()
+                    SimulatedWFS.enumerateTime = 0.
+            inits, scans, starts, ends, saved = zip(*results)
+            aggregate = sum(saved) / (max(ends) - min(starts))
+            print('%-9s %d heads: %7.1f frames/s aggregate, %6.1f per head; init %5.0f-%5.0f ms, %d instrument scans' % (
+                mode, n, aggregate, aggregate / n, 1e3*min(inits), 1e3*max(inits), sum(scans)))
+
+
+BENCHMARKS = {
+    'readout': bench_readout,
+    'end_of_shot': bench_end_of_shot,
+    'exposures': bench_exposures,
+    'frame_timing': bench_frame_timing,
+    'feedback': bench_feedback,
+    'trigger_wait': bench_trigger_wait,
+    'pipeline': bench_pipeline,
+    'profiles': bench_profiles,
+    'records': bench_records,
+    'reference': bench_reference,
+    'spotfield': bench_spotfield,
+    'codecs': bench_codecs,
+    'aggregate': bench_aggregate,
+    'centroiding': bench_centroiding,
+    'crop': bench_crop,
+    'heads': bench_heads,
+    'lifecycle': bench_lifecycle,
+    'monitor': bench_monitor,
+    'smart_programming': bench_smart_programming,
+    'startup': bench_startup,
+    'stage_timing': bench_stage_timing,
+    'zernike': bench_zernike,
+    'zonal': bench_zonal,
+    'reprocess': bench_reprocess,
+    'run_store': bench_run_store,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='one or more of %s (default: all)' % ', '.join(sorted(BENCHMARKS)))
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: ' + name)
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        print('== ' + name)
+        BENCHMARKS[name]()
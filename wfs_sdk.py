@@ -0,0 +1,31 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/ThorlabsWaveFrontSensor/wfs_sdk.py             #
+#                                                                   #
+# This file is part of labscript_devices                            #
+#                                                                   #
+#####################################################################
+import ctypes as ct
+
+WFS_DLL_PATH = r'C:\Program Files\IVI Foundation\VISA\Win64\Bin\WFS_64.dll'
+# WFS_DLL_PATH = r'C:\Program Files (x86)\IVI Foundation\VISA\WinNT\Bin\WFS_32.dll' # with ct.WinDLL
+
+def _load_dll(serialNum):
+    return ct.cdll.LoadLibrary(WFS_DLL_PATH)
+
+def _load_simulated(serialNum):
+    # Imported here so the real backend does not pull in the NumPy Zernike code
+    from labscript_devices.ThorlabsWaveFrontSensor.simulated_wfs import SimulatedWFS
+    return SimulatedWFS(serialNum=serialNum)
+
+# Implementations of the WFS_* function table, selected with sdkBackend in the connection table
+SDK_BACKENDS = {
+    'dll': _load_dll,
+    'simulated': _load_simulated,
+}
+
+def load_sdk(backend, serialNum):
+    """WFS_* function table by backend name: the Thorlabs DLL, or SimulatedWFS for running without hardware."""
+    if backend not in SDK_BACKENDS:
+        raise ValueError('Unknown SDK backend %r, expected one of %s' % (backend, ', '.join(SDK_BACKENDS)))
+    return SDK_BACKENDS[backend](serialNum)
@@ -0,0 +1,196 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/ThorlabsWaveFrontSensor/zernike.py             #
+#                                                                   #
+# This file is part of labscript_devices                            #
+#                                                                   #
+#####################################################################
+"""NumPy least-squares Zernike fit of Shack-Hartmann spot deviations.
+
+The fit mirrors WFS_ZernikeLsf: modes are numbered like the WFS software
+(Z1 piston, Z2 tip, Z3 tilt, Z4 astigmatism 45, Z5 defocus, ... i.e. ANSI
+order plus one), normalised to unit RMS over the pupil, and coefficients are
+in um. The gradient basis only depends on the spot grid, the pupil and the
+order, so it is built once, inverted once and cached; every frame after that
+is a single matrix product.
+
+Lenslet centres are taken on a regular grid of lensletPitchUm centred on the
+sensor, with x along the columns and y along the rows of the spot arrays.
+"""
+from collections import OrderedDict, namedtuple
+from math import factorial, sqrt
+import numpy as np
+
+from labscript_devices.ThorlabsWaveFrontSensor.shot_buffers import ZernikeOrderCount
+
+# Everything that determines the fit matrix except the Zernike order. The pitches and
+# focal length come from WFS_GetMlaData, the pupil from the front panel (WFS_SetPupil).
+SpotGeometry = namedtuple('SpotGeometry', [
+    'spotsX', 'spotsY',
+    'lensletPitchUm', 'camPitchUm', 'lensletFocalUm',
+    'pupilCenterXMm', 'pupilCenterYMm', 'pupilDiameterXMm', 'pupilDiameterYMm',
+])
+
+
+# Names of the SpotGeometry fields among the attributes of the images/<orientation> group
+GEOMETRY_ATTRS = SpotGeometry(
+    'Spots X', 'Spots Y',
+    'Lenslet Pitch', 'Camera Pitch', 'Lenslet Focal Length',
+    'Pupil Center X', 'Pupil Center Y', 'Pupil Diameter X', 'Pupil Diameter Y',
+)
+
+def geometry_from_attrs(attrs):
+    """SpotGeometry of a shot from the attributes of its images/<orientation> group."""
+    return SpotGeometry(*[type(default)(attrs[name]) for name, default in
+                          zip(GEOMETRY_ATTRS, SpotGeometry(0, 0, 0., 0., 0., 0., 0., 0., 0.))])
+
+def geometry_attrs(geometry):
+    """Inverse of geometry_from_attrs."""
+    return dict(zip(GEOMETRY_ATTRS, geometry))
+
+
+def zernike_modes(order):
+    """(n, m) of every mode up to radial order `order`, in WFS numbering order."""
+    return [(n, m) for n in range(order+1) for m in range(-n, n+1, 2)]
+
+
+def _radial_polynomial(n, m):
+    """Coefficients of P(s), s = rho**2, such that R_n^m(rho) = rho**|m| * P(s), highest power first."""
+    m = abs(m)
+    return np.array([(-1)**k * factorial(n-k) / (factorial(k) * factorial((n+m)//2-k) * factorial((n-m)//2-k))
+                     for k in range((n-m)//2+1)])
+
+def zernike(n, m, u, v):
+    """Value and gradient (Z, dZ/du, dZ/dv) of the normalised Zernike polynomial Z_n^m at
+    unit pupil coordinates u, v.
+
+    Written as P(u**2 + v**2) * Re/Im((u + iv)**|m|) so that it is a plain polynomial,
+    with no singularity at the pupil centre."""
+    a = abs(m)
+    norm = sqrt(n+1) if m == 0 else sqrt(2*(n+1))
+    s = u*u + v*v
+    coefficients = _radial_polynomial(n, m)
+    P = np.polyval(coefficients, s)
+    dP = np.polyval(np.polyder(coefficients), s) if len(coefficients) > 1 else np.zeros_like(s)
+    w = u + 1j*v
+    wa = w**a
+    dwa = a * w**(a-1) if a else np.zeros_like(w)
+    if m >= 0:
+        T, dTdu, dTdv = wa.real, dwa.real, -dwa.imag
+    else:
+        T, dTdu, dTdv = wa.imag, dwa.imag, dwa.real
+    Z = norm * P * T
+    dZdu = norm * (2*u*dP*T + P*dTdu)
+    dZdv = norm * (2*v*dP*T + P*dTdv)
+    return Z, dZdu, dZdv
+
+
+def lenslet_coordinates(geometry):
+    """x, y (um) of every lenslet of the spot grid, each of shape (spotsY, spotsX)."""
+    x = (np.arange(geometry.spotsX) - (geometry.spotsX-1)/2) * geometry.lensletPitchUm
+    y = (np.arange(geometry.spotsY) - (geometry.spotsY-1)/2) * geometry.lensletPitchUm
+    return np.meshgrid(x, y)
+
+def pupil_coordinates(geometry):
+    """Unit pupil coordinates u, v of every lenslet and the mask of those inside the pupil."""
+    x, y = lenslet_coordinates(geometry)
+    u = (x - 1e3*geometry.pupilCenterXMm) / (5e2*geometry.pupilDiameterXMm)
+    v = (y - 1e3*geometry.pupilCenterYMm) / (5e2*geometry.pupilDiameterYMm)
+    return u, v, u*u + v*v <= 1
+
+def spot_grid_crop(geometry):
+    """(rowStart, rowStop, columnStart, columnStop) of the valid part of the spot arrays."""
+    return (0, geometry.spotsY, 0, geometry.spotsX)
+
+def pupil_crop(geometry, margin=1):
+    """Smallest crop of the spot arrays holding every lenslet inside the pupil, plus margin
+    lenslets on each side; the whole spot grid if the pupil misses it."""
+    _, _, mask = pupil_coordinates(geometry)
+    rows, columns = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+    if not len(rows):
+        return spot_grid_crop(geometry)
+    return (int(max(rows[0] - margin, 0)), int(min(rows[-1] + 1 + margin, geometry.spotsY)),
+            int(max(columns[0] - margin, 0)), int(min(columns[-1] + 1 + margin, geometry.spotsX)))
+
+
+class ZernikeBasis(object):
+    """Fit matrix for one spot geometry and Zernike order.
+
+    matrix maps the stacked x and y slopes of the lenslets inside the pupil to
+    the Zernike gradients; pinv is its pseudo-inverse. Piston has no gradient
+    and is always reported as 0.
+    """
+    def __init__(self, geometry, order):
+        self.geometry = geometry
+        self.order = order
+        self.modes = zernike_modes(order)
+        u, v, self.mask = pupil_coordinates(geometry)
+        u, v = u[self.mask], v[self.mask]
+        radiusXUm = 5e2*geometry.pupilDiameterXMm
+        radiusYUm = 5e2*geometry.pupilDiameterYMm
+        columns = []
+        for n, m in self.modes[1:]:
+            _, dZdu, dZdv = zernike(n, m, u, v)
+            columns.append(np.concatenate([dZdu / radiusXUm, dZdv / radiusYUm]))
+        self.matrix = np.stack(columns, axis=1)
+        self.pinv = np.linalg.pinv(self.matrix)
+        # Deviations are in camera pixels; the slope is the spot shift over the lenslet focal length
+        self.slopeScale = geometry.camPitchUm / geometry.lensletFocalUm
+
+    def slopes(self, deviations):
+        """Stacked x and y slopes inside the pupil, shape (..., 2*spots), from (..., rows, cols, 2) deviations."""
+        g = self.geometry
+        deviations = np.asarray(deviations)[..., :g.spotsY, :g.spotsX, :]
+        inPupil = deviations[..., self.mask, :]
+        return self.slopeScale * np.concatenate([inPupil[..., 0], inPupil[..., 1]], axis=-1)
+
+    def fit(self, deviations):
+        """Zernike coefficients (um), shape (..., modes), of one or many frames of spot deviations.
+
+        Frames without missing spots are fitted together with one matrix product; the
+        rest are solved individually over the spots that were found."""
+        slopes = self.slopes(deviations)
+        frames = slopes.reshape(-1, slopes.shape[-1])
+        coefficients = np.zeros((len(frames), len(self.modes)))
+        valid = np.isfinite(frames)
+        complete = valid.all(axis=1)
+        coefficients[complete, 1:] = frames[complete] @ self.pinv.T
+        for i in np.flatnonzero(~complete):
+            coefficients[i, 1:] = np.linalg.lstsq(self.matrix[valid[i]], frames[i, valid[i]], rcond=None)[0]
+        return coefficients.reshape(slopes.shape[:-1] + (len(self.modes),))
+
+    def order_rms(self, coefficients):
+        """RMS (um) of each radial order 1..order, like the arrayZernikeOrdersUm output of WFS_ZernikeLsf."""
+        coefficients = np.asarray(coefficients)
+        radialOrders = np.array([n for n, m in self.modes])
+        return np.stack([np.sqrt((coefficients[..., radialOrders == n]**2).sum(axis=-1))
+                         for n in range(1, self.order+1)], axis=-1)
+
+    def radius_of_curvature(self, coefficients):
+        """Radius of curvature (mm) of the wavefront from the defocus term Z5."""
+        radiusUm = 2.5e2*(self.geometry.pupilDiameterXMm + self.geometry.pupilDiameterYMm)
+        with np.errstate(divide='ignore'):
+            return 1e-3 * radiusUm**2 / (4*sqrt(3)*np.asarray(coefficients)[..., 4])
+
+
+class ZernikeFitter(object):
+    """Caches ZernikeBasis objects by geometry and order, least recently used first out."""
+    def __init__(self, maxCached=8):
+        self.maxCached = maxCached
+        self.cache = OrderedDict()
+
+    def basis(self, geometry, order):
+        if not 2 <= order < len(ZernikeOrderCount):
+            raise ValueError('Zernike order must be between 2 and %d, not %s' % (len(ZernikeOrderCount)-1, order))
+        key = (tuple(geometry), order)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+        else:
+            self.cache[key] = ZernikeBasis(geometry, order)
+            while len(self.cache) > self.maxCached:
+                self.cache.popitem(last=False)
+        return self.cache[key]
+
+    def fit(self, deviations, geometry, order):
+        """Zernike coefficients of one (rows, cols, 2) frame or a (frames, rows, cols, 2) stack."""
+        return self.basis(geometry, order).fit(deviations)
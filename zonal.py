@@ -0,0 +1,196 @@
+#####################################################################
+#                                                                   #
+# /labscript_devices/ThorlabsWaveFrontSensor/zonal.py               #
+#                                                                   #
+# This file is part of labscript_devices                            #
+#                                                                   #
+#####################################################################
+"""Zonal least-squares reconstruction of the wavefront from spot deviations.
+
+What WFS_CalcWavefront does inside the SDK, on stored or live spot
+deviations and for any number of frames at once. The wavefront is
+reconstructed at the lenslet centres inside the pupil in the Southwell
+geometry: for every two neighbouring lenslets the wavefront difference is
+the lenslet pitch times the mean of their slopes along the line joining
+them, and the wavefront is the least-squares solution of all those
+differences. Spot deviations are in camera pixels like everywhere else;
+the slope is the deviation over the lenslet focal length. The wavefront is
+in um, with zero mean over the lenslets it is defined at, since the
+deviations say nothing about piston.
+
+The normal equations are a Poisson equation on the lenslets inside the
+pupil, with a Neumann boundary at the pupil edge. On the rectangle around
+the pupil that Poisson equation is solved exactly by a cosine transform
+(DCT-II), which is used to precondition conjugate gradients on the pupil
+itself; they converge in 10 to 20 iterations. The transform and the
+edges between lenslets depend only on the spot grid and the pupil, so they
+are built once per geometry and cached. Frames are solved together, each
+with its own edges, so a frame with missing spots (NaN) simply loses the
+differences that involve them. Lenslets left without any difference are
+NaN in the result.
+
+The spot grid holds at most 80 x 80 lenslets, so the transform is applied
+as two small matrix products per frame rather than by FFT.
+"""
+from collections import OrderedDict
+from threading import Lock
+import numpy as np
+
+from labscript_devices.ThorlabsWaveFrontSensor.zernike import pupil_coordinates
+
+# Values of the wavefrontSolver connection table property: the SDK's WFS_CalcWavefront on the
+# capture thread, or this reconstruction on the processing thread
+WAVEFRONT_SOLVERS = ('sdk', 'zonal')
+TOLERANCE = 1e-6 # relative residual at which a frame has converged
+MAX_ITERATIONS = 200
+
+
+def cosine_basis(n):
+    """Orthonormal DCT-II matrix of size n and the eigenvalues of the Neumann Laplacian of n points in it."""
+    k = np.arange(n)
+    basis = np.cos(np.pi * k[:, None] * (k[None, :] + 0.5) / n) * np.sqrt(2. / n)
+    basis[0] /= np.sqrt(2.)
+    return basis, 2. - 2.*np.cos(np.pi * k / n)
+
+
+class SouthwellSolver(object):
+    """Cached edges and preconditioner of the zonal reconstruction for one spot geometry.
+
+    rows and columns are the slices of the spot grid holding the pupil, and
+    mask the lenslets inside it; results are only calculated there. Nothing
+    is changed by reconstruct() but iterations, the count of the last call,
+    so several threads can reconstruct with one solver."""
+    def __init__(self, geometry, tolerance=TOLERANCE, maxIterations=MAX_ITERATIONS):
+        self.geometry = geometry
+        self.tolerance = tolerance
+        self.maxIterations = maxIterations
+        self.iterations = 0
+        _, _, mask = pupil_coordinates(geometry)
+        rows, columns = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+        self.rows = slice(rows[0], rows[-1] + 1) if len(rows) else slice(0, 0)
+        self.columns = slice(columns[0], columns[-1] + 1) if len(columns) else slice(0, 0)
+        self.mask = mask[self.rows, self.columns]
+        # Differences between neighbours inside the pupil, along x (columns) and y (rows)
+        self.edgesX = self.mask[:, 1:] & self.mask[:, :-1]
+        self.edgesY = self.mask[1:, :] & self.mask[:-1, :]
+        self.cosY, eigenY = cosine_basis(self.mask.shape[0])
+        self.cosX, eigenX = cosine_basis(self.mask.shape[1])
+        eigen = eigenY[:, None] + eigenX[None, :]
+        with np.errstate(divide='ignore'):
+            # The constant mode is the free piston
+            self.inverseEigen = np.where(eigen > 0, 1. / eigen, 0.)
+        # Wavefront difference (um) of two neighbours per pixel of summed deviation
+        self.differenceScale = 0.5 * geometry.lensletPitchUm * geometry.camPitchUm / geometry.lensletFocalUm
+
+    def _laplacian(self, w, weightsX, weightsY):
+        # D^T diag(weights) D w, D the differences along the edges
+        dx = (w[:, :, 1:] - w[:, :, :-1]) * weightsX
+        dy = (w[:, 1:, :] - w[:, :-1, :]) * weightsY
+        out = np.zeros_like(w)
+        out[:, :, :-1] -= dx
+        out[:, :, 1:] += dx
+        out[:, :-1, :] -= dy
+        out[:, 1:, :] += dy
+        return out
+
+    def _precondition(self, r, valid):
+        # Exact inverse of the Laplacian of the whole rectangle, restricted to the valid lenslets
+        spectrum = self.cosY @ r @ self.cosX.T
+        return (self.cosY.T @ (spectrum * self.inverseEigen) @ self.cosX) * valid
+
+    def reconstruct(self, deviations):
+        """Wavefront (um) of one (rows, cols, 2) frame or a (frames, rows, cols, 2) stack of spot deviations.
+
+        The result has the spot rows and columns of the input, float32, NaN
+        outside the pupil and at lenslets without a valid neighbour."""
+        deviations = np.asarray(deviations)
+        single = deviations.ndim == 3
+        if single:
+            deviations = deviations[None]
+        frames = len(deviations)
+        result = np.full(deviations.shape[:3], np.nan, dtype=np.float32)
+        if not self.mask.any() or not frames:
+            return result[0] if single else result
+        pupil = deviations[:, self.rows, self.columns].astype(np.float64)
+        sx, sy = pupil[..., 0], pupil[..., 1]
+        differenceX = self.differenceScale * (sx[:, :, 1:] + sx[:, :, :-1])
+        differenceY = self.differenceScale * (sy[:, 1:, :] + sy[:, :-1, :])
+        # Only differences between two found spots count
+        weightsX = (self.edgesX & np.isfinite(differenceX)).astype(np.float64)
+        weightsY = (self.edgesY & np.isfinite(differenceY)).astype(np.float64)
+        differenceX = np.where(weightsX > 0, differenceX, 0.)
+        differenceY = np.where(weightsY > 0, differenceY, 0.)
+        valid = np.zeros(pupil.shape[:3], dtype=bool)
+        for weights, axis in ((weightsX > 0, 2), (weightsY > 0, 1)):
+            first = [slice(None)] * 3
+            second = [slice(None)] * 3
+            first[axis], second[axis] = slice(None, -1), slice(1, None)
+            valid[tuple(first)] |= weights
+            valid[tuple(second)] |= weights
+
+        # b = D^T diag(weights) differences, then preconditioned conjugate gradients from w = 0
+        b = np.zeros(pupil.shape[:3])
+        b[:, :, :-1] -= differenceX
+        b[:, :, 1:] += differenceX
+        b[:, :-1, :] -= differenceY
+        b[:, 1:, :] += differenceY
+        w = np.zeros_like(b)
+        r = b.copy()
+        z = self._precondition(r, valid)
+        p = z.copy()
+        rz = np.einsum('fyx,fyx->f', r, z)
+        threshold = (self.tolerance * np.sqrt(np.einsum('fyx,fyx->f', b, b)))**2
+        iterations = 0
+        while iterations < self.maxIterations:
+            active = np.einsum('fyx,fyx->f', r, r) > threshold
+            if not active.any():
+                break
+            Ap = self._laplacian(p, weightsX, weightsY)
+            pAp = np.einsum('fyx,fyx->f', p, Ap)
+            alpha = np.where(active, rz / np.where(pAp > 0, pAp, 1.), 0.)
+            w += alpha[:, None, None] * p
+            r -= alpha[:, None, None] * Ap
+            z = self._precondition(r, valid)
+            rzNext = np.einsum('fyx,fyx->f', r, z)
+            beta = np.where(active, rzNext / np.where(rz > 0, rz, 1.), 0.)
+            p = z + beta[:, None, None] * p
+            rz = rzNext
+            iterations += 1
+        self.iterations = iterations
+
+        counts = valid.sum(axis=(1, 2))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(valid, w, 0.).sum(axis=(1, 2)) / counts
+        w = np.where(valid, w - mean[:, None, None], np.nan)
+        result[:, self.rows, self.columns] = w
+        return result[0] if single else result
+
+
+class ZonalReconstructor(object):
+    """Caches SouthwellSolver objects by geometry, least recently used first out.
+
+    Safe to use from several threads, e.g. the processing workers of pipeline.py."""
+    def __init__(self, maxCached=8):
+        self.maxCached = maxCached
+        self.cache = OrderedDict()
+        self.lock = Lock()
+
+    def solver(self, geometry):
+        key = tuple(geometry)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        # Built outside the lock, so other geometries are not held up; a thread building the same
+        # one at the same time only wastes the work
+        solver = SouthwellSolver(geometry)
+        with self.lock:
+            solver = self.cache.setdefault(key, solver)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.maxCached:
+                self.cache.popitem(last=False)
+        return solver
+
+    def reconstruct(self, deviations, geometry):
+        """Wavefront of one (rows, cols, 2) frame or a (frames, rows, cols, 2) stack of spot deviations."""
+        return self.solver(geometry).reconstruct(deviations)